@@ -0,0 +1,134 @@
+#! /usr/bin/env python3.2
+"""Hand an ssh request to a running p4gf_auth_daemon.py.
+
+p4gf_auth_server.py imports this before anything else. If a daemon is
+listening on its Unix socket, forward_if_daemon() passes it this process's
+argv, environment, working directory and stdin/stdout/stderr file
+descriptors, waits for the daemon to report the request's exit code, and
+exits with that. git and ssh never notice the difference: the daemon's
+worker reads and writes the very same descriptors.
+
+If there is no daemon, or this Python cannot pass file descriptors over a
+socket (socket.sendmsg() arrived in 3.3), forward_if_daemon() returns and
+p4gf_auth_server.py carries on in-process as it always has.
+
+Keep this module cheap to import: standard library only.
+"""
+
+import json
+import os
+import socket
+import struct
+import sys
+import time
+
+# When this request started, as near as we can tell: this module is the
+# first thing p4gf_auth_server.py imports. A daemon worker replaces this
+# with the time its client started.
+START = time.time()
+
+# Environment variable naming the daemon's socket. Unset means
+# DEFAULT_SOCKET_PATH.
+SOCKET_ENVAR = "P4GF_AUTH_DAEMON_SOCKET"
+DEFAULT_SOCKET_PATH = "~/.git-fusion/p4gf_auth_daemon.sock"
+
+# Request header: payload length, followed by the payload, a JSON dict.
+# Reply: exit code.
+_HEADER = struct.Struct("!I")
+_REPLY = struct.Struct("!i")
+
+# stdin, stdout, stderr
+_FDS = [0, 1, 2]
+
+
+def socket_path():
+    """Where the daemon listens."""
+    return os.path.expanduser(os.environ.get(SOCKET_ENVAR, DEFAULT_SOCKET_PATH))
+
+
+def fd_passing_supported():
+    """Can this Python pass file descriptors over a Unix socket?"""
+    return (    hasattr(socket, 'AF_UNIX')
+            and hasattr(socket.socket, 'sendmsg')
+            and hasattr(socket, 'SCM_RIGHTS'))
+
+
+def _recv_exactly(sock, size):
+    """Read exactly size bytes from sock, or raise EOFError."""
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError("p4gf_auth_daemon hung up")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_request(sock):
+    """Send this process's request down sock."""
+    payload = json.dumps({ 'argv'  : sys.argv
+                         , 'env'   : dict(os.environ)
+                         , 'cwd'   : os.getcwd()
+                         , 'start' : START
+                         }).encode('utf-8')
+    fds = struct.pack("{}i".format(len(_FDS)), *_FDS)
+    sock.sendmsg([_HEADER.pack(len(payload))],
+                 [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+    sock.sendall(payload)
+
+
+def recv_request(sock):
+    """Daemon side of send_request(). Return (payload dict, [fd, fd, fd])."""
+    int_size = struct.calcsize("i")
+    (header, ancdata, _flags, _addr) = sock.recvmsg(
+                    _HEADER.size, socket.CMSG_SPACE(len(_FDS) * int_size))
+    fds = []
+    for (level, kind, data) in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            count = len(data) // int_size
+            fds.extend(struct.unpack("{}i".format(count),
+                                     data[:count * int_size]))
+    if len(header) < _HEADER.size:
+        header += _recv_exactly(sock, _HEADER.size - len(header))
+    if len(fds) != len(_FDS):
+        for fd in fds:
+            os.close(fd)
+        raise RuntimeError("expected {} file descriptors, got {}"
+                           .format(len(_FDS), len(fds)))
+    (size,) = _HEADER.unpack(header)
+    payload = json.loads(_recv_exactly(sock, size).decode('utf-8'))
+    return (payload, fds)
+
+
+def send_reply(sock, exit_code):
+    """Daemon side: report the request's exit code."""
+    sock.sendall(_REPLY.pack(exit_code))
+
+
+def forward_if_daemon():
+    """If a daemon is listening, have it serve this request, and exit with
+    its exit code. If not, return.
+    """
+    if not fd_passing_supported():
+        return
+    path = socket_path()
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        # Stale socket left by a daemon that is no longer running.
+        sock.close()
+        return
+    try:
+        send_request(sock)
+        (code,) = _REPLY.unpack(_recv_exactly(sock, _REPLY.size))
+    except (socket.error, EOFError) as e:
+        # Too late to fall back: the daemon may have consumed stdin.
+        sys.stderr.write("error: p4gf_auth_daemon: {}\n".format(e))
+        code = 1
+    finally:
+        sock.close()
+    sys.exit(code)
@@ -0,0 +1,239 @@
+#! /usr/bin/env python3.2
+"""Long-running server for p4gf_auth_server.py requests.
+
+Every ssh request used to start a fresh Python, import every Git Fusion
+module, checksum every script for the version log, run 'git --version',
+and connect to Perforce, all before the first useful byte. Run this
+daemon as the Git Fusion Unix account and p4gf_auth_server.py hands each
+request to it over a Unix socket (see p4gf_auth_client.py) instead.
+
+The daemon does the per-process work once, at startup, then keeps a few
+spare worker processes forked and waiting, each already connected to
+Perforce. A worker serves exactly one request, on the client's own
+stdin/stdout/stderr, then exits, so one request's state never leaks into
+the next. As soon as a worker takes a request, the daemon forks another
+spare.
+
+Needs Python 3.3 or later to pass file descriptors. Clients fall back to
+serving requests in-process whenever the daemon is not running.
+
+Each request logs its startup time, from client process start to handing
+the connection to git, as "startup_ms=N" on the p4gf_auth_server.startup
+log, with or without the daemon, for comparison.
+"""
+
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+
+import p4gf_auth_client
+import p4gf_auth_server
+import p4gf_create_p4
+import p4gf_log
+import p4gf_util
+import p4gf_version
+
+LOG = p4gf_log.for_module()
+
+# Idle workers to keep waiting for requests.
+DEFAULT_SPARES = 2
+
+# A spare worker that has waited this long for a request exits, and the
+# daemon forks a fresh one: no Perforce connection sits idle for hours.
+SPARE_MAX_IDLE_SECS = 5 * 60
+
+# A worker tells the daemon "I took a request" by writing its pid here.
+_PID = struct.Struct("i")
+
+# The daemon answers on the worker's own pipe: "no longer a spare, go on".
+_GO = b'g'
+
+
+def _check_peer(conn):
+    """Serve only our own Unix account. Where the platform cannot tell us
+    who is on the other end, the socket's 0600 mode has to do.
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize("3i"))
+    (_pid, uid, _gid) = struct.unpack("3i", creds)
+    if uid != os.getuid():
+        raise RuntimeError("refusing request from uid {}".format(uid))
+
+
+def _serve_one(listener, taken_w, go_r):
+    """Worker: connect to Perforce, wait for one request, serve it, exit."""
+    code = 1
+    try:
+        p4gf_create_p4.prewarm()
+        (readable, _, _) = select.select([listener], [], [], SPARE_MAX_IDLE_SECS)
+        if not readable:
+            code = 0
+            return
+        # If another spare beat us to it, wait here for the next one.
+        (conn, _addr) = listener.accept()
+        listener.close()
+        # Serve nothing until the daemon no longer counts us as a spare it
+        # may stop. If it is stopping instead, it never says go.
+        os.write(taken_w, _PID.pack(os.getpid()))
+        if os.read(go_r, len(_GO)) != _GO:
+            return
+        _check_peer(conn)
+        (payload, fds) = p4gf_auth_client.recv_request(conn)
+
+        # Become the client: its stdin/stdout/stderr, environment,
+        # working directory, argv and start time.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for (i, fd) in enumerate(fds):
+            os.dup2(fd, i)
+            os.close(fd)
+        os.environ.clear()
+        os.environ.update(payload['env'])
+        os.chdir(payload['cwd'])
+        sys.argv = payload['argv']
+        p4gf_auth_client.START = payload['start']
+
+        try:
+            p4gf_auth_server.run(check_versions=False)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        p4gf_auth_client.send_reply(conn, code)
+    # pylint: disable=W0703
+    # Catching too general exception
+    # A worker must never fall back into the daemon's loop.
+    except Exception:
+        LOG.exception("auth daemon worker failed")
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def _spawn(listener, taken_w, go):
+    """Fork one spare worker. Remember its end of the go pipe in go, by
+    pid. Return its pid.
+    """
+    (go_r, go_w) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # The daemon's SIGTERM handler is for the daemon. A worker stopped
+        # in the middle of a request must not report success.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.close(go_w)
+        for fd in go.values():
+            os.close(fd)
+        _serve_one(listener, taken_w, go_r)
+    os.close(go_r)
+    go[pid] = go_w
+    return pid
+
+
+def _taken(data, idle, go):
+    """Workers whose pids are in data took requests: they are spares no
+    more. Tell each to go on.
+    """
+    for i in range(0, len(data) - _PID.size + 1, _PID.size):
+        pid = _PID.unpack(data[i:i + _PID.size])[0]
+        idle.discard(pid)
+        fd = go.pop(pid, None)
+        if fd is not None:
+            os.write(fd, _GO)
+            os.close(fd)
+
+
+def _reap(children, go):
+    """Collect exited workers."""
+    while children:
+        try:
+            (pid, _status) = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            return
+        if not pid:
+            return
+        children.discard(pid)
+        fd = go.pop(pid, None)
+        if fd is not None:
+            os.close(fd)
+
+
+def serve(path, spares):
+    """Listen on path and serve requests until killed."""
+    if not p4gf_auth_client.fd_passing_supported():
+        raise RuntimeError("p4gf_auth_daemon needs Python 3.3 or later.")
+
+    # Once, not once per request.
+    p4gf_version.log_version()
+    p4gf_version.git_version_check()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(old_umask)
+    listener.listen(64)
+    LOG.info("p4gf_auth_daemon pid={} listening on {}".format(os.getpid(), path))
+
+    (taken_r, taken_w) = os.pipe()
+    idle = set()
+    children = set()
+    go = {}         # pid ==> write end of that spare's go pipe
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))
+    try:
+        while True:
+            while len(idle) < spares:
+                pid = _spawn(listener, taken_w, go)
+                idle.add(pid)
+                children.add(pid)
+            (readable, _, _) = select.select([taken_r], [], [], 1.0)
+            if readable:
+                _taken(os.read(taken_r, 64 * _PID.size), idle, go)
+            _reap(children, go)
+            # A worker that died before taking a request is no spare.
+            idle &= children
+    finally:
+        # Workers already serving a request finish it, as do any that
+        # took one and told us so. Spares go, and so does any spare that
+        # took a request too late for that: without the go-ahead it has
+        # not started on it.
+        while select.select([taken_r], [], [], 0)[0]:
+            data = os.read(taken_r, 64 * _PID.size)
+            if not data:
+                break
+            _taken(data, idle, go)
+        for pid in idle:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for fd in go.values():
+            os.close(fd)
+        listener.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def main():
+    """Parse the command line and serve."""
+    parser = p4gf_util.create_arg_parser(
+        "Serves p4gf_auth_server.py requests without a per-request start-up.")
+    parser.add_argument('--socket', metavar="",
+            default=p4gf_auth_client.socket_path(),
+            help='Unix socket to listen on, default={}'
+                 .format(p4gf_auth_client.socket_path()))
+    parser.add_argument('--spares', metavar="", type=int, default=DEFAULT_SPARES,
+            help='idle workers to keep ready, default={}'.format(DEFAULT_SPARES))
+    args = parser.parse_args()
+    serve(args.socket, max(1, args.spares))
+    return 0
+
+
+if __name__ == "__main__":
+    p4gf_log.run_with_exception_logger(main, write_to_stderr=True)
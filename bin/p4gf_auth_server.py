@@ -21,8 +21,14 @@ Reject attempt if p4user lacks read privileges for the entire view.
 
 Reject unknown git command
 
+If p4gf_auth_daemon.py is running, hand the whole request to it instead,
+before paying to import anything else.
 """
 
+import p4gf_auth_client
+if __name__ == "__main__":
+    p4gf_auth_client.forward_if_daemon()
+
 import argparse
 import logging
 import os
@@ -30,19 +36,23 @@ import re
 import subprocess
 import shutil
 import sys
+import time
 import traceback
 
 import p4gf_audit_log
 import p4gf_const
 import p4gf_context
 import p4gf_copy_p2g
+import p4gf_create_p4
 from   p4gf_create_p4 import connect_p4
+import p4gf_fact_cache
 import p4gf_group
 import p4gf_init
 import p4gf_init_repo
 import p4gf_lock
 import p4gf_log
 import p4gf_p4msg
+import p4gf_pack_cache
 from p4gf_repolist import RepoList
 import p4gf_util
 import p4gf_version
@@ -55,7 +65,12 @@ def check_protects(p4):
     Fusion user is granted sufficient privileges. Returns False if this
     is not the case.
     """
-    return p4gf_version.p4d_supports_protects(p4)
+    if p4gf_fact_cache.get(p4, "protects"):
+        return True
+    okay = p4gf_version.p4d_supports_protects(p4)
+    if okay:
+        p4gf_fact_cache.put(p4, "protects")
+    return okay
 
 
 def illegal_option(option):
@@ -93,6 +108,7 @@ def cleanup_client(ctx, view_name):
 
     ctx.p4.run('sync', '-fq', command_path + '#none')
     ctx.p4.run('client', '-df', client_name)
+    p4gf_fact_cache.forget(ctx.p4)
     for vdir in [view_dirs.view_container]:
         LOG.debug('removing view directory {}'.format(vdir))
         if os.path.isdir(vdir):
@@ -271,12 +287,18 @@ def _check_lock_perm(p4):
     '''
     Permission check: can git-fusion-user set our lock counter? If not, you
     know what to do.
+
+    Taking and dropping a lock costs several counter writes: once it
+    works, trust p4gf_fact_cache that it still does.
     '''
+    if p4gf_fact_cache.get(p4, "lock_perm"):
+        return
     with p4gf_group.PermErrorOK(p4):
         with p4gf_lock.CounterLock(p4, "git_fusion_auth_server_lock"):
             pass
     if p4gf_p4msg.contains_protect_error(p4):
         _raise_p4gf_perm()
+    p4gf_fact_cache.put(p4, "lock_perm")
 
 
 def _check_authorization(view_perm, user, command, view_name):
@@ -292,21 +314,62 @@ def _check_authorization(view_perm, user, command, view_name):
                                view=view_name))
 
 
-def _call_original_git(ctx, args):
+def _call_original_git(view_dirs, args, call=subprocess.call):
     '''
     Pass to git-upload-pack/git-receive-pack. But with the view converted to
     an absolute path to the Git Fusion repo.
+
+    call(cmd_list) runs it and returns its exit code.
     '''
     converted_argv = args.options[:-1]
-    converted_argv.append(ctx.view_dirs.GIT_DIR)
+    converted_argv.append(view_dirs.GIT_DIR)
     cmd_list = args.command + converted_argv
+    LOG.getChild("startup").info("startup_ms={}".format(
+                int((time.time() - p4gf_auth_client.START) * 1000)))
     logging.getLogger("cmd").debug(' '.join(cmd_list))
     # Note that we are intentionally _not_ using the shell, to avoid vulnerabilities.
-    code = subprocess.call(cmd_list)
+    code = call(cmd_list)
     logging.getLogger("cmd.exit").debug("exit: {0}".format(code))
     return code
 
 
+def _call_upload_pack(view_dirs, args):
+    '''
+    Serve a fetch from the refs already published in the Git Fusion repo.
+
+    Holds the view's refs lock shared, not the exclusive view lock: any
+    number of fetches can run at once, and only wait for the short time
+    it takes P2G to move refs.
+
+    With P4GF_UPLOAD_PACK_CACHE on, a full clone of refs already cloned
+    gets the response saved last time (see p4gf_pack_cache).
+    '''
+    call = subprocess.call
+    if p4gf_pack_cache.enabled():
+        call = lambda cmd_list: p4gf_pack_cache.upload_pack(view_dirs, cmd_list)
+    # Flush stderr before returning control to Git.
+    # Otherwise Git's own output might interrupt ours.
+    sys.stderr.flush()
+    with p4gf_lock.RefsLock(view_dirs):
+        return _call_original_git(view_dirs, args, call)
+
+
+def _up_to_date_view_dirs(p4, view_name):
+    '''
+    If view_name's Git Fusion repo already holds everything in the view,
+    return its ViewDirs. If not, or if there is no such repo yet, return None.
+    '''
+    view_dirs = p4gf_view_dirs.from_p4gf_dir(p4gf_util.p4_to_p4gf_dir(p4),
+                                             view_name)
+    if not os.path.exists(view_dirs.GIT_DIR):
+        return None
+    if not p4gf_copy_p2g.up_to_date(p4,
+                                    p4gf_context.view_to_client_name(view_name),
+                                    view_dirs.GIT_DIR):
+        return None
+    return view_dirs
+
+
 def main():
     """set up repo for a view"""
     with ExceptionAuditLogger():
@@ -342,6 +405,16 @@ def main():
         # Create Git Fusion server depot, user, config. NOPs if already created.
         p4gf_init.init(p4)
 
+        # A fetch that finds nothing new in Perforce needs no P2G, and so
+        # no exclusive view lock. Only in a bare repo: with a work tree,
+        # G2P checks out commits and moves HEAD and refs outside RefsLock.
+        if args.command[0] == 'git-upload-pack' and p4gf_util.git_bare_repo():
+            view_dirs = _up_to_date_view_dirs(p4, view_name)
+            if view_dirs:
+                LOG.debug("view {} up to date, serving fetch".format(view_name))
+                view_perm.write_if(p4)
+                return _call_upload_pack(view_dirs, args)
+
         with p4gf_lock.view_lock(p4, view_name) as view_lock:
 
             # Create Git Fusion per-repo client view mapping and config.
@@ -363,10 +436,9 @@ def main():
             view_perm.write_if(p4)
 
             # Now that we have valid git-fusion-user and
-            # git-fusion-<view> client, replace our temporary P4
-            # connection with a more permanent Context, shared for the
-            # remainder of this process.
-            ctx = p4gf_context.create_context(view_name, view_lock)
+            # git-fusion-<view> client, hand our P4 connection to a more
+            # permanent Context, shared for the remainder of this process.
+            ctx = p4gf_context.create_context(view_name, view_lock, p4)
             del p4
             LOG.debug("reconnected to P4, p4gf=%s", ctx.p4gf)
 
@@ -400,24 +472,51 @@ def main():
             # original git, otherwise we won't be able to push master.
             p4gf_util.checkout_detached_master()
 
+            # A fetch reads only the refs P2G just published: let the next
+            # writer have the view while we serve it.
+            if args.command[0] == 'git-upload-pack':
+                view_lock.release()
+                return _call_upload_pack(ctx.view_dirs, args)
+
+            # Spare our pre-receive hook from asking Perforce all over
+            # again what ctx already knows.
+            os.environ[p4gf_const.P4GF_CONTEXT_HANDOFF_ENVAR] = \
+                                            p4gf_context.write_handoff(ctx)
+
             # Flush stderr before returning control to Git.
             # Otherwise Git's own output might interrupt ours.
             sys.stderr.flush()
 
-            return _call_original_git(ctx, args)
+            code = _call_original_git(ctx.view_dirs, args)
+            if code == 0:
+                p4gf_pack_cache.invalidate(ctx.view_dirs)
+            return code
 
 
-if __name__ == "__main__":
+def run(check_versions=True):
+    """Serve one request, from the top, and exit.
+
+    p4gf_auth_daemon.py checks versions once, when it starts, not for
+    every request it serves.
+    """
     # Ensure any errors occurring in the setup are sent to stderr, while the
     # code below directs them to stderr once rather than twice.
     try:
         with p4gf_log.ExceptionLogger(squelch=False, write_to_stderr_=True):
             p4gf_audit_log.record_argv()
-            p4gf_version.log_version()
-            p4gf_version.git_version_check()
+            if check_versions:
+                p4gf_version.log_version()
+                p4gf_version.git_version_check()
     # pylint: disable=W0702
     except:
         # Cannot continue if above code failed.
         exit(1)
     # main() already writes errors to stderr, so don't let logger do it again
-    p4gf_log.run_with_exception_logger(main, write_to_stderr=False)
+    try:
+        p4gf_log.run_with_exception_logger(main, write_to_stderr=False)
+    finally:
+        p4gf_create_p4.report_round_trips()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,109 @@
+#! /usr/bin/env python3.2
+"""Run one Perforce command over a very long list of file arguments.
+
+Putting 100,000 paths into a single 'p4 add' argv is slow at best, and at
+worst trips the server's MaxResults/MaxScanRows limits. run_chunked() feeds
+the arguments to the server a chunk at a time, capped both by count and by
+total argument bytes, and yields each chunk's results as it arrives so that
+callers never hold more than one chunk's worth at once.
+
+If the server rejects a chunk as too large, the chunk is split in half and
+retried, and the smaller size sticks for the rest of the run.
+"""
+
+import logging
+
+import P4
+
+import p4gf_const
+import p4gf_p4msgid
+import p4gf_util
+
+LOG = logging.getLogger(__name__)
+
+# Messages that mean "ask for less at once".
+MSGID_TOO_BIG = [ p4gf_p4msgid.MsgDb_MaxResults
+                , p4gf_p4msgid.MsgDb_MaxScanRows
+                ]
+
+
+def _is_too_big(p4):
+    """Did the last command fail because it asked for too much at once?"""
+    for m in p4.messages:
+        if m.msgid in MSGID_TOO_BIG or m.generic == p4gf_p4msgid.EV_TOOBIG:
+            return True
+    return False
+
+
+def _max_count(max_count):
+    """Default chunk length."""
+    if max_count is None:
+        return p4gf_util.const_to_int(p4gf_const.P4GF_BULK_MAX_ARGS)
+    return max_count
+
+
+def _chunk_end(args, start, max_count, max_bytes):
+    """Return the index one past the end of the chunk starting at start."""
+    end = start
+    size = 0
+    while end < len(args) and end - start < max_count:
+        size += len(args[end]) + 1
+        if max_bytes < size and start < end:
+            break
+        end += 1
+    return end
+
+
+def chunks(args, max_count=None):
+    """Generate successive sublists of args, each no longer than max_count
+    elements and P4GF_BULK_MAX_ARG_BYTES total argument length (a single
+    argument longer than that still gets a chunk of its own).
+
+    Walks args by index: no copying of the unconsumed remainder.
+    """
+    max_count = _max_count(max_count)
+    max_bytes = p4gf_util.const_to_int(p4gf_const.P4GF_BULK_MAX_ARG_BYTES)
+    start = 0
+    while start < len(args):
+        end = _chunk_end(args, start, max_count, max_bytes)
+        yield args[start:end]
+        start = end
+
+
+def run_chunked(p4, cmd, args, max_count=None):
+    """Run p4 command cmd (a list) once for each chunk of args, yielding
+    each chunk's result list in turn.
+
+    p4.messages, p4.errors and p4.warnings describe the most recent chunk
+    when control returns to the caller.
+    """
+    max_count = _max_count(max_count)
+    max_bytes = p4gf_util.const_to_int(p4gf_const.P4GF_BULK_MAX_ARG_BYTES)
+    start = 0
+    while start < len(args):
+        end = _chunk_end(args, start, max_count, max_bytes)
+        try:
+            r = p4.run(cmd + args[start:end])
+        except P4.P4Exception:
+            if end - start < 2 or not _is_too_big(p4):
+                raise
+            # Retry this chunk, and carry on with the rest, at half size.
+            max_count = (end - start) // 2
+            LOG.debug("p4 {} too big at {} args, retrying {} at a time"
+                      .format(cmd[0], end - start, max_count))
+            continue
+        start = end
+        yield r
+
+
+def run(p4, cmd, args, max_count=None):
+    """Run p4 command cmd over all of args, yielding individual results."""
+    for r in run_chunked(p4, cmd, args, max_count):
+        for rr in r:
+            yield rr
+
+
+def run_all(p4, cmd, args, max_count=None):
+    """Run p4 command cmd over all of args, for its side effects only."""
+    for _ in run_chunked(p4, cmd, args, max_count):
+        pass
@@ -21,12 +21,91 @@ P4GF_GROUP_PUSH       = "git-fusion-push"
 P4GF_COUNTER_INIT_STARTED = "git-fusion-init-started"
 P4GF_COUNTER_INIT_COMPLETE = "git-fusion-init-complete"
 P4GF_COUNTER_PERMISSION_GROUP_DEFAULT = "git-fusion-permission-group-default"
+P4GF_COUNTER_HAVE_CHANGE = "git-fusion-{view}-have-change"
 
 P4GF_BRANCH_EMPTY_REPO = "p4gf_empty_repo"
 P4GF_BRANCH_TEMP       = "git_fusion_temp_branch"
 
+# Tunables. Override any of these by setting an environment variable of the
+# same name (see the end of this file). Use p4gf_util.const_to_bool() and
+# const_to_int() to read them, since overrides arrive as strings.
+                    # Stage pushed files into the Perforce workspace with
+                    # a hard link when source and target share a filesystem.
+P4GF_STAGE_HARDLINK = True
+                    # Set each pushed changelist's User and Date in one
+                    # batched pass at the end of the push rather than with
+                    # two extra round-trips after every submit.
+P4GF_G2P_DEFER_CHANGE_OWNER = False
+                    # How many commits a push may stage ahead of the one
+                    # being submitted. 0 disables the pipeline: each commit
+                    # is checked out into the Git work tree and copied from
+                    # there.
+P4GF_G2P_PIPELINE_DEPTH = 2
+                    # Most file arguments, and most bytes of file
+                    # arguments, to pass to a single p4 command. Longer
+                    # lists are split across several (see p4gf_bulk).
+P4GF_BULK_MAX_ARGS = 1000
+P4GF_BULK_MAX_ARG_BYTES = 512 * 1024
+                    # Keep an empty placeholder file in each view's Perforce
+                    # workspace for every file in the view. Nothing needs
+                    # them any more; turn off to save an inode per file.
+P4GF_PLACEHOLDER_WORKSPACE = True
+                    # Submit with 'p4 submit --parallel=threads=N' when a
+                    # pushed commit carries at least this many bytes of file
+                    # content. Off (0 threads) unless set: needs p4d 2014.1
+                    # or later with net.parallel.max set, and a P4API that
+                    # supports it.
+P4GF_SUBMIT_PARALLEL_THREADS = 0
+P4GF_SUBMIT_PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+                    # Keep each view's mirror Git repository bare: move refs
+                    # with 'git update-ref --stdin', never check anything
+                    # out. Needs Git 1.8.5 or later, else ignored. Turning
+                    # this off again needs 'git config core.bare false' in
+                    # every mirror repo.
+P4GF_GIT_BARE_REPO = True
+                    # Seconds this host trusts what an earlier request
+                    # learned from Perforce (initialized, permissions OK,
+                    # client root and view) before asking again. See
+                    # p4gf_fact_cache. 0 asks every time.
+P4GF_FACT_CACHE_SECS = 60
+                    # Seconds this host trusts its copy of 'p4 users'
+                    # (see p4gf_usermap). A user it does not find there
+                    # still gets a fresh look.
+P4GF_USERS_CACHE_SECS = 10 * 60
+                    # How often some process on this host checks whether
+                    # the protections table changed, and how long it
+                    # trusts one user's 'p4 protects -u' result at most
+                    # (group membership changes do not change the table).
+                    # See p4gf_protect.ProtectsCache. 0 checks every time.
+P4GF_PROTECTS_CHECK_SECS = 60
+P4GF_PROTECTS_CACHE_SECS = 10 * 60
+                    # Save git-upload-pack's response to a full clone in
+                    # the view's directory, and send it to the next full
+                    # clone of the same refs instead of packing again.
+                    # See p4gf_pack_cache. Costs a clone's worth of disk
+                    # per view.
+P4GF_UPLOAD_PACK_CACHE = False
+                    # P2G leaves packing the mirror Git repo to
+                    # p4gf_maintenance.py, and starts one in the background
+                    # for its view unless this is off (run it from cron
+                    # instead). Maintenance of one view runs at most once
+                    # every P4GF_MAINTENANCE_MIN_SECS, packs loose objects
+                    # once there are P4GF_MAINTENANCE_LOOSE_OBJECTS of them,
+                    # and repacks everything, with bitmaps, once there are
+                    # P4GF_MAINTENANCE_MAX_PACKS packs, no bitmap, or no
+                    # full repack for P4GF_MAINTENANCE_FULL_SECS.
+P4GF_MAINTENANCE_SPAWN = True
+P4GF_MAINTENANCE_MIN_SECS = 10 * 60
+P4GF_MAINTENANCE_LOOSE_OBJECTS = 6700
+P4GF_MAINTENANCE_MAX_PACKS = 50
+P4GF_MAINTENANCE_FULL_SECS = 7 * 24 * 60 * 60
+                    # Count every command each request sends to Perforce,
+                    # and report the totals on stderr when it is done.
+P4GF_TRACE_ROUND_TRIPS = False
+
 # Environment vars
 P4GF_AUTH_P4USER_ENVAR      = "P4GF_AUTH_P4USER"
+P4GF_CONTEXT_HANDOFF_ENVAR  = "P4GF_CONTEXT_HANDOFF"
 
 # Internal debugging keys
 P4GF_TEST             = "test"                  # section in rc file for test vars
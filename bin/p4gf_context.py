@@ -1,15 +1,18 @@
 #! /usr/bin/env python3.2
 """Config and Context classes"""
+import json
 import logging
 import os
 import tempfile
 import time
 
-from P4 import Map, P4Exception
+from P4 import Map
 
+import p4gf_create_p4
 from p4gf_create_p4 import create_p4
 from p4gf_gitmirror import GitMirror
 import p4gf_const
+import p4gf_fact_cache
 import p4gf_protect
 import p4gf_util
 
@@ -52,21 +55,70 @@ def view_to_client_name(view):
     return "git-fusion-{0}".format(view)
 
 
-def create_context(view_name, view_lock):
+def create_context(view_name, view_lock, p4=None, handoff=None):
     """Return a Context object that contains the connection details for use
-    in communicating with the Perforce server."""
+    in communicating with the Perforce server.
+
+    Pass p4, a connection as git-fusion-user, to have the Context take it
+    over as its p4gf connection rather than open another.
+
+    Pass handoff, from read_handoff(), to skip asking Perforce what the
+    Context that wrote it already knew. Ignored if it is for some other
+    view or server.
+    """
     cfg = Config()
-    p4 = create_p4()
-    cfg.p4port = p4.env('P4PORT')
+    if p4:
+        cfg.p4port = p4.port
+    else:
+        cfg.p4port = create_p4().env('P4PORT')
     cfg.p4user = p4gf_const.P4GF_USER
     cfg.p4client = view_to_client_name(view_name)
     cfg.p4client_gf = p4gf_util.get_object_client_name()
     cfg.view_name = view_name
-    ctx = Context(cfg)
+    if handoff and (   handoff.get('view_name') != view_name
+                    or handoff.get('p4port')    != cfg.p4port):
+        LOG.debug("ignoring handoff for view {} on {}"
+                  .format(handoff.get('view_name'), handoff.get('p4port')))
+        handoff = None
+    ctx = Context(cfg, p4gf=p4, handoff=handoff)
     ctx.view_lock = view_lock  # None OK: can run without a lock.
     return ctx
 
 
+def write_handoff(ctx):
+    """Write what ctx learned from Perforce to a new file, private to this
+    request, and return its path. The file goes when ctx.tempdir does.
+
+    p4gf_auth_server.py names this file in the environment of the git
+    process that runs our pre-receive hook, so that the hook's Context
+    need not learn it all over again.
+    """
+    handoff = { 'view_name' : ctx.config.view_name
+              , 'p4port'    : ctx.config.p4port
+              , 'timezone'  : ctx.timezone
+              , 'clients'   : ctx.client_specs
+              }
+    (fd, path) = tempfile.mkstemp(prefix='context-', suffix='.json',
+                                  dir=ctx.tempdir.name)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(handoff, f)
+    return path
+
+
+def read_handoff():
+    """Return what write_handoff() wrote for this request, or None."""
+    path = os.environ.get(p4gf_const.P4GF_CONTEXT_HANDOFF_ENVAR)
+    if not path:
+        return None
+    try:
+        with open(path, 'r') as f:
+            handoff = json.load(f)
+    except (IOError, OSError, ValueError):
+        LOG.debug("cannot read context handoff {}".format(path), exc_info=True)
+        return None
+    return handoff if isinstance(handoff, dict) else None
+
+
 class Config:
     """perforce config"""
 
@@ -81,13 +133,24 @@ class Config:
 class Context:
     """a single git-fusion view/repo context"""
 
-    def __init__(self, config):
+    def __init__(self, config, p4gf=None, handoff=None):
         self.config = config
         self.p4 = self.__make_p4(client=self.config.p4client)
-        self.p4gf = self.__make_p4(client=self.config.p4client_gf)
+        if p4gf:
+            p4gf.client = self.config.p4client_gf
+            p4gf.exception_level = 1
+            self.p4gf = p4gf
+        else:
+            self.p4gf = self.__make_p4(client=self.config.p4client_gf)
         self.mirror = GitMirror(config.view_name)
+        # client name ==> {'Root', 'View'}, as write_handoff() passes on.
+        self.client_specs = {}
         self.timezone = None
-        self.get_timezone()
+        if handoff:
+            self.client_specs = dict(handoff.get('clients') or {})
+            self.timezone = handoff.get('timezone')
+        if not self.timezone:
+            self.get_timezone()
         self._user_to_protect = None
         self.view_dirs = None
         self.view_lock = None
@@ -116,17 +179,12 @@ class Context:
         return self._user_to_protect.user_to_protect(user)
 
     def __make_p4(self, client=None):
-        """create a connection to the perforce server"""
-        p4 = create_p4(port=self.config.p4port,
-                       user=self.config.p4user)
-        if client:
-            p4.client = client
-        else:
-            p4.client = self.config.p4client
-        try:
-            p4.connect()
-        except P4Exception as e:
-            raise RuntimeError("Failed P4 connect: {}".format(str(e)))
+        """Return a connection to the perforce server, from the process's
+        pool, that connects when first used.
+        """
+        p4 = p4gf_create_p4.LazyP4(port=self.config.p4port,
+                                   user=self.config.p4user,
+                                   client=client or self.config.p4client)
         p4.exception_level = 1
         return p4
 
@@ -135,9 +193,21 @@ class Context:
         return self.contentclientroot
 
     def get_timezone(self):
-        """get server's timezone via p4 info"""
+        """get server's timezone via p4 info, or p4gf_fact_cache"""
+        self.timezone = p4gf_fact_cache.get(self.p4, "timezone")
+        if self.timezone:
+            return
         server_date = p4gf_util.first_value_for_key(self.p4.run("info"), 'serverDate')
         self.timezone = server_date.split(" ")[2]
+        p4gf_fact_cache.put(self.p4, "timezone", self.timezone)
+
+    def __client_root_view(self, p4):
+        """Root and View of p4's client."""
+        client = self.client_specs.get(p4.client)
+        if not client:
+            client = p4gf_util.fetch_client_root_view(p4, p4.client)
+            self.client_specs[p4.client] = client
+        return client
 
     def __set_up_paths(self):
         """set up depot and local paths for both content and P4GF
@@ -153,7 +223,7 @@ class Context:
         These paths are derived from the client root and client view.
         """
 
-        client = self.p4.fetch_client()
+        client = self.__client_root_view(self.p4)
         self.clientmap = Map(client["View"])
 
         # local syntax client root, force trailing /
@@ -170,7 +240,7 @@ class Context:
         These paths are derived from the client root and client view.
         """
 
-        client = self.p4gf.fetch_client()
+        client = self.__client_root_view(self.p4gf)
 
         # client root, minus any trailing /
         self.gitrootdir = client["Root"]
@@ -237,7 +307,7 @@ class Context:
         if not self.view_lock:
             return
 
-        if self.view_lock.canceled():
+        if self.view_lock.canceled_recently():
             raise RuntimeError("Canceling: lock {} lost."
                                .format(self.view_lock.counter_name()))
 
@@ -12,22 +12,60 @@ import shutil
 import os
 import sys
 
+import P4
 
 import p4gf_const
 import p4gf_copy_to_git
+import p4gf_lock
 import p4gf_log
+import p4gf_pack_cache
 import p4gf_path
 import p4gf_util
 import p4gf_view_dirs
 
 LOG = p4gf_log.for_module()
 
-def _p4_empty(ctx):
+# File in the mirror Git repo's GIT_DIR that records the newest changelist
+# in the view as of the last complete copy_p2g(). Lives and dies with the
+# repo it describes.
+LAST_CHANGE_FILE = "p4gf-last-change"
+
+def _p4_head_change(p4, client_name):
     """
-    Is our client view completely empty, no files, not even deleted or purged?
+    Return the newest submitted changelist number in client_name's view, as
+    a string, or None if the view is completely empty, no files, not even
+    deleted or purged.
     """
-    r = ctx.p4.run('files', '-m1', p4gf_path.slash_dot_dot_dot(ctx.config.p4client))
-    return not r
+    r = p4.run('changes', '-m1', '-s', 'submitted',
+               p4gf_path.slash_dot_dot_dot(client_name))
+    if not r:
+        return None
+    return r[0]['change']
+
+
+def _read_last_change(git_dir):
+    """Return the changelist number recorded by _write_last_change(),
+    or None if none.
+    """
+    try:
+        with open(os.path.join(git_dir, LAST_CHANGE_FILE), 'r') as f:
+            return f.read().strip() or None
+    except (OSError, IOError):
+        return None
+
+
+def _write_last_change(git_dir, change):
+    """Record that Git holds everything in the view up to change.
+
+    NOP if change is None: nothing to compare against next time.
+    """
+    if not change:
+        return
+    path = os.path.join(git_dir, LAST_CHANGE_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(change + '\n')
+    os.rename(tmp_path, path)
 
 
 def _git_empty():
@@ -38,6 +76,22 @@ def _git_empty():
     p = p4gf_util.popen_no_throw(['git', 'log', '-1', '--oneline'])
     return not p['out']
 
+def up_to_date(p4, client_name, git_dir):
+    """
+    Does git_dir already hold everything in client_name's view?
+
+    Needs no view lock and no Context: one 'p4 changes -m1' and a file read.
+    False if in any doubt.
+    """
+    last_change = _read_last_change(git_dir)
+    if not last_change:
+        return False
+    try:
+        return _p4_head_change(p4, client_name) == last_change
+    except P4.P4Exception:
+        return False
+
+
 def copy_p2g(ctx, start):
     """Fill git with content from Perforce."""
 
@@ -48,16 +102,32 @@ def copy_p2g(ctx, start):
         LOG.warn("mirror Git repository {} missing, recreating...".format(git_dir))
         # it's not the end of the world if the git repo disappears, just recreate it
         create_git_repo(git_dir)
+    bare = p4gf_util.git_bare_repo()
+    if bare:
+        p4gf_util.git_make_bare(git_dir)
+
+    # Fast path for the common fetch that finds nothing new: if the view's
+    # newest changelist is the same one we saw after the last complete
+    # copy, there is nothing to copy and Git is already where it should be.
+    head_change = _p4_head_change(ctx.p4, ctx.config.p4client)
+    if (    head_change
+        and not start
+        and head_change == _read_last_change(git_dir)):
+        LOG.debug("No new changes in view {} since @{}"
+                  .format(view_name, head_change))
+        return
 
     # If Perforce client view is empty and git repo is empty, someone is
     # probably trying to push into an empty repo/perforce tree. Let them.
-    if _p4_empty(ctx) and _git_empty():
+    if not head_change and _git_empty():
         LOG.info("Nothing to copy from empty view {}".format(view_name))
         return
 
     # We're not empty anymore, we no longer need this to avoid
     # git push rejection of push to empty repo refs/heads/master.
-    delete_empty_repo_branch(view_dirs.GIT_DIR)
+    # (Bare repos never had one.)
+    if not bare:
+        delete_empty_repo_branch(view_dirs.GIT_DIR)
 
     start_at = p4gf_util.git_ref_master()
     if start and start_at:
@@ -71,6 +141,13 @@ def copy_p2g(ctx, start):
 
     p4gf_copy_to_git.copy_p4_changes_to_git(ctx, start_at, "#head")
 
+    # Bare: FastImport.merge() already moved master to the end of the temp
+    # branch and deleted the temp branch, in one transaction. HEAD is
+    # branch master, and no work tree needs to follow.
+    if bare:
+        _write_last_change(git_dir, head_change)
+        return
+
     # Want to exit this function with HEAD and master both pointing to
     # the end of history. If we just copied anything from Perforce to
     # Git, point to the end of Perforce history.
@@ -83,20 +160,23 @@ def copy_p2g(ctx, start):
     # commits ahead of master. Move HEAD and master to the temp branch's
     # commit. Move HEAD, detached (~0), first, just in case someone left it on master.
     temp_branch = p4gf_const.P4GF_BRANCH_TEMP + '~0'
-    p1 = p4gf_util.popen_no_throw(['git', 'checkout', temp_branch])
-    detached_head = (p1['Popen'].returncode == 0)
-    if detached_head:
-        p4gf_util.popen_no_throw(['git', 'branch', '-f', 'master', temp_branch])
+    with p4gf_lock.RefsLock(view_dirs, exclusive=True):
+        p1 = p4gf_util.popen_no_throw(['git', 'checkout', temp_branch])
+        detached_head = (p1['Popen'].returncode == 0)
+        if detached_head:
+            p4gf_util.popen_no_throw(['git', 'branch', '-f', 'master', temp_branch])
 
-    # Rare: If there are zero p4 changes in this view (yet), our temp
-    # branch either does not exist or points nowhere and we were unable
-    # to detach head from that temp branch. In that case switch to
-    # (empty) branch master, creating it. We really want a master
-    # branch, even if empty, so that we can delete the temp branch.
-    if not detached_head:
-        p4gf_util.popen_no_throw(['git', 'checkout', '-b', 'master'])
+        # Rare: If there are zero p4 changes in this view (yet), our temp
+        # branch either does not exist or points nowhere and we were unable
+        # to detach head from that temp branch. In that case switch to
+        # (empty) branch master, creating it. We really want a master
+        # branch, even if empty, so that we can delete the temp branch.
+        if not detached_head:
+            p4gf_util.popen_no_throw(['git', 'checkout', '-b', 'master'])
 
-    p4gf_util.popen_no_throw(['git', 'branch', '-d', p4gf_const.P4GF_BRANCH_TEMP])
+        p4gf_util.popen_no_throw(['git', 'branch', '-d', p4gf_const.P4GF_BRANCH_TEMP])
+        p4gf_pack_cache.invalidate(view_dirs)
+    _write_last_change(git_dir, head_change)
 
 
 def create_empty_repo_branch(git_dir):
@@ -148,14 +228,23 @@ def create_git_repo(git_dir):
 
     # Initialize the Git repository for that directory.
     LOG.debug("creating Git repository in %s", git_dir)
+    bare = p4gf_util.git_bare_repo()
     cmd = ['git', '--git-dir=' + git_dir, 'init']
+    if bare:
+        cmd.append('--bare')
     result = p4gf_util.popen_no_throw(cmd)
     if result['Popen'].returncode:
         code = result['Popen'].returncode
         LOG.error("error creating Git repo, git init returned %d", code)
         sys.stderr.write("error: git init failed with {} for {}\n".format(code, git_dir))
 
-    create_empty_repo_branch(git_dir)
+    if bare:
+        # A bare repo accepts pushes to its current branch: no need for
+        # an empty_repo branch. Do not leave HEAD to init.defaultBranch.
+        p4gf_util.popen(['git', '--git-dir=' + git_dir,
+                         'symbolic-ref', 'HEAD', 'refs/heads/master'])
+    else:
+        create_empty_repo_branch(git_dir)
 
 
 def copy_p2g_ctx(ctx, start=None):
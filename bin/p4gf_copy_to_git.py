@@ -17,6 +17,10 @@ from p4gf_p4changelist import P4Changelist
 from p4gf_gitmirror import GitMirror
 from p4gf_progress_reporter import ProgressReporter
 
+import p4gf_const
+import p4gf_lock
+import p4gf_maintenance
+import p4gf_pack_cache
 import p4gf_profiler
 import p4gf_util
 import logging
@@ -261,10 +265,19 @@ class SyncHandler(OutputHandler):
     edit.  Again, we don't need to actually have the content stored in
     the p4 client tree, as we'll supply that from the git repo as we're
     building up a change to submit.
+
+    Push now tells adds from edits by comparing Git trees, so reason 1 no
+    longer applies. If placeholders is False, maintain only the have list.
     """
 
+    def __init__(self, placeholders=True):
+        OutputHandler.__init__(self)
+        self.placeholders = placeholders
+
     def outputStat(self, h):
         """grab clientFile from fstat output"""
+        if not self.placeholders:
+            return OutputHandler.HANDLED
         p4file = P4File.create_from_sync(h)
         if p4file.is_delete():
             if os.path.exists(p4file.client_path):
@@ -546,11 +559,14 @@ class P2G:
 
     def _sync(self, sorted_changes):
         """fake sync of last change to make life easier at push time"""
-        self.ctx.p4.handler = SyncHandler()
+        self.ctx.p4.handler = SyncHandler(p4gf_util.const_to_bool(
+                                    p4gf_const.P4GF_PLACEHOLDER_WORKSPACE))
         lastchange = self.changes[sorted_changes[-1]]
         self.ctx.p4.run("sync", "-kf",
                 self.ctx.client_view_path() + "@" + str(lastchange.change))
         self.ctx.p4.handler = None
+        p4gf_util.set_have_change(self.ctx.p4, self.ctx.config.view_name,
+                                  lastchange.change)
 
     def _fast_import(self, sorted_changes, last_commit):
         """build fast-import script from changes, then run fast-import"""
@@ -587,12 +603,13 @@ class P2G:
     # pylint: disable=R0201
     # R0201 Method could be a function
     def _pack(self):
-        """run 'git gc' to pack up the blobs
+        """leave packing up the blobs to p4gf_maintenance, in the background
 
-        aside from any possible performance benefit, this prevents warnings
-        from git about "unreachable loose objects"
+        packing prevents warnings from git about "unreachable loose
+        objects", and bitmaps and a commit-graph speed up every fetch
+        after it, but none of it needs to hold up this one
         """
-        p4gf_util.popen_no_throw(["git", "gc"])
+        p4gf_maintenance.request(self.ctx.view_dirs)
 
     def _collapse_to_graft_change(self):
         """Move all of the files from pre-graft changelists into the graft
@@ -694,7 +711,9 @@ class P2G:
 
             with self.perf.timer[MERGE]:
                 # merge temporary branch into master, then delete it
-                self.fastimport.merge()
+                with p4gf_lock.RefsLock(self.ctx.view_dirs, exclusive=True):
+                    self.fastimport.merge()
+                    p4gf_pack_cache.invalidate(self.ctx.view_dirs)
 
             with self.perf.timer[PACK]:
                 self._pack()
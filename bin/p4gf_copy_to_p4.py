@@ -2,18 +2,19 @@
 """copy_git_changes_to_p4"""
 
 import os
-import shutil
-import stat
 import logging
 import time
 import traceback
 
 import P4
 
-from   p4gf_create_p4 import connect_p4
+import p4gf_bulk
 from   p4gf_g2p_conflict_checker import G2PConflictChecker
 import p4gf_const
+import p4gf_fastcopy
 import p4gf_fastexport
+import p4gf_g2p_journal
+import p4gf_g2p_stage
 import p4gf_p4filetype
 import p4gf_p4msg
 import p4gf_p4msgid
@@ -23,6 +24,7 @@ import p4gf_path
 import p4gf_profiler
 from   p4gf_progress_reporter import ProgressReporter
 import p4gf_util
+import p4gf_version
 
 LOG = logging.getLogger(__name__)
 
@@ -77,7 +79,8 @@ def change_description(commit, pusher, author):
     parts.append(" sha1: {}".format(commit['sha1']))
     return "\n".join(parts)
 
-def p4_submit(p4, desc, author, author_date):
+def p4_submit(p4, desc, author, author_date, change_owners=None,
+              parallel_threads=0):
     """This is the function called once for each git commit as it is
     submitted to Perforce. If you need to customize the submit or change
     the description, here is where you can do so safely without
@@ -93,12 +96,26 @@ def p4_submit(p4, desc, author, author_date):
     author_date can be either integer "seconds since the epoch" or a
     Perforce-formatted timestamp string YYYY/MM/DD hh:mm:ss. Probably needs to
     be in the server's timezone.
+
+    If change_owners is a list, do not edit the changelist now: append a
+    (changelist number, author, author_date) tuple to change_owners and
+    leave it to p4_set_change_owners() to apply later.
+
+    If parallel_threads is non-zero, transfer file content over that many
+    connections at once.
     """
     # Avoid fetch_change() and run_submit() since that exposes us to the
     # issue of filenames with double-quotes in them (see job015259).
-    r = p4.run('submit', '-d', desc)
+    cmd = ['submit']
+    if parallel_threads:
+        cmd.append('--parallel=threads={}'.format(parallel_threads))
+    r = p4.run(cmd + ['-d', desc])
     changenum = changelist_from_submit_result(r)
     LOG.debug("Submitted change: {}".format(r))
+    if change_owners is not None:
+        change_owners.append((changenum, author, author_date))
+        LOG.debug("Deferring change owner: {}".format(author))
+        return changenum
     change = p4.fetch_change(changenum)
     change['User'] = author
     change['Date'] = author_date   # both number or string work here
@@ -107,6 +124,33 @@ def p4_submit(p4, desc, author, author_date):
     return changenum
 
 
+def p4_set_change_owners(p4, change_owners):
+    """Deferred half of p4_submit(): set 'User' and 'Date' on every
+    submitted changelist recorded in change_owners, a list of
+    (changelist number, author, author_date) tuples.
+
+    Fetches the changelists with 'p4 describe -s' in bulk instead of
+    one 'p4 change -o' per changelist, then rewrites each. If you
+    customized p4_submit(), customize this too.
+    """
+    described = {}
+    for d in p4gf_bulk.run(p4, ['describe', '-s'],
+                           [str(co[0]) for co in change_owners]):
+        if isinstance(d, dict):
+            described[d['change']] = d
+    for (changenum, author, author_date) in change_owners:
+        d = described[str(changenum)]
+        p4.input = { 'Change'      : d['change']
+                   , 'Client'      : d['client']
+                   , 'Status'      : d['status']
+                   , 'Description' : d['desc']
+                   , 'User'        : author
+                   , 'Date'        : author_date
+                   }
+        p4.run('change', '-f', '-i')
+    LOG.debug("Changed owner of {} changelists".format(len(change_owners)))
+
+
 def contains_desc(desc, changelist_array):
     """Does ANY changelist in the given array have a description that
     contains the requested desc?
@@ -189,17 +233,26 @@ TEST_BLOCK_PUSH = "Test Block Push"
 CHECK_CONFLICT = "Check Conflict"
 GIT_CHECKOUT = "Git Checkout"
 COPY = "Copy"
+STAGE_WAIT = "Wait for Staging"
 COPY_BLOBS_1 = "Copy Blobs Pass 1"
 COPY_BLOBS_2 = "Copy Blobs Pass 2"
-CHECK_PROTECTS = "Check Protects"
+PARALLEL_SUBMIT = "Parallel Submit"
+VALIDATE = "Validate Commits"
+CHANGE_OWNER = "Change Owner"
 MIRROR = "Mirror Git Objects"
 
 N_BLOBS = "Number of Blobs"
 N_RENAMES = "Number of Renames"
+N_STAGED = {method: "Files staged by {}".format(method)
+            for method in p4gf_fastcopy.METHODS}
 
 
 class ProtectsChecker:
-    """class to handle filtering a list of paths against view and protections"""
+    """class to handle filtering a list of paths against view and protections
+
+    Building one costs several P4.Map.join() calls. Reuse it for every
+    commit with the same author and pusher.
+    """
     def __init__(self, ctx, author, pusher):
         """init P4.Map objects for author, pusher, view and combination"""
         self.ctx = ctx
@@ -209,14 +262,22 @@ class ProtectsChecker:
         self.view_map = None
         self.read_protect_author = None
         self.read_protect_pusher = None
-        self.read_filter = None
+        self.read_protect = None        # author AND pusher, before view
+        self.read_filter = None         # author AND pusher AND view
         self.write_protect_author = None
         self.write_protect_pusher = None
+        self.write_protect = None
         self.write_filter = None
 
+        # True if protections grant author and pusher read and write on
+        # every path in the view, in which case only the view itself can
+        # reject a path.
+        self.entire_view_granted = False
+
         self.init_view()
         self.init_read_filter()
         self.init_write_filter()
+        self.init_entire_view_granted()
 
         self.author_denied = []
         self.pusher_denied = []
@@ -237,6 +298,7 @@ class ProtectsChecker:
                                            self.read_protect_pusher)
         else:
             self.read_filter = self.read_protect_author
+        self.read_protect = self.read_filter
         self.read_filter = P4.Map.join(self.read_filter, self.view_map)
 
     def init_write_filter(self):
@@ -250,8 +312,22 @@ class ProtectsChecker:
                                             self.write_protect_pusher)
         else:
             self.write_filter = self.write_protect_author
+        self.write_protect = self.write_filter
         self.write_filter = P4.Map.join(self.write_filter, self.view_map)
 
+    def init_entire_view_granted(self):
+        """Can we tell, from the maps alone, that protections grant every
+        path in the view?
+        """
+        view_list = self.view_map.as_array()
+        for mapapi in [self.write_protect, self.read_protect]:
+            if (p4gf_protect.map_includes_entire_view(mapapi, view_list)
+                    != p4gf_protect.COMPLETELY_INCLUDED):
+                return
+        LOG.debug("protects grant entire view to author={} pusher={}"
+                  .format(self.author, self.pusher))
+        self.entire_view_granted = True
+
     def filter_paths(self, blobs):
         """run list of paths through filter and set list of paths that don't pass"""
         # check against one map for read, one for write
@@ -261,6 +337,10 @@ class ProtectsChecker:
         self.pusher_denied = []
         self.unmapped = []
 
+        if self.entire_view_granted:
+            self._filter_paths_view_only(blobs)
+            return
+
         for blob in blobs:
             if blob['action'] == 'R' or blob['action'] == 'C':
                 # for Rename or Copy, need to check read access for source path
@@ -286,6 +366,17 @@ class ProtectsChecker:
                 else:
                     self.pusher_denied.append(topath)
 
+    def _filter_paths_view_only(self, blobs):
+        """filter_paths() when protections cannot reject anything."""
+        for blob in blobs:
+            paths = [blob['path']]
+            if blob['action'] == 'R' or blob['action'] == 'C':
+                paths.append(blob['topath'])
+            for path in paths:
+                clientpath = self.local_rel_path_to_client(path)
+                if not self.view_map.includes(clientpath, False):
+                    self.unmapped.append(clientpath)
+
     def local_rel_path_to_client(self, local_rel_path):
         """return client syntax path for local path"""
         return "//{0}/{1}".format(self.ctx.config.p4client, local_rel_path)
@@ -317,17 +408,68 @@ class G2P:
                              (FAST_EXPORT, OVERALL),
                              (TEST_BLOCK_PUSH, OVERALL),
                              (CHECK_CONFLICT, OVERALL),
+                             (VALIDATE, OVERALL),
+                             (STAGE_WAIT, OVERALL),
                              (COPY, OVERALL),
                              (GIT_CHECKOUT, COPY),
-                             (CHECK_PROTECTS, COPY),
                              (COPY_BLOBS_1, COPY),
                              (COPY_BLOBS_2, COPY),
+                             (PARALLEL_SUBMIT, COPY_BLOBS_2),
+                             (CHANGE_OWNER, OVERALL),
                              (MIRROR, OVERALL),
                              ])
         self.perf.add_counters([N_BLOBS, N_RENAMES])
+        self.perf.add_counters([N_STAGED[m] for m in p4gf_fastcopy.METHODS])
         self.usermap = p4gf_usermap.UserMap(ctx.p4gf)
         self.progress = ProgressReporter()
 
+        # (author, pusher) ==> ProtectsChecker, for the rest of this push.
+        self.protects_checkers = {}
+
+        # git commit sha1 ==> author's Perforce user, for every commit that
+        # passed validate_commit().
+        self.commit_author = {}
+
+        # git commit sha1 ==> changelist number, for commits that an earlier
+        # push of the same commits already submitted. Set by copy().
+        self.journaled = {}
+
+        # p4gf_g2p_stage.GitModes as of the commit most recently copied.
+        # Set by copy().
+        self.git_modes = None
+
+        # Where copy_blobs() reads file content from: the StagedCommit
+        # being copied.
+        self.staged = None
+
+        # Paths this commit has moved or copied a file to.
+        self.move_targets = set()
+
+        # Add/edit is decided from Git trees, not from what happens to be in
+        # the Perforce workspace. Without placeholders, the workspace holds
+        # only the files of the commit being copied, removed after submit.
+        self.placeholders = p4gf_util.const_to_bool(
+                                    p4gf_const.P4GF_PLACEHOLDER_WORKSPACE)
+        self.workspace_files = []
+
+        # Bytes of file content written into the workspace for the commit
+        # being copied, to decide whether to submit in parallel.
+        self.staged_bytes = 0
+
+        # Bare mirror repo: copy_commit() stages from 'git archive', never
+        # from a checkout.
+        self.bare = p4gf_util.git_bare_repo()
+
+        # Can we 'submit --parallel'? None until we ask p4d.
+        self.submit_parallel_ok = None
+
+        # (changelist, author, date) tuples awaiting p4_set_change_owners(),
+        # or None to set owners as we submit.
+        if p4gf_util.const_to_bool(p4gf_const.P4GF_G2P_DEFER_CHANGE_OWNER):
+            self.change_owners = []
+        else:
+            self.change_owners = None
+
     def __str__(self):
         return "\n".join([str(self.perf),
                           str(self.ctx.mirror)
@@ -338,11 +480,11 @@ class G2P:
         to Perforce. As a result, revert all modifications, log the error,
         and raise an exception."""
         # roll back and raise the problem to the caller
-        p4 = connect_p4(user=p4gf_const.P4GF_USER, client=self.ctx.p4.client)
-        if p4:
-            opened = p4.run('opened')
-            if opened:
-                p4.run('revert', '//{}/...'.format(self.ctx.p4.client))
+        # (ctx.p4 reconnects first if the error dropped its connection)
+        p4 = self.ctx.p4
+        opened = p4.run('opened')
+        if opened:
+            p4.run('revert', '//{}/...'.format(p4.client))
         # revert doesn't clean up added files
         self.remove_added_files()
         if not errmsg:
@@ -397,6 +539,11 @@ class G2P:
 
         self.check_p4_messages()
 
+    def _p4run_bulk(self, cmd, paths):
+        """_p4run() cmd over paths, a bounded chunk of paths at a time."""
+        for chunk in p4gf_bulk.chunks(paths):
+            self._p4run(cmd + chunk)
+
     def run_p4_commands(self):
         """run all pending p4 commands"""
         for operation, paths in self.addeditdelete.items():
@@ -410,7 +557,7 @@ class G2P:
                 # move takes a tuple of two arguments, the old name and new name
                 oldnames = [escape_path(pair[0]) for pair in paths]
                 # move requires opening the file for edit first
-                self._p4run(['edit', '-k'] + oldnames)
+                self._p4run_bulk(['edit', '-k'], oldnames)
                 LOG.debug("Edit {}".format(oldnames))
                 for pair in paths:
                     (frompath, topath) = pair
@@ -425,17 +572,18 @@ class G2P:
                     cmd = cmd[0:1] + cmd[3:]
 
                 if not cmd[0] == 'add':
-                    self._p4run(cmd + [escape_path(path) for path in paths])
+                    self._p4run_bulk(cmd, [escape_path(path) for path in paths])
                 else:
-                    self._p4run(cmd + paths)
+                    self._p4run_bulk(cmd, paths)
 
                 if reopen:
-                    self._p4run(reopen + [escape_path(path) for path in paths])
+                    self._p4run_bulk(reopen, [escape_path(path) for path in paths])
 
                 if cmd[0] == 'delete':
                     LOG.debug("Delete {}".format(paths))
                     for path in paths:
-                        os.remove(path)
+                        if os.path.lexists(path):
+                            os.remove(path)
 
     def remove_added_files(self):
         """remove added files to restore p4 client after failure of p4 command"""
@@ -486,6 +634,33 @@ class G2P:
                     p4type = p4gf_p4filetype.remove_mod(p4type, 'x')
         return p4type
 
+    def _stage_file(self, src, dst, mode=None):
+        """Copy src to dst with the cheapest available primitive."""
+        method = p4gf_fastcopy.stage_file(src, dst, mode)
+        self.perf.counter[N_STAGED[method]] += 1
+        self.workspace_files.append(dst)
+        self.staged_bytes += os.lstat(dst).st_size
+
+    def _git_path_exists(self, path):
+        """Does path exist in Perforce as of the commit we are copying?
+
+        The parent commit's tree matches Perforce (the mirror says so), so
+        a path exists if the parent commit has it, or if this commit has
+        already moved or copied a file there.
+        """
+        return (   self.git_modes.get(path) is not None
+                or path in self.move_targets)
+
+    def _clean_workspace(self):
+        """Without a placeholder workspace, remove the files we put in the
+        Perforce workspace for the commit just submitted.
+        """
+        if not self.placeholders:
+            for path in self.workspace_files:
+                if os.path.lexists(path):
+                    os.unlink(path)
+        self.workspace_files = []
+
     def add_or_edit_blob(self, blob):
         """run p4 add or edit for a new or modified file"""
 
@@ -493,7 +668,7 @@ class G2P:
         p4path = self.ctx.contentlocalroot + blob['path']
 
         # edit or add?
-        isedit = os.path.exists(p4path)
+        isedit = self._git_path_exists(blob['path'])
 
         # make sure dest dir exists
         dstdir = os.path.dirname(p4path)
@@ -503,8 +678,9 @@ class G2P:
         if isedit:
             LOG.debug("Copy edit from: " + blob['path'] + " to " + p4path)
             # for edits, only use +x or -x to propagate partial filetype changes
-            wasx = os.stat(p4path).st_mode & stat.S_IXUSR
-            isx = os.stat(blob['path']).st_mode & stat.S_IXUSR
+            old_mode = self.git_modes.get(blob['path'])
+            wasx = bool(old_mode and int(old_mode, 8) & 0o100)
+            isx = bool(int(blob['mode'], 8) & 0o100)
             if wasx != isx:
                 p4type = self._toggle_filetype(p4path, isx)
             else:
@@ -514,13 +690,11 @@ class G2P:
                           .format(ft=p4type,
                                   oldx=wasx,
                                   newx=isx))
-            shutil.copystat(blob['path'], p4path)
-            shutil.copyfile(blob['path'], p4path)
         else:
             LOG.debug("Copy add from: " + blob['path'] + " to " + p4path)
             # for adds, use complete filetype of new file
             p4type = p4type_from_mode(blob['mode'])
-            shutil.copyfile(blob['path'], p4path)
+        self._stage_file(self.staged.source(blob['path']), p4path, blob['mode'])
 
         # if file exists it's an edit, so do p4 edit before copying content
         # for an add, do p4 add after copying content
@@ -543,7 +717,8 @@ class G2P:
         if not os.path.exists(dstdir):
             os.makedirs(dstdir)
         # copy out of Git repo to Perforce workspace
-        shutil.copyfile(blob['topath'], p4topath)
+        self._stage_file(self.staged.source(blob['topath']), p4topath,
+                         self.git_modes.get(blob['path']))
         self.setup_p4_command("move", (p4frompath, p4topath))
 
     def copy_blob(self, blob):
@@ -562,7 +737,10 @@ class G2P:
             os.makedirs(dstdir)
 
         LOG.debug("Copy/integ from: " + p4frompath + " to " + p4topath)
-        shutil.copyfile(p4frompath, p4topath)
+        # 'copy -v' needs nothing local. Only a placeholder workspace
+        # has something to copy.
+        if os.path.exists(p4frompath):
+            self._stage_file(p4frompath, p4topath, self.git_modes.get(blob['path']))
 
     def delete_blob(self, blob):
         """run p4 delete for a deleted file"""
@@ -571,15 +749,17 @@ class G2P:
         p4path = self.ctx.contentlocalroot + blob['path']
         self.setup_p4_command("delete", p4path)
 
-    def copy_blobs(self, blobs):
+    def copy_blobs(self, staged):
         """copy git blobs to perforce revs"""
+        self.staged = staged
+        self.move_targets = set([blob['topath'] for blob in staged.moves])
         # first, one pass to do rename/copy
         # these don't batch.  move can't batch due to p4 limitations.
         # however, the edit required before move is batched.
         # copy could be batched by creating a temporary branchspec
         # but for now it's done file by file
         with self.perf.timer[COPY_BLOBS_1]:
-            for blob in blobs:
+            for blob in staged.moves:
                 if blob['action'] == 'R':
                     self.rename_blob(blob)
                 elif blob['action'] == 'C':
@@ -593,16 +773,27 @@ class G2P:
         # 1 + 3 + 3 commands run.
         with self.perf.timer[COPY_BLOBS_2]:
             self.addeditdelete = {}
-            for blob in blobs:
+            for blob in staged.edits:
                 if blob['action'] == 'M':
                     self.add_or_edit_blob(blob)
                 elif blob['action'] == 'D':
                     self.delete_blob(blob)
             self.run_p4_commands()
 
+    def protects_checker(self, author, pusher):
+        """Return the ProtectsChecker for author and pusher, creating it
+        the first time they are seen in this push.
+        """
+        key = (author, pusher)
+        pc = self.protects_checkers.get(key)
+        if not pc:
+            pc = ProtectsChecker(self.ctx, author, pusher)
+            self.protects_checkers[key] = pc
+        return pc
+
     def check_protects(self, p4user, blobs):
         """check if author is authorized to submit files"""
-        pc = ProtectsChecker(self.ctx, self.ctx.authenticated_p4user, p4user)
+        pc = self.protects_checker(self.ctx.authenticated_p4user, p4user)
         pc.filter_paths(blobs)
         if pc.has_error():
             self.revert_and_raise(pc.error_message())
@@ -613,45 +804,130 @@ class G2P:
         into next commit.
         """
         self.addeditdelete = {}
+        self.staged_bytes = 0
+
+    def _submit_parallel_threads(self):
+        """How many threads should submit use for the current commit? 0 for
+        a plain, single-connection submit.
+        """
+        threads = p4gf_util.const_to_int(p4gf_const.P4GF_SUBMIT_PARALLEL_THREADS)
+        if threads < 2:
+            return 0
+        if self.staged_bytes < p4gf_util.const_to_int(
+                                p4gf_const.P4GF_SUBMIT_PARALLEL_MIN_BYTES):
+            return 0
+        if self.submit_parallel_ok is None:
+            self.submit_parallel_ok = \
+                p4gf_version.p4d_version_supports_submit_parallel(self.ctx.p4)
+        return threads if self.submit_parallel_ok else 0
+
+    def _submit(self, desc, author_p4user, author_date):
+        """p4_submit(), in parallel if worth it and possible."""
+        threads = self._submit_parallel_threads()
+        if threads:
+            LOG.debug("submitting {} bytes with {} threads"
+                      .format(self.staged_bytes, threads))
+            with self.perf.timer[PARALLEL_SUBMIT]:
+                try:
+                    return p4_submit(self.ctx.p4, desc, author_p4user,
+                                     author_date, self.change_owners, threads)
+                except P4.P4Exception as e:
+                    # p4d without net.parallel.max refuses outright, before
+                    # submitting anything. Any other failure may come after
+                    # p4d has renumbered the changelist: no retrying that.
+                    if not p4gf_p4msg.find_msgid(self.ctx.p4,
+                                    p4gf_p4msgid.MsgDm_ParallelNotEnabled):
+                        raise
+                    LOG.warn("parallel submit refused, not trying again: {}"
+                             .format(e))
+                    self.submit_parallel_ok = False
+        return p4_submit(self.ctx.p4, desc, author_p4user, author_date,
+                         self.change_owners)
 
     def attempt_resync(self):
         """Attempts to sync -k the Git Fusion client to the change that
         corresponds to the HEAD of the Git mirror repository. This prevents
         the obscure "file(s) not on client" error.
+
+        When resuming a push, an earlier try already submitted the
+        journaled commits, which master does not yet include: sync -k to
+        the newest of those instead, or the commits still to copy would
+        open revisions older than the ones the journaled commits
+        submitted. Call _load_journal() first.
+
+        The have-change counter records the changelist the client's have
+        list already matches. If that is the one we want, there is nothing
+        to do. If it is older, sync -k only the files changed since.
         """
         # we assume we are in the GIT_WORK_TREE, which seems to be a safe
         # assumption at this point
         try:
+            target = 0
             last_commit = p4gf_util.git_ref_master()
             if last_commit:
                 last_changelist_number = self.ctx.mirror.get_change_for_commit(
                     last_commit, self.ctx)
                 if last_changelist_number:
-                    filerev = "//...@{}".format(last_changelist_number)
-                    self._p4run(['sync', '-k', filerev])
+                    target = int(last_changelist_number)
+            if self.journaled:
+                target = max([target] + [int(change) for change
+                                         in self.journaled.values()])
+            if target:
+                view_name = self.ctx.config.view_name
+                have = p4gf_util.have_change(self.ctx.p4, view_name)
+                if have == target:
+                    LOG.debug("resync: have list already @{}".format(have))
+                    return
+                if 0 < have < target:
+                    filerev = "//...@{},@{}".format(have + 1, target)
+                else:
+                    filerev = "//...@{}".format(target)
+                self._p4run(['sync', '-k', filerev])
+                p4gf_util.set_have_change(self.ctx.p4, view_name, target)
         except P4.P4Exception:
             # don't stop the world if we have an error above
             LOG.warn("resync failed with exception", exc_info=True)
 
-    def copy_commit(self, commit):
-        """copy a single commit"""
+    def record_have_change(self, marks, clean):
+        """After a clean push, the client's have list matches the last
+        changelist we submitted. After a conflict or an error it matches
+        nothing in particular.
+        """
+        if clean and not marks:
+            return
+        change = None
+        if clean:
+            change = mark_to_commit_changelist(marks[-1])[1]
+        try:
+            p4gf_util.set_have_change(self.ctx.p4, self.ctx.config.view_name,
+                                      change)
+        except P4.P4Exception:
+            LOG.warn("failed to record have change", exc_info=True)
 
-        self._reset_for_new_commit()
+    @staticmethod
+    def _author_email(commit):
+        """Return commit's author email address, without enclosing
+        angle brackets.
+        """
+        return commit['author']['email'].strip('<>')
 
-        #OG.debug("dump commit {}".format(commit))
-        LOG.debug("for  commit {}".format(commit['mark']))
-        LOG.debug("with description: {}".format(commit['data']))
-        LOG.debug("files affected: {}".format(commit['files']))
+    def validate_commit(self, commit, email_to_user=None):
+        """Reject, with revert_and_raise(), a commit we cannot or may not
+        copy to Perforce. Return the author's Perforce user.
 
+        email_to_user is the result of UserMap.lookup_by_emails() for
+        this commit's author, or None to look the author up here.
+        """
         # Reject merge commits. Not supported in 2012.1.
         if 'merge' in commit:
             self.revert_and_raise(("Merge commit {} not permitted."
                                    +" Rebase to create a linear"
                                    +" history.").format(commit['sha1']))
 
-        # strip any enclosing angle brackets from the email address
-        email = commit['author']['email'].strip('<>')
-        user = self.usermap.lookup_by_email(email)
+        email = self._author_email(commit)
+        if email_to_user is None:
+            email_to_user = self.usermap.lookup_by_emails([email])
+        user = email_to_user[email]
         LOG.debug("for email {} found user {}".format(email, user))
         if (user is None) or (not self.usermap.p4user_exists(user[0])):
             # User is not a known and existing Perforce user, and the
@@ -664,19 +940,64 @@ class G2P:
             if err:
                 self.revert_and_raise(err)
 
-        with self.perf.timer[GIT_CHECKOUT]:
-            d = p4gf_util.popen_no_throw(['git', 'checkout', commit['sha1']])
-            if d['Popen'].returncode:
-                # Sometimes git cannot distinquish the revision from a path...
-                p4gf_util.popen(['git', 'reset', '--hard', commit['sha1'], '--'])
+        self.check_protects(author_p4user, commit['files'])
+
+        self.commit_author[commit['sha1']] = author_p4user
+        return author_p4user
+
+    def validate_commits(self, commands):
+        """Run validate_commit() over every commit in the push before we
+        submit any of them, so that a push that is going to fail fails
+        now, not after submitting everything ahead of the bad commit.
+        """
+        commits = [c for c in commands if c['command'] == 'commit'
+                   and not c['sha1'] in self.journaled]
+        email_to_user = self.usermap.lookup_by_emails(
+                            [self._author_email(c) for c in commits])
+        for commit in commits:
+            self.validate_commit(commit, email_to_user)
+
+    def copy_commit(self, commit, staged=None):
+        """copy a single commit
+
+        staged is the commit's p4gf_g2p_stage.StagedCommit, or None to
+        check the commit out into the Git work tree and copy from there.
+        """
+        if staged is None:
+            staged = p4gf_g2p_stage.StagedCommit(commit)
+
+        self._reset_for_new_commit()
+
+        #OG.debug("dump commit {}".format(commit))
+        LOG.debug("for  commit {}".format(commit['mark']))
+        LOG.debug("with description: {}".format(commit['data']))
+        LOG.debug("files affected: {}".format(commit['files']))
 
-        with self.perf.timer[CHECK_PROTECTS]:
-            self.check_protects(author_p4user, commit['files'])
+        author_p4user = self.commit_author.get(commit['sha1'])
+        if not author_p4user:
+            author_p4user = self.validate_commit(commit)
+
+        archived = None
+        if not staged.root:
+            with self.perf.timer[GIT_CHECKOUT]:
+                if self.bare:
+                    archived = p4gf_g2p_stage.archive_commit(commit,
+                                                             self._view_dir())
+                    staged = archived
+                else:
+                    d = p4gf_util.popen_no_throw(['git', 'checkout', commit['sha1']])
+                    if d['Popen'].returncode:
+                        # Sometimes git cannot distinquish the revision from a path...
+                        p4gf_util.popen(['git', 'reset', '--hard', commit['sha1'], '--'])
 
         try:
-            self.copy_blobs(commit['files'])
+            self.copy_blobs(staged)
         except P4.P4Exception as e:
             self.revert_and_raise(str(e))
+        finally:
+            if archived:
+                archived.remove()
+        self.git_modes.record(commit['files'])
 
         with self.perf.timer[COPY_BLOBS_2]:
             pusher_p4user = self.ctx.authenticated_p4user
@@ -686,14 +1007,16 @@ class G2P:
             try:
                 opened = self.ctx.p4.run('opened')
                 if opened:
-                    changenum = p4_submit(self.ctx.p4, desc, author_p4user,
-                                          commit['author']['date'])
+                    changenum = self._submit(desc, author_p4user,
+                                             commit['author']['date'])
                     LOG.info("Submitted change @{} for commit {}".format(changenum, commit['sha1']))
                 else:
                     LOG.info("Ignored empty commit {}".format(commit['sha1']))
+                    self._clean_workspace()
                     return None
             except P4.P4Exception as e:
                 self.revert_and_raise(str(e))
+            self._clean_workspace()
             return ":" + str(changenum) + " " + commit['sha1']
 
     def test_block_push(self):
@@ -735,23 +1058,86 @@ class G2P:
 
         log.debug("Block released")
         
+    def set_change_owners(self):
+        """Apply any deferred changelist User/Date edits.
+
+        Must run before the mirror records these changelists. A failure
+        here is logged but not raised: the changelists are submitted, and
+        losing their mirror objects would be worse than a wrong owner.
+        """
+        if not self.change_owners:
+            return
+        try:
+            p4_set_change_owners(self.ctx.p4, self.change_owners)
+        except P4.P4Exception:
+            LOG.error("failed to set change owners for {}"
+                      .format([co[0] for co in self.change_owners]),
+                      exc_info=True)
+        self.change_owners = []
+
+    def _view_dir(self):
+        """Return the directory that holds this view's Perforce workspace."""
+        return os.path.dirname(self.ctx.contentlocalroot.rstrip('/'))
+
+    def _load_journal(self, commands):
+        """Open this view's push journal, and find which of the commits
+        in this push an earlier, unfinished push already submitted.
+        """
+        journal = p4gf_g2p_journal.PushJournal(self._view_dir())
+        journal.load()
+        self.journaled = journal.verified(
+                            self.ctx.p4, self.ctx.p4.client,
+                            [c['sha1'] for c in commands
+                             if c['command'] == 'commit'])
+        if self.journaled:
+            LOG.info("resuming push: {} commits already submitted"
+                     .format(len(self.journaled)))
+        return journal
+
+    def _skip_journaled(self, commit):
+        """Account for a commit that an earlier push submitted, without
+        submitting it again. Return its mark.
+        """
+        self.git_modes.record(commit['files'])
+        return ":{} {}".format(self.journaled[commit['sha1']], commit['sha1'])
+
+    def _start_stager(self, commands, start_at, commit_count):
+        """Start a thread staging commits ahead of copy_commit(), or
+        return None if the pipeline is disabled or pointless.
+        """
+        depth = p4gf_util.const_to_int(p4gf_const.P4GF_G2P_PIPELINE_DEPTH)
+        if depth < 1 or commit_count < 2:
+            return None
+        # Stage next to the Perforce workspace, on the same filesystem,
+        # so that staged files can be hard linked into place.
+        stager = p4gf_g2p_stage.CommitStager(commands, self._view_dir(),
+                                             start_at, depth, self.journaled)
+        stager.start()
+        return stager
+
     def copy(self, start_at, end_at):
         """copy a set of commits from git into perforce"""
         with self.perf.timer[OVERALL]:
             with p4gf_util.HeadRestorer():
                 LOG.debug("begin copying from {} to {}".format(start_at, end_at))
-                self.attempt_resync()
+                self.git_modes = p4gf_g2p_stage.GitModes(start_at)
                 with self.perf.timer[CHECK_CONFLICT]:
                     conflict_checker = G2PConflictChecker(self.ctx)
                 with self.perf.timer[FAST_EXPORT]:
                     fe = p4gf_fastexport.FastExport(start_at, end_at, self.ctx.tempdir.name)
                     fe.run()
                 marks = []
+                completed = False
                 commit_count = 0
                 for x in fe.commands:
                     if x['command'] == 'commit':
                         commit_count += 1
+                with self.perf.timer[VALIDATE]:
+                    journal = self._load_journal(fe.commands)
+                    self.attempt_resync()
+                    self.validate_commits(fe.commands)
                 self.progress.progress_init_determinate(commit_count)
+                stager = self._start_stager(fe.commands, start_at, commit_count)
                 try:
                     for command in fe.commands:
                         with self.perf.timer[TEST_BLOCK_PUSH]:
@@ -759,10 +1145,24 @@ class G2P:
                         if command['command'] == 'commit':
                             self.progress.progress_increment("Copying changelists...")
                             self.ctx.heartbeat()
-                            with self.perf.timer[COPY]:
-                                mark = self.copy_commit(command)
-                                if mark is None:
-                                    continue
+                            staged = None
+                            if stager:
+                                with self.perf.timer[STAGE_WAIT]:
+                                    staged = stager.get(command)
+                            try:
+                                with self.perf.timer[COPY]:
+                                    if command['sha1'] in self.journaled:
+                                        mark = self._skip_journaled(command)
+                                    else:
+                                        mark = self.copy_commit(command, staged)
+                                        if mark is not None:
+                                            journal.record(command['sha1'],
+                                                mark_to_commit_changelist(mark)[1])
+                            finally:
+                                if staged:
+                                    staged.remove()
+                            if mark is None:
+                                continue
                             with self.perf.timer[CHECK_CONFLICT]:
                                 (git_commit_sha1,
                                  p4_changelist_number) = mark_to_commit_changelist(mark)
@@ -777,12 +1177,34 @@ class G2P:
                         else:
                             raise RuntimeError("Unexpected fast-export command: " +
                                                command['command'])
+                    with self.perf.timer[CHECK_CONFLICT]:
+                        if (    not conflict_checker.has_conflict()
+                            and conflict_checker.reconcile()):
+                            LOG.error("P4 conflict found")
+                            first_bad = int(conflict_checker.first_conflict_change)
+                            marks = [m for m in marks
+                                     if int(mark_to_commit_changelist(m)[1]) < first_bad]
+                    completed = True
                 finally:
+                    self.record_have_change(marks, completed and
+                                            not conflict_checker.has_conflict())
+                    # Throw away whatever was staged for commits we will
+                    # now never submit.
+                    if stager:
+                        stager.abort()
+                    with self.perf.timer[CHANGE_OWNER]:
+                        self.set_change_owners()
                     # we want to write mirror objects for any commits that made it through
                     # any exception will still be alive after this
                     with self.perf.timer[MIRROR]:
                         self.ctx.mirror.add_commits(marks)
                         self.ctx.mirror.add_objects_to_p4(self.ctx)
+                    # Keep the journal for the user's next try unless this
+                    # push ran to the end.
+                    if completed:
+                        journal.remove()
+                    else:
+                        journal.close()
 
                 if conflict_checker.has_conflict():
                     raise RuntimeError("Conflicting change from Perforce caused one"
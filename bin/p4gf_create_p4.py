@@ -1,16 +1,69 @@
 #! /usr/bin/env python3.2
 """Create a new P4.P4() instance."""
 
+import collections
 import sys
 
 import P4
 
 import p4gf_const
+import p4gf_fact_cache
 import p4gf_log
+import p4gf_util
 import p4gf_version
 
 LOG = p4gf_log.for_module()
 
+# Commands sent to Perforce by this process, by command name, counted only
+# when P4GF_TRACE_ROUND_TRIPS is on. 'connect' counts connections.
+round_trips = collections.Counter()
+
+
+def tracing_round_trips():
+    """Is P4GF_TRACE_ROUND_TRIPS on?"""
+    return p4gf_util.const_to_bool(p4gf_const.P4GF_TRACE_ROUND_TRIPS)
+
+
+def _trace(p4):
+    """Count every command p4 runs, and every time it connects.
+
+    P4.run_xxx(), fetch_xxx() and save_xxx() all go through run().
+    """
+    run = p4.run
+    connect = p4.connect
+
+    def traced_run(*args, **kwargs):
+        """P4.run(), counted."""
+        cmd = args[0] if args else '?'
+        while isinstance(cmd, (list, tuple)):
+            cmd = cmd[0] if cmd else '?'
+        round_trips[cmd] += 1
+        return run(*args, **kwargs)
+
+    def traced_connect():
+        """P4.connect(), counted."""
+        round_trips['connect'] += 1
+        return connect()
+
+    p4.run = traced_run
+    p4.connect = traced_connect
+
+
+def report_round_trips():
+    """If tracing, write this process's round trip counts to stderr and
+    the log.
+    """
+    if not tracing_round_trips():
+        return
+    msg = ("p4gf: {} p4 round trips: {}"
+           .format(sum(round_trips.values()),
+                   " ".join("{}={}".format(k, v)
+                            for k, v in sorted(round_trips.items()))))
+    msg += ("\np4gf: p4 connections: pooled opened={} reused={}"
+            .format(POOL.opened, POOL.reused))
+    LOG.getChild("round_trips").info(msg)
+    sys.stderr.write(msg + "\n")
+
 
 def create_p4(port=None, user=None, client=None):
     """Return a new P4.P4() instance with its prog set to
@@ -29,9 +82,39 @@ def create_p4(port=None, user=None, client=None):
     if client:
         p4.client = client
 
+    if tracing_round_trips():
+        _trace(p4)
     return p4
 
 
+# Connections opened ahead of need by p4gf_auth_daemon.py, for the next
+# connect_p4() with the same port, user and client to take instead of
+# connecting.
+_prewarmed = []
+
+
+def prewarm(port=None, user=None, client=None):
+    """Open a connection now, for a later connect_p4() to take."""
+    p4 = connect_p4(port, user, client)
+    if p4:
+        _prewarmed.append(p4)
+
+
+def _take_prewarmed(p4):
+    """Return a still-connected prewarmed connection that matches p4's port,
+    user and client, or None.
+    """
+    for warm in _prewarmed:
+        if (    warm.port   == p4.port
+            and warm.user   == p4.user
+            and warm.client == p4.client):
+            _prewarmed.remove(warm)
+            if warm.connected():
+                LOG.debug("connect_p4(): prewarmed {}".format(warm))
+                return warm
+    return None
+
+
 def connect_p4(port=None, user=None, client=None):
     """Connects to a P4D instance and checks the version of the server. The
     connected P4.P4 instance is returned. If the version of the server is
@@ -41,6 +124,9 @@ def connect_p4(port=None, user=None, client=None):
     if not user:
         user = p4gf_const.P4GF_USER
     p4 = create_p4(port, user, client)
+    warm = _take_prewarmed(p4)
+    if warm:
+        return warm
     try:
         p4.connect()
         LOG.debug("connect_p4(): u={} {}".format(user, p4))
@@ -48,5 +134,113 @@ def connect_p4(port=None, user=None, client=None):
         LOG.error('Failed P4 connect: {}'.format(str(e)))
         sys.stderr.write("error: cannot connect, p4d not running?\n")
         return None
-    p4gf_version.p4d_version_check(p4)
+    _check_p4d_version(p4)
     return p4
+
+
+def _check_p4d_version(p4):
+    """p4gf_version.p4d_version_check(), unless this host already found
+    this server's version acceptable recently.
+    """
+    version_string = p4gf_fact_cache.get(p4, "p4d_version")
+    if version_string:
+        p4gf_version.p4d_version_cache_set(p4, version_string)
+        return
+    version_string = p4gf_version.p4d_version_check(p4)
+    p4gf_fact_cache.put(p4, "p4d_version", version_string)
+
+
+class ConnectionPool:
+    """This process's shared Perforce connections, one per (port, user,
+    client), each opened when first needed and reused from then on.
+
+    Shared by every Context in the process, so a connection is only good
+    for the thread that uses Contexts. Anything that runs Perforce
+    commands on another thread (the lock Pacemaker) gets a connection of
+    its own from connect_p4().
+    """
+
+    def __init__(self):
+        self.connections = {}
+        self.opened = 0         # connects, including reconnects
+        self.reused = 0         # requests answered with an open connection
+
+    def get(self, port, user, client):
+        """Return a connected P4.P4 for port, user and client.
+
+        Reconnects if the one we had is no longer connected. Raises
+        RuntimeError if it cannot connect.
+        """
+        key = (port, user, client)
+        p4 = self.connections.get(key)
+        if p4 and p4.connected():
+            self.reused += 1
+            return p4
+        if p4:
+            LOG.debug("reconnecting u={} c={}: connection dropped"
+                      .format(user, client))
+        p4 = create_p4(port, user, client)
+        warm = _take_prewarmed(p4)
+        if warm:
+            p4 = warm
+        else:
+            try:
+                p4.connect()
+            except P4.P4Exception as e:
+                raise RuntimeError("Failed P4 connect: {}".format(str(e)))
+            self.opened += 1
+            LOG.debug("pool: connected u={} {}".format(user, p4))
+        self.connections[key] = p4
+        return p4
+
+
+POOL = ConnectionPool()
+
+
+class LazyP4:
+    """Stands in for a P4.P4 from POOL, and does not connect until
+    something actually needs Perforce.
+
+    Every attribute it does not know is the real connection's. Reading
+    port, user or client does not connect. Anything assigned (tagged,
+    exception_level, handler) is remembered and applied again if the
+    connection drops and POOL has to replace it.
+    """
+
+    # Readable without connecting.
+    _KEY_ATTRS = ('port', 'user', 'client')
+
+    def __init__(self, port=None, user=None, client=None):
+        self.__dict__['_key'] = (port, user, client)
+        self.__dict__['_p4'] = None
+        self.__dict__['_settings'] = {}
+
+    def connection(self):
+        """Return the real, connected P4.P4, connecting if necessary."""
+        p4 = self.__dict__['_p4']
+        if p4 is None or not p4.connected():
+            p4 = POOL.get(*self.__dict__['_key'])
+            for (name, value) in self.__dict__['_settings'].items():
+                setattr(p4, name, value)
+            self.__dict__['_p4'] = p4
+        return p4
+
+    def __getattr__(self, name):
+        if name in LazyP4._KEY_ATTRS:
+            value = self.__dict__['_key'][LazyP4._KEY_ATTRS.index(name)]
+            if value:
+                return value
+        return getattr(self.connection(), name)
+
+    def __setattr__(self, name, value):
+        if name in LazyP4._KEY_ATTRS:
+            raise AttributeError("cannot change {} of a pooled connection"
+                                 .format(name))
+        self.__dict__['_settings'][name] = value
+        if self.__dict__['_p4'] is not None:
+            setattr(self.__dict__['_p4'], name, value)
+
+    def __str__(self):
+        (port, user, client) = self.__dict__['_key']
+        return "LazyP4 port={} user={} client={} connected={}".format(
+                port, user, client, self.__dict__['_p4'] is not None)
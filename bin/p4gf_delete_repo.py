@@ -25,9 +25,11 @@ import sys
 
 
 import P4
+import p4gf_bulk
 import p4gf_const
 import p4gf_context
 from p4gf_create_p4 import connect_p4
+import p4gf_fact_cache
 import p4gf_log
 import p4gf_lock
 import p4gf_util
@@ -156,7 +158,10 @@ def delete_client(args, p4, client_name):
         for group_template in group_list:
             group = group_template.format(view=view_name)
             print("p4 group -a -d {}".format(group))
-        print('p4 counter -u -d {}'.format(p4gf_lock.view_lock_name(view_name)))
+        for counter in p4gf_lock.view_lock_counter_names(view_name):
+            print('p4 counter -u -d {}'.format(counter))
+        print('p4 counter -u -d {}'.format(
+                p4gf_const.P4GF_COUNTER_HAVE_CHANGE.format(view=view_name)))
 
     else:
         print_verbose(args, "Removing client files for {}...".format(client_name))
@@ -165,11 +170,7 @@ def delete_client(args, p4, client_name):
         p4.run('client', '-df', client_name)
         for d in rm_list:
             remove_file_or_dir(args, view_name, d)
-        bite_size = 1000
-        while len(objects_to_delete):
-            to_delete = objects_to_delete[:bite_size]
-            objects_to_delete = objects_to_delete[bite_size:]
-            p4.run("obliterate", "-y", to_delete)
+        p4gf_bulk.run_all(p4, ["obliterate", "-y"], objects_to_delete)
         if objects_to_modify:
             for (fname, views) in objects_to_modify:
                 p4.run("edit", fname)
@@ -177,7 +178,9 @@ def delete_client(args, p4, client_name):
             p4.run("submit", "-d", "'Removing {} from views attribute'".format(view_name))
         for group_template in group_list:
             delete_group(args, p4, group_template.format(view=view_name))
-        _delete_counter(p4, p4gf_lock.view_lock_name(view_name))
+        for counter in p4gf_lock.view_lock_counter_names(view_name):
+            _delete_counter(p4, counter)
+        _delete_counter(p4, p4gf_const.P4GF_COUNTER_HAVE_CHANGE.format(view=view_name))
 # pylint: enable=R0912
 
 
@@ -326,20 +329,25 @@ def main():
         sys.stderr.write("P4 exception occurred: {}".format(e))
         sys.exit(1)
 
-    if args.all:
-        try:
-            delete_all(args, p4)
-        except P4.P4Exception as e:
-            sys.stderr.write("{}\n".format(e))
-            sys.exit(1)
-    else:
-        # Delete the client(s) for the named view(s).
-        for view in args.views:
-            client_name = p4gf_context.view_to_client_name(view)
+    try:
+        if args.all:
             try:
-                delete_client(args, p4, client_name)
+                delete_all(args, p4)
             except P4.P4Exception as e:
                 sys.stderr.write("{}\n".format(e))
+                sys.exit(1)
+        else:
+            # Delete the client(s) for the named view(s).
+            for view in args.views:
+                client_name = p4gf_context.view_to_client_name(view)
+                try:
+                    delete_client(args, p4, client_name)
+                except P4.P4Exception as e:
+                    sys.stderr.write("{}\n".format(e))
+    finally:
+        if args.delete:
+            # Whatever this host remembered about them is no longer so.
+            p4gf_fact_cache.forget(p4)
     if not args.delete:
         print("This was report mode. Use -y to make changes.")
 
@@ -0,0 +1,146 @@
+#! /usr/bin/env python3.2
+"""Facts about Perforce that rarely change, remembered between requests.
+
+Every p4gf_auth_server.py request used to learn the same things from
+Perforce all over again before doing any real work: Git Fusion is
+initialized, git-fusion-user can write counters and run 'p4 protects',
+this view's repo and client exist, this client's root and view are such
+and such. Each costs at least one round trip.
+
+This host now remembers each such fact in one small JSON file in
+~/.git-fusion, keyed by P4PORT, for P4GF_FACT_CACHE_SECS seconds. After
+that, the fact is looked up again. Git Fusion code that changes something
+a fact records calls forget(), so only changes made outside this host's
+Git Fusion (by hand, or by another Git Fusion host) wait out the TTL.
+
+Remember only good news. A failed check is always checked again.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+import p4gf_const
+
+LOG = logging.getLogger(__name__)
+
+FILENAME = "fact-cache.json"
+
+# This process's copy of the file, loaded on first get().
+_facts = None
+
+
+def _ttl():
+    """How many seconds to trust a fact. 0 or less disables the cache."""
+    try:
+        return int(p4gf_const.P4GF_FACT_CACHE_SECS)
+    except ValueError:
+        return 0
+
+
+def _path():
+    """Where this host keeps its facts."""
+    return os.path.join(os.path.expanduser('~'), p4gf_const.P4GF_DIR, FILENAME)
+
+
+def _key(p4, name):
+    """Facts about one server never answer for another."""
+    return "{}|{}".format(p4.port, name)
+
+
+def read_json(path):
+    """Return the dict stored in the JSON file at path, or an empty dict if
+    the file is missing, damaged, or holds something else.
+    """
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def write_json(path, data):
+    """Replace the file at path with data, as JSON, atomically: concurrent
+    readers see the old file or the new one, never half of either. Last
+    writer wins. Failure to write is logged, not raised.
+    """
+    try:
+        dir_path = os.path.dirname(path)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        with tempfile.NamedTemporaryFile(mode='w', dir=dir_path,
+                                         prefix=os.path.basename(path) + '.',
+                                         delete=False) as f:
+            json.dump(data, f)
+        os.rename(f.name, path)
+    except (IOError, OSError):
+        LOG.debug("cannot write {}".format(path), exc_info=True)
+
+
+def _load():
+    """Read the whole file. A missing or damaged file holds no facts."""
+    return read_json(_path())
+
+
+def _fresh(entry, now, ttl):
+    """Is [time, value] entry younger than ttl seconds?"""
+    return (    isinstance(entry, list)
+            and len(entry) == 2
+            and 0 <= now - entry[0] < ttl)
+
+
+def _update(func):
+    """Re-read the file, let func(facts) change it, write it back.
+
+    Concurrent requests may each update the file; the last rename wins and
+    whatever the loser added is simply learned again later.
+    """
+    global _facts
+    facts = _load()
+    func(facts)
+    now = time.time()
+    ttl = _ttl()
+    facts = {k: v for k, v in facts.items() if _fresh(v, now, ttl)}
+    _facts = facts
+    write_json(_path(), facts)
+
+
+def get(p4, name):
+    """Return the value remembered for name, or None if not remembered or
+    too old to trust.
+    """
+    global _facts
+    ttl = _ttl()
+    if ttl <= 0:
+        return None
+    if _facts is None:
+        _facts = _load()
+    entry = _facts.get(_key(p4, name))
+    if not _fresh(entry, time.time(), ttl):
+        return None
+    LOG.debug("fact {}: {}".format(name, entry[1]))
+    return entry[1]
+
+
+def put(p4, name, value=True):
+    """Remember value for name. value must survive a trip through JSON."""
+    if _ttl() <= 0:
+        return
+    key = _key(p4, name)
+    _update(lambda facts: facts.__setitem__(key, [time.time(), value]))
+
+
+def forget(p4, name=None):
+    """Stop trusting name, or every fact about p4's server if name is None."""
+    if not os.path.exists(_path()):
+        return
+    if name is None:
+        prefix = _key(p4, '')
+        _update(lambda facts: [facts.pop(k) for k in list(facts)
+                               if k.startswith(prefix)])
+    else:
+        key = _key(p4, name)
+        _update(lambda facts: facts.pop(key, None))
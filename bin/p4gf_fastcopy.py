@@ -0,0 +1,196 @@
+#! /usr/bin/env python3.2
+"""Copy file content from the Git work tree into the Perforce workspace
+using the cheapest primitive the filesystem offers.
+
+In order of preference:
+
+    link      hard link, zero bytes copied. Only when both paths share a
+              filesystem. Git never rewrites a work tree file in place (it
+              unlinks and recreates), and p4 writes through a temp file, so
+              the two names never see each other's later changes.
+    reflink   copy-on-write clone (FICLONE) on btrfs, XFS and friends.
+    range     os.copy_file_range(), in-kernel copy.
+    sendfile  os.sendfile(), in-kernel copy.
+    copy      plain shutil.copyfile(), userspace copy.
+
+Symlinks are never followed: dst becomes a symlink to the same target as
+src, which is what p4 submits for a file of type symlink.
+"""
+
+import errno
+import logging
+import os
+import shutil
+
+import p4gf_const
+import p4gf_util
+
+LOG = logging.getLogger(__name__)
+
+# Copy methods, in order of preference. Also the values returned by
+# stage_file() so callers can count which method won.
+LINK     = "link"
+REFLINK  = "reflink"
+RANGE    = "range"
+SENDFILE = "sendfile"
+COPY     = "copy"
+
+METHODS = [LINK, REFLINK, RANGE, SENDFILE, COPY]
+
+# linux/fs.h: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+# Bytes per in-kernel copy call.
+_CHUNK = 64 * 1024 * 1024
+
+# errno values that mean "this primitive is not available here, try the
+# next one" rather than "something is really wrong".
+_UNSUPPORTED = set([errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOSYS,
+                    errno.EOPNOTSUPP, errno.ENOTTY, errno.EMLINK,
+                    getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)])
+
+# Methods that failed with an "unsupported" errno once are not retried for
+# the rest of this process: a push copies thousands of files between the
+# same two directories, no point asking the kernel the same question.
+_disabled = set()
+
+
+def _disable(method, e):
+    """Remember that method does not work here."""
+    LOG.debug("disabling {} copy: {}".format(method, e))
+    _disabled.add(method)
+
+
+def _unlink_if(path):
+    """Remove path if it exists.
+
+    The Perforce workspace holds zero-byte placeholders for edits, and
+    files that p4 has made read-only after an earlier submit. Replacing
+    the directory entry avoids both problems.
+    """
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _try_link(src, dst):
+    """Hard link src to dst."""
+    os.link(src, dst)
+
+
+def _try_reflink(src, dst):
+    """Copy-on-write clone src to dst."""
+    import fcntl
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            except (OSError, IOError):
+                fdst.close()
+                _unlink_if(dst)
+                raise
+
+
+def _kernel_copy(src, dst, copy_fn):
+    """Copy src to dst one _CHUNK at a time using copy_fn(fd_in, fd_out,
+    count), which returns the number of bytes copied.
+
+    Some filesystems answer an in-kernel copy by copying nothing at all,
+    no error. Treat that as unsupported, so that stage_file() moves on to
+    the next method rather than leave dst short.
+    """
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    n = copy_fn(fsrc.fileno(), fdst.fileno(),
+                                min(remaining, _CHUNK))
+                    if n == 0:
+                        raise OSError(errno.EOPNOTSUPP,
+                                      "copied nothing, {} bytes to go"
+                                      .format(remaining), src)
+                    remaining -= n
+            except (OSError, IOError):
+                fdst.close()
+                _unlink_if(dst)
+                raise
+
+
+def _try_range(src, dst):
+    """In-kernel copy with copy_file_range()."""
+    _kernel_copy(src, dst, os.copy_file_range)
+
+
+def _try_sendfile(src, dst):
+    """In-kernel copy with sendfile()."""
+    _kernel_copy(src, dst, lambda fin, fout, n: os.sendfile(fout, fin, None, n))
+
+
+def _available(method):
+    """Does this Python/platform offer method, and is it still enabled?"""
+    if method in _disabled:
+        return False
+    if method == LINK:
+        return p4gf_util.const_to_bool(p4gf_const.P4GF_STAGE_HARDLINK)
+    if method == REFLINK:
+        return hasattr(os, 'uname') and os.uname()[0] == 'Linux'
+    if method == RANGE:
+        return hasattr(os, 'copy_file_range')
+    if method == SENDFILE:
+        return hasattr(os, 'sendfile')
+    return True
+
+_TRY = { LINK     : _try_link
+       , REFLINK  : _try_reflink
+       , RANGE    : _try_range
+       , SENDFILE : _try_sendfile
+       }
+
+
+def _copy_symlink(src, dst):
+    """Make dst a symlink to whatever src points to, without following src.
+
+    src is either the symlink itself, from a checkout or 'git archive', or
+    a regular file holding the blob, whose content is the link target.
+    """
+    if os.path.islink(src):
+        target = os.readlink(src)
+    else:
+        with open(src, 'rb') as f:
+            target = os.fsdecode(f.read())
+    os.symlink(target, dst)
+
+
+def stage_file(src, dst, mode=None):
+    """Make dst a copy of src, replacing any existing dst.
+
+    mode is the Git file mode string as reported by fast-export, or None
+    if unknown. Only regular files ("100644", "100755") take the fast
+    paths. If mode is unknown, fall back to asking the filesystem.
+
+    Return the name of the method that did the work, one of METHODS.
+    """
+    if mode is None:
+        regular = not os.path.islink(src)
+    else:
+        regular = mode.startswith('100')
+    _unlink_if(dst)
+    if mode == "120000" or (mode is None and not regular):
+        _copy_symlink(src, dst)
+        return COPY
+    if regular:
+        for method in METHODS[:-1]:
+            if not _available(method):
+                continue
+            try:
+                _TRY[method](src, dst)
+                return method
+            except (OSError, IOError) as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                _disable(method, e)
+    shutil.copyfile(src, dst)
+    return COPY
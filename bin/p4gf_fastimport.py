@@ -8,6 +8,7 @@ import tempfile
 import p4gf_const
 import p4gf_profiler
 import p4gf_usermap
+import p4gf_util
 
 LOG = logging.getLogger(__name__)
 
@@ -223,10 +224,37 @@ class FastImport:
         """Run git-merge to merge the imported commits."""
         with self.perf.timer[OVERALL]:
             with self.perf.timer[MERGE]:
+                if p4gf_util.git_bare_repo():
+                    self._merge_bare()
+                    return
                 check_output(['git', 'status'])
                 LOG.debug("git merge --quiet --ff-only {0}".format(self.branchname))
                 check_call(['git', 'merge', '--quiet', '--ff-only', self.branchname])
 
+    def _merge_bare(self):
+        """Fast-forward master to the imported commits and delete the temp
+        branch, in one transaction, without touching a work tree.
+        """
+        branch_ref = 'refs/heads/' + self.branchname
+        master_ref = 'refs/heads/master'
+        d = p4gf_util.popen_no_throw(['git', 'show-ref', master_ref, branch_ref])
+        tips = {}
+        for line in d['out'].splitlines():
+            (sha1, ref) = line.split(' ', 1)
+            tips[ref] = sha1
+        tip = tips.get(branch_ref)
+        if not tip:
+            LOG.debug("nothing imported, master stays put")
+            return
+        master = tips.get(master_ref)
+        if master:
+            # Same refusal as 'git merge --ff-only'.
+            check_call(['git', 'merge-base', '--is-ancestor', master, tip])
+        LOG.debug("fast-forward master {0} to {1}".format(master, tip))
+        p4gf_util.git_update_refs([ (master_ref, tip, master or '0' * 40)
+                                  , (branch_ref, None, tip)
+                                  ])
+
     def __repr__(self):
         return "\n".join([repr(self.ctx),
                           "timezone                : " + self.timezone,
@@ -2,7 +2,7 @@
 """Code for detecting conflicting Perforce changelist submitted while
 copying git commits to Perforce.
 """
-from   collections import namedtuple
+from   collections import deque, namedtuple
 import logging
 
 import p4gf_log
@@ -19,11 +19,34 @@ LOG = p4gf_log.for_module()
 # thus deserves a capital.
 CommitChange = namedtuple('CommitChange', ['git_commit_sha1', 'p4_changelist_number'])
 
+# How many recent CommitChange tuples to keep in G2PConflictChecker.good.
+# Anything older has already been checked.
+WINDOW = 1000
+
+# job058596: On play:1999, @now is NOT reporting the most recently
+# submitted changelist, causing 'p4 changes //client/....@change,now'
+# to not report the recent change, and find_Conflict_index() to
+# (correctly!) report a conflict because we claim there should be a
+# changelist in self.good but fail to see it in changes. Work around
+# this @now bug by using a date far in the future, but not so far that
+# Perforce rejects it as a bogus date. PS: Note to self: if we're
+# still using this code in the year 2030, try ',now' instead of
+# ',2030/12/31' and if that works, remove this hack.
+FUTURE = "2030/12/31"
+
 
 class G2PConflictChecker:
     """An object that follows along as you copy commits from git to
     Perforce, and knows how to detect when someone else has submitted to
     Perforce, causing a conflict.
+
+    check() runs after every submit, so it has to be cheap. Changelist
+    numbers only grow, so anyone else's changelist submitted between two of
+    ours must be numbered between them: if our two are consecutive, there
+    is nothing to ask the server. Otherwise one 'p4 changes -m1' over the
+    gap tells. Only if that finds something, and once more at the end of the
+    push in reconcile(), do we compare our recent history against the
+    server's in full.
     """
 
     def __init__(self, ctx,
@@ -44,12 +67,21 @@ class G2PConflictChecker:
         #
         # element[0] is usally the git commit sha1 and Perforce
         # changelist number that correspond with HEAD at __init__ time.
-        self.good                    = []
+        #
+        # Only the most recent WINDOW elements are kept.
+        self.good                    = deque(maxlen=WINDOW)
 
         # Updated by check(), point to element of good[] or None if no
-        # conflict yet.
+        # conflict yet. May be len(good) if the conflict is a changelist
+        # after all of ours.
         self.first_conflict_index    = None
 
+        # The Perforce changelist number at first_conflict_index.
+        self.first_conflict_change   = None
+
+        # Number of times we asked the server, for the curious.
+        self.query_count             = 0
+
         # Updated by find_conflict_index() when no conflict is found.
         self.last_good_change_number = None
 
@@ -115,7 +147,8 @@ class G2PConflictChecker:
         # Do NOT update last_unconflicted_index here! We don't _know_
         # another Perforce changelist snuck in ahead of this commit thus
         # making this a conflicted, ungood commit. Let check() do that.
-        LOG.debug("end of record_commit(): {}".format(self))
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("end of record_commit(): {}".format(self))
 
 
     def find_conflict_index(self, changelist_list_):
@@ -123,52 +156,53 @@ class G2PConflictChecker:
         recorded via record_commit(), then they must have come from elsewhere
         and are a conflict.
 
-        Return an index into g2p_change_number identifying the first commit/change
+        Return an index into self.good identifying the first commit/change
         that occurs at or after a conflict. This commit does NOT exactly match
         its Perforce changelist counterpart and cannot be considered
         "committed". This is the first commit that 'git push' must reject.
         'git push' must accept (and move the head pointer to) the commit
         immedately before this commit.
+
+        Sets first_conflict_change. O(n).
         """
 
         # p4 changes returns newer-to-older [4, 3, 2, 1] but our loop works
         # better older-to-newer [1, 2, 3, 4].
-        changelist_list = changelist_list_
-        changelist_list.reverse()
-
-        # Pull from "known good" and "p4 changes output" in lock step until we
-        # hit a mismatch. Should be O(n)
-        good_index = 0
+        changes = [x['change'] for x in reversed(changelist_list_)]
         good    = [x.p4_changelist_number for x in self.good]
-        changes = [x['change'] for x in changelist_list]
         LOG.debug("find_conflict_index changes={}".format(changes))
-        LOG.debug(str(self))
-        
-        # Skip old "good" elements that occur before the start of "changes" history.
-        while len(good) and not (good[0] in changes):
-            good.pop(0)
-
-        while len(good) and len(changes):
-            g = good.pop(0)
-            c = changes.pop(0)
-            if (g == c):
-                good_index += 1
-                continue
-
-            return good_index
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug(str(self))
 
-        if len(good):
+        # Skip old "good" elements that occur before the start of "changes" history.
+        change_set = set(changes)
+        good_index = 0
+        while good_index < len(good) and not (good[good_index] in change_set):
+            good_index += 1
+
+        # Walk "known good" and "p4 changes output" in lock step until we
+        # hit a mismatch.
+        change_index = 0
+        while good_index < len(good) and change_index < len(changes):
+            if good[good_index] != changes[change_index]:
+                self.first_conflict_change = good[good_index]
+                return good_index
+            good_index   += 1
+            change_index += 1
+
+        if good_index < len(good):
             # We fell off the end of one or both lists. If there are any known
             # changes left in good that did not appear in 'p4 changes' output
             # changes, then something's wrong. I guess we'll flag the first
             # unseen "good" as conflict.
+            self.first_conflict_change = good[good_index]
             return good_index
 
-        if len(changes):
+        if change_index < len(changes):
             # There are one or more changes in 'p4 changes' that did not
-            # appear in known, those are conflicts. Append the first to our
-            # list of "known" just so that we can return an index to it.
-            good.append(CommitChange(None, changes[0]))
+            # appear in known, those are conflicts. Point just past the end
+            # of good[].
+            self.first_conflict_change = changes[change_index]
             return good_index
 
         # Everything in good[] was also in changelist_list[], so it's all good.
@@ -176,42 +210,58 @@ class G2PConflictChecker:
             self.last_good_change_number = self.good[-1].p4_changelist_number
         return None
 
-    def check(self):
-        """Query Perforce for recent changes, if any submitted changes
-        are not ours, then a conflict has occurred and it is time to
-        stop copying.
+    def _run_changes(self, cmd):
+        """Run one 'p4 changes' command and count it."""
+        self.query_count += 1
+        r = self.ctx.p4.run(cmd)
+        LOG.debug('p4 {} returned r={}'.format(' '.join(cmd), r))
+        return r
 
-        Return None if no conflict, or first conflicting p4 changelist number.
+    def _gap_is_empty(self):
+        """Can we tell, cheaply, that nobody submitted anything to our view
+        between our two most recent changelists?
+
+        Return False if we cannot tell, or if someone did.
         """
+        if len(self.good) < 2:
+            return False
+        prev = self.good[-2].p4_changelist_number
+        last = self.good[-1].p4_changelist_number
+        if not (prev and last):
+            return False
+        if prev != self.last_good_change_number:
+            return False
+        prev = int(prev)
+        last = int(last)
+        if last <= prev:
+            return False
+        if last == prev + 1:
+            return True
+        path = p4gf_path.slash_dot_dot_dot(self.ctx.config.p4client)
+        cmd = ['changes', '-m1', '-ssubmitted',
+               "{path}@{first},@{last}".format(path=path,
+                                                first=prev + 1,
+                                                last=last - 1)]
+        return not self._run_changes(cmd)
 
-        # job058596: On play:1999, @now is NOT reporting the most recently
-        # submitted changelist, causing 'p4 changes //client/....@change,now'
-        # to not report the recent change, and find_Conflict_index() to
-        # (correctly!) report a conflict because we claim there should be a
-        # changelist in self.good but fail to see it in changes. Work around
-        # this @now bug by using a date far in the future, but not so far that
-        # Perforce rejects it as a bogus date. PS: Note to self: if we're
-        # still using this code in the year 2030, try ',now' instead of
-        # ',2030/12/31' and if that works, remove this hack.
-        future = "2030/12/31"
+    def _full_check(self, max_changes):
+        """Compare good[] against the server's most recent changes.
 
+        Return None if no conflict, or first conflicting p4 changelist number.
+        """
         path = p4gf_path.slash_dot_dot_dot(self.ctx.config.p4client)
         path_at = None
         if self.last_good_change_number:
             path_at = ("{path}@{change},{future}"
                        .format(path=path,
                                change=self.last_good_change_number,
-                               future=future))
+                               future=FUTURE))
         else:
             path_at = "{path}@0,{future}".format(path=path,
-                                                 future=future)
+                                                 future=FUTURE)
 
-        # -m5: don't fetch more than 5 changes. As long as we run
-        # immediately before or after our git-to-perforce submit,
-        # any conflict will be within the most recent 2 changes.
-        cmd = ['changes', '-m5', '-ssubmitted', path_at]
-        changelist_list = self.ctx.p4.run(cmd)
-        LOG.debug('p4 changes -m5 -ssubmitted {} returned r={}'.format(path_at, changelist_list))
+        cmd = ['changes', '-m{}'.format(max_changes), '-ssubmitted', path_at]
+        changelist_list = self._run_changes(cmd)
 
         self.first_conflict_index = self.find_conflict_index(changelist_list)
 
@@ -224,8 +274,37 @@ class G2PConflictChecker:
                       .format(i=i, g=e.git_commit_sha1, p=e.p4_changelist_number))
         LOG.error("at index {}".format(self.first_conflict_index))
 
-        return self.good[self.first_conflict_index].p4_changelist_number
+        return self.first_conflict_change
+
+    def check(self):
+        """Detect whether anyone else has submitted to our view since our
+        last check. If so, a conflict has occurred and it is time to stop
+        copying.
+
+        Return None if no conflict, or first conflicting p4 changelist number.
+        """
+        if self._gap_is_empty():
+            self.last_good_change_number = self.good[-1].p4_changelist_number
+            return None
+
+        # -m5: don't fetch more than 5 changes. As long as we run
+        # immediately before or after our git-to-perforce submit,
+        # any conflict will be within the most recent 2 changes.
+        return self._full_check(5)
+
+    def reconcile(self):
+        """Once at the end of a push, compare everything still in good[]
+        against the server.
+
+        Return None if no conflict, or first conflicting p4 changelist number.
+        """
+        if self.has_conflict() or len(self.good) < 2:
+            return self.first_conflict_change
+        # Start from the oldest changelist we still remember.
+        self.last_good_change_number = self.good[0].p4_changelist_number
+        return self._full_check(len(self.good) + 5)
 
     def has_conflict(self):
         """Has a previous call to check() detected a conflict?"""
         return None != self.first_conflict_index
+
@@ -0,0 +1,99 @@
+#! /usr/bin/env python3.2
+"""Durable record of which Git commits a push has already submitted.
+
+G2P appends "sha1 changelist" to the view's journal as soon as each commit
+is submitted, and deletes the journal once the push completes. If a push
+dies partway through (dropped connection, p4d restart), the journal
+survives, and the user's next push of the same commits can skip the ones
+already in Perforce instead of submitting them again.
+
+A journal entry is only a hint: verified() checks each against the
+submitted changelist's description before anyone relies on it.
+"""
+
+import logging
+import os
+
+import P4
+
+import p4gf_bulk
+
+LOG = logging.getLogger(__name__)
+
+FILENAME = "push-journal"
+
+
+class PushJournal:
+    """One view's push journal, stored in dir_path."""
+
+    def __init__(self, dir_path):
+        self.path = os.path.join(dir_path, FILENAME)
+        # sha1 ==> changelist number string, as read at load() time.
+        self.entries = {}
+        self._file = None
+
+    def load(self):
+        """Read any entries left by an earlier, unfinished push."""
+        self.entries = {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                parts = line.split()
+                # A torn last line from a crash is not an entry.
+                if len(parts) == 2 and len(parts[0]) == 40:
+                    self.entries[parts[0]] = parts[1]
+        LOG.debug("loaded {} entries from {}".format(len(self.entries), self.path))
+
+    def verified(self, p4, client, sha1s):
+        """Return a dict of sha1 ==> changelist number for each of sha1s that
+        the journal says was submitted, and which Perforce agrees was: the
+        changelist is submitted, from our client, and names that commit.
+        """
+        want = dict((sha1, self.entries[sha1]) for sha1 in sha1s
+                    if sha1 in self.entries)
+        if not want:
+            return {}
+        described = {}
+        try:
+            for d in p4gf_bulk.run(p4, ['describe', '-s'],
+                                   list(set(want.values()))):
+                if isinstance(d, dict) and 'change' in d:
+                    described[d['change']] = d
+        except P4.P4Exception:
+            # Some changelist no longer exists. Trust none of it.
+            LOG.warn("push journal: cannot verify, ignoring", exc_info=True)
+            return {}
+        result = {}
+        for sha1, change in want.items():
+            d = described.get(change)
+            if (    d
+                and d.get('status') == 'submitted'
+                and d.get('client') == client
+                and " sha1: {}".format(sha1) in d.get('desc', '')):
+                result[sha1] = change
+            else:
+                LOG.warn("push journal: {} @{} not verified, ignoring"
+                         .format(sha1, change))
+        return result
+
+    def record(self, sha1, change):
+        """Durably append one submitted commit."""
+        if not self._file:
+            self._file = open(self.path, 'a')
+        self._file.write("{} {}\n".format(sha1, change))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """Stop appending; keep the journal for next time."""
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """The push completed: nothing left to resume."""
+        self.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.entries = {}
@@ -0,0 +1,320 @@
+#! /usr/bin/env python3.2
+"""Staging for the Git-to-Perforce push pipeline.
+
+G2P.copy() spends most of its time waiting on 'p4 submit'. A CommitStager
+thread works ahead of the submitter: for each upcoming commit it sorts the
+commit's file actions into the sets G2P.copy_blobs() runs, and writes the
+content of every added, edited or moved file into a private per-commit
+staging directory, read straight out of the object store with one
+long-running 'git cat-file --batch'. The submitter then copies staged files
+into the Perforce workspace without touching the Git work tree.
+
+Commits the stager cannot stage (merges, symlinks, submodules, and any
+commit whose tree holds a .gitattributes file, since raw blobs skip eol and
+filter conversion) go through with root=None, and G2P falls back to 'git checkout' for those, or, in a
+bare repo, to archive_commit().
+
+The stager never talks to Perforce and never writes to the Perforce
+workspace, so stopping it (abort()) and deleting its staging directories is
+all it takes to back out of a push that hit a conflict or an error.
+"""
+
+import logging
+import os
+import queue
+import shutil
+from   subprocess import Popen, PIPE
+import tarfile
+import tempfile
+import threading
+
+import p4gf_bulk
+import p4gf_util
+
+LOG = logging.getLogger(__name__)
+
+
+class GitModes:
+    """Git file mode of every file as of the most recently copied commit.
+
+    Seeded lazily from a single 'git ls-tree' of the commit the push starts
+    from, then kept current with record(). Lets G2P see executable bit
+    changes without stat-ing either side, and the stager see whether the
+    tree has any .gitattributes files.
+    """
+
+    def __init__(self, start_at):
+        self.start_at = start_at
+        self.modes = None
+        self.attributes = set()
+
+    def _load(self):
+        """Seed modes from start_at. NOP if already loaded."""
+        if self.modes is not None:
+            return
+        self.modes = {}
+        if not self.start_at or self.start_at == '0'*40:
+            return
+        d = p4gf_util.popen(['git', 'ls-tree', '-r', '-z', '--full-tree',
+                             self.start_at])
+        for entry in d['out'].split('\0'):
+            if not entry:
+                continue
+            # entry is: mode SP type SP sha1 TAB path
+            (info, path) = entry.split('\t', 1)
+            self._set(path, info.split(' ')[0])
+
+    def _set(self, path, mode):
+        """Record path's mode, None if it no longer exists."""
+        if mode:
+            self.modes[path] = mode
+        else:
+            self.modes.pop(path, None)
+        if os.path.basename(path) == '.gitattributes':
+            if mode:
+                self.attributes.add(path)
+            else:
+                self.attributes.discard(path)
+
+    def get(self, path):
+        """Return the Git file mode of path, or None if path does not exist."""
+        self._load()
+        return self.modes.get(path)
+
+    def has_attributes(self):
+        """Does the tree hold a .gitattributes file anywhere?"""
+        self._load()
+        return bool(self.attributes)
+
+    def record(self, blobs):
+        """Apply one commit's file actions."""
+        self._load()
+        for blob in blobs:
+            if blob['action'] == 'M':
+                self._set(blob['path'], blob['mode'])
+            elif blob['action'] == 'D':
+                self._set(blob['path'], None)
+            elif blob['action'] == 'R':
+                mode = self.modes.get(blob['path'])
+                self._set(blob['path'], None)
+                if mode:
+                    self._set(blob['topath'], mode)
+            elif blob['action'] == 'C':
+                mode = self.modes.get(blob['path'])
+                if mode:
+                    self._set(blob['topath'], mode)
+
+
+class StagedCommit:
+    """One fast-export commit, with its file actions sorted into the two
+    passes G2P.copy_blobs() makes over them.
+
+    root is the staging directory holding this commit's file content, or
+    None if the content must come from a 'git checkout' of the commit.
+    """
+
+    def __init__(self, commit, root=None):
+        self.sha1 = commit['sha1']
+        self.root = root
+        # Pass 1: renames and copies, which do not batch.
+        self.moves = [b for b in commit['files'] if b['action'] in ('R', 'C')]
+        # Pass 2: adds, edits and deletes, batched by p4 command.
+        self.edits = [b for b in commit['files'] if b['action'] in ('M', 'D')]
+
+    def source(self, path):
+        """Where to read the content of path from."""
+        if self.root:
+            return os.path.join(self.root, path)
+        return path
+
+    def remove(self):
+        """Delete this commit's staging directory, if any."""
+        if self.root:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.root = None
+
+
+class CommitStager(threading.Thread):
+    """Thread that stages commits ahead of the submitter, at most depth
+    commits ahead.
+
+    Hand it the same fast-export command list the submitter walks, then
+    call get() once per commit, in order. Commits whose sha1 is in skip
+    are not staged.
+    """
+
+    def __init__(self, commands, parent_dir, start_at, depth, skip=None):
+        threading.Thread.__init__(self, name="g2p-stager")
+        self.daemon = True
+        self.commands = commands
+        self.skip = skip or {}
+        self.root = tempfile.mkdtemp(prefix='g2p-stage-', dir=parent_dir)
+        self.git_modes = GitModes(start_at)
+        self.staged = queue.Queue(depth)
+        self.stop = threading.Event()
+        self.cat_file = None
+
+    def run(self):
+        try:
+            self.cat_file = Popen(['git', 'cat-file', '--batch'],
+                                  stdin=PIPE, stdout=PIPE)
+            for command in self.commands:
+                if self.stop.is_set():
+                    break
+                if command['command'] == 'commit':
+                    self._put(self._stage(command))
+        # pylint: disable=W0703
+        # Catching too general exception
+        # Anything that goes wrong here is re-raised by get() in the
+        # submitter's thread.
+        except Exception as e:
+            LOG.error("staging failed", exc_info=True)
+            self._put(e)
+        finally:
+            if self.cat_file:
+                self.cat_file.stdin.close()
+                self.cat_file.wait()
+
+    def _put(self, item):
+        """Queue item for the submitter, giving up if told to stop."""
+        while not self.stop.is_set():
+            try:
+                self.staged.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+        if isinstance(item, StagedCommit):
+            item.remove()
+
+    def _stage(self, commit):
+        """Write one commit's new file content to a fresh staging directory."""
+        if 'merge' in commit or commit['sha1'] in self.skip:
+            # Rejected by G2P.copy_commit() anyway, or not copied at all.
+            self.git_modes.record(commit['files'])
+            return StagedCommit(commit)
+
+        wanted = []
+        for blob in commit['files']:
+            if blob['action'] == 'M':
+                wanted.append((blob['path'], blob['mode']))
+            elif blob['action'] == 'R':
+                wanted.append((blob['topath'], self.git_modes.get(blob['path'])))
+        self.git_modes.record(commit['files'])
+
+        # cat-file --batch is line-oriented; symlinks and submodules are
+        # not plain file content; and raw blobs skip the eol and filter
+        # conversion .gitattributes asks for. Let the submitter check
+        # those out.
+        if self.git_modes.has_attributes():
+            return StagedCommit(commit)
+        for (path, mode) in wanted:
+            if '\n' in path or not (mode and mode.startswith('100')):
+                return StagedCommit(commit)
+
+        root = tempfile.mkdtemp(prefix=commit['mark'] + '-', dir=self.root)
+        staged = StagedCommit(commit, root)
+        for (path, mode) in wanted:
+            self._write_blob(commit['sha1'], path, staged.source(path), mode)
+        return staged
+
+    def _write_blob(self, commit_sha1, path, dst, mode):
+        """Copy path as of commit_sha1 out of the object store into dst."""
+        self.cat_file.stdin.write("{}:{}\n".format(commit_sha1, path).encode())
+        self.cat_file.stdin.flush()
+        header = self.cat_file.stdout.readline().decode().split()
+        if len(header) != 3 or header[1] != 'blob':
+            raise RuntimeError("cannot stage {}:{}: {}"
+                               .format(commit_sha1, path, ' '.join(header)))
+        remaining = int(header[2])
+        dstdir = os.path.dirname(dst)
+        if not os.path.exists(dstdir):
+            os.makedirs(dstdir)
+        with open(dst, 'wb') as f:
+            while remaining:
+                chunk = self.cat_file.stdout.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise RuntimeError("cannot stage {}:{}: short read"
+                                       .format(commit_sha1, path))
+                f.write(chunk)
+                remaining -= len(chunk)
+        self.cat_file.stdout.read(1)    # trailing LF
+        os.chmod(dst, 0o755 if int(mode, 8) & 0o100 else 0o644)
+
+    def get(self, commit):
+        """Return the StagedCommit for commit, waiting for it if necessary.
+
+        Raises if staging failed.
+        """
+        item = self.staged.get()
+        if isinstance(item, Exception):
+            raise RuntimeError("staging failed: {}".format(item))
+        if item.sha1 != commit['sha1']:
+            item.remove()
+            raise RuntimeError("staged commit {} out of order, expected {}"
+                               .format(item.sha1, commit['sha1']))
+        return item
+
+    def abort(self):
+        """Stop staging, wait for the thread, and delete everything staged
+        but not yet submitted.
+        """
+        self.stop.set()
+        while True:
+            try:
+                item = self.staged.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, StagedCommit):
+                item.remove()
+        if self.is_alive():
+            self.join()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def _check_members(tar, root):
+    """Raise unless every member of tar extracts to somewhere inside root.
+
+    Git refuses such paths in a tree, but a pushed object store is not
+    to be trusted with the filesystem outside the staging directory.
+    """
+    real_root = os.path.realpath(root)
+    for member in tar.getmembers():
+        path = os.path.realpath(os.path.join(real_root, member.name))
+        if os.path.isabs(member.name) or not path.startswith(real_root + os.sep):
+            raise RuntimeError("cannot stage {}: outside staging directory"
+                               .format(member.name))
+        if not (member.isfile() or member.isdir() or member.issym()):
+            raise RuntimeError("cannot stage {}: not a file, directory or symlink"
+                               .format(member.name))
+
+
+def archive_commit(commit, parent_dir):
+    """Stage one commit's new file content with 'git archive' into a fresh
+    staging directory under parent_dir, and return its StagedCommit.
+
+    Slower than CommitStager, but handles anything a checkout would,
+    symlinks included, and needs no Git work tree.
+    """
+    root = tempfile.mkdtemp(prefix=commit['mark'] + '-', dir=parent_dir)
+    staged = StagedCommit(commit, root)
+    paths = ([b['path']   for b in staged.edits if b['action'] == 'M'] +
+             [b['topath'] for b in staged.moves if b['action'] == 'R'])
+    env = dict(os.environ)
+    env['GIT_LITERAL_PATHSPECS'] = '1'
+    try:
+        for chunk in p4gf_bulk.chunks(paths):
+            with tempfile.TemporaryFile(dir=parent_dir) as tar:
+                p = Popen(['git', 'archive', '--format=tar', commit['sha1'], '--']
+                          + chunk, stdout=tar, env=env)
+                p.wait()
+                if p.returncode:
+                    raise RuntimeError("cannot stage {}: git archive returned {}"
+                                       .format(commit['sha1'], p.returncode))
+                tar.seek(0)
+                with tarfile.open(fileobj=tar) as t:
+                    _check_members(t, root)
+                    t.extractall(root)
+    except:
+        staged.remove()
+        raise
+    return staged
@@ -5,6 +5,7 @@ import os
 import re
 import zlib
 from subprocess import Popen, PIPE
+import p4gf_bulk
 import p4gf_log
 import p4gf_p4msgid
 import p4gf_object_type
@@ -209,16 +210,11 @@ def edit_objects_with_views(ctx, existing_files):
     their 'views' attribute to reflect the newly associated view.
     """
     existing_names, view_mapping = build_view_mapping(existing_files)
-    bite_size = 1000
-    while len(existing_names):
-        bite = existing_names[:bite_size]
-        existing_names = existing_names[bite_size:]
-        ctx.p4gf.run("edit", bite)
+    p4gf_bulk.run_all(ctx.p4gf, ["edit"], existing_names)
     for views, names in view_mapping.items():
-        while len(names):
-            bite = names[:bite_size]
-            names = names[bite_size:]
-            ctx.p4gf.run("attribute", "-p", "-n", "views", "-v", views, bite)
+        p4gf_bulk.run_all(ctx.p4gf,
+                          ["attribute", "-p", "-n", "views", "-v", views],
+                          names)
 
 
 class GitMirror:
@@ -297,11 +293,8 @@ class GitMirror:
         treecount = 0
         commitcount = 0
         # Add new files to the object cache.
-        bite_size = 1000
-        while len(add_files):
-            bite = add_files[:bite_size]
-            add_files = add_files[bite_size:]
-            result = ctx.p4gf.run("add", "-t", "binary", bite)
+        for result in p4gf_bulk.run_chunked(ctx.p4gf, ["add", "-t", "binary"],
+                                            add_files):
             for m in [m for m in ctx.p4gf.messages
                       if (m.msgid != p4gf_p4msgid.MsgDm_OpenUpToDate or
                           m.dict['action'] != 'add')]:
@@ -321,10 +314,9 @@ class GitMirror:
                         commitcount += 1
         LOG.debug("Added {} commits and {} trees".format(commitcount, treecount))
         # Set the 'views' attribute on the opened files.
-        while len(added_files):
-            bite = added_files[:bite_size]
-            added_files = added_files[bite_size:]
-            ctx.p4gf.run("attribute", "-p", "-n", "views", "-v", self.view_name, bite)
+        p4gf_bulk.run_all(ctx.p4gf,
+                          ["attribute", "-p", "-n", "views", "-v", self.view_name],
+                          added_files)
         return files_not_added
 
     def add_objects_to_p4(self, ctx):
@@ -352,16 +344,14 @@ class GitMirror:
                 with self.perf.timer[P4_FSTAT]:
                     # Need to use fstat to get the 'views' attribute for existing
                     # files, which we can't know until we use fstat to find out.
-                    bite_size = 1000
                     LOG.debug("using fstat to optimize add")
                     original_count = len(add_files)
                     ctx.p4gf.handler = FilterAddFstatHandler(self.view_name)
                     # spoon-feed p4 to avoid blowing out memory
-                    while len(add_files):
-                        bite = add_files[:bite_size]
-                        add_files = add_files[bite_size:]
-                        # Try to get only the information we really need.
-                        ctx.p4gf.run("fstat", "-Oa", "-T", "depotFile, attr-views", bite)
+                    # Try to get only the information we really need.
+                    p4gf_bulk.run_all(ctx.p4gf,
+                                      ["fstat", "-Oa", "-T", "depotFile, attr-views"],
+                                      add_files)
                     add_files = ctx.p4gf.handler.files
                     existing_files = ctx.p4gf.handler.existing
                     ctx.p4gf.handler = None
@@ -238,6 +238,22 @@ def _can_push(pull, push):
         return True
     return None
 
+def _fetch_groups_and_default(p4, p4user):
+    """Return a dict of every group p4user belongs to, and the default
+    permission counter's value.
+    """
+    group_list = p4.run('groups', '-i', p4user)
+    group_dict = {group['group']:group for group in group_list}
+    LOG.debug("group_dict.keys()={}".format(group_dict.keys()))
+
+    value = p4gf_util.first_value_for_key(
+                p4.run('counter', '-u', p4gf_const.P4GF_COUNTER_PERMISSION_GROUP_DEFAULT),
+                'value')
+    if value == '0':
+        value = DEFAULT_PERM
+    LOG.debug("counter={}".format(value))
+    return (group_dict, value)
+
 def _to_char(x):
     """Convert True/False/None to 1/0/' ' for shorter printing."""
     return { True  : '1',
@@ -284,11 +300,27 @@ class ViewPerm:
     def for_user_and_view(cls, p4, p4user, view_name):
         """Factory to fetch user's permissions on a view."""
         LOG.debug("for_user_and_view() {u} {v}".format(u=p4user, v=view_name))
+        (group_dict, value) = _fetch_groups_and_default(p4, p4user)
+        return cls._from_groups(p4user, view_name, group_dict, value)
 
-        group_list = p4.run('groups', '-i', p4user)
-        group_dict = {group['group']:group for group in group_list}
-        LOG.debug("group_dict.keys()={}".format(group_dict.keys()))
+    @classmethod
+    def for_user_and_views(cls, p4, p4user, view_names):
+        """Factory to fetch user's permissions on many views at once.
+
+        Same answers as for_user_and_view() for each view, but from a
+        single 'p4 groups' and default counter fetch.
+        """
+        LOG.debug("for_user_and_views() {u} {n} views"
+                  .format(u=p4user, n=len(view_names)))
+        (group_dict, value) = _fetch_groups_and_default(p4, p4user)
+        return [cls._from_groups(p4user, view_name, group_dict, value)
+                for view_name in view_names]
 
+    @classmethod
+    def _from_groups(cls, p4user, view_name, group_dict, value):
+        """Build one view's permissions from already fetched groups and
+        default counter value.
+        """
         vp = ViewPerm()
         vp.p4user_name = p4user
         vp.view_name   = view_name
@@ -298,14 +330,8 @@ class ViewPerm:
         vp.global_pull = p4gf_const.P4GF_GROUP_PULL                             in group_dict
         vp.global_push = p4gf_const.P4GF_GROUP_PUSH                             in group_dict
 
-        value = p4gf_util.first_value_for_key(
-                    p4.run('counter', '-u', p4gf_const.P4GF_COUNTER_PERMISSION_GROUP_DEFAULT),
-                    'value')
-        if value == '0':
-            value = DEFAULT_PERM
         vp.default_pull = value == PERM_PULL
         vp.default_push = value == PERM_PUSH
-        LOG.debug("counter={}".format(value))
 
         LOG.debug(vp)
         return vp
@@ -20,6 +20,7 @@ import time
 import P4
 import p4gf_const
 from p4gf_create_p4 import connect_p4
+import p4gf_fact_cache
 import p4gf_group
 import p4gf_log
 import p4gf_p4msg
@@ -194,7 +195,19 @@ def _global_init(p4):
 
 def init(p4):
     """Ensure both global and host-specific initialization are completed.
+
+    Once done, nothing undoes it but p4gf_delete_repo.py: trust a recent
+    answer from p4gf_fact_cache rather than read four counters again.
     """
+    fact = "init:" + p4gf_util.get_object_client_name()
+    if p4gf_fact_cache.get(p4, fact):
+        return
+    _init(p4)
+    p4gf_fact_cache.put(p4, fact)
+
+
+def _init(p4):
+    """Ensure both global and host-specific initialization are completed."""
     started_counter = p4gf_const.P4GF_COUNTER_INIT_STARTED
     complete_counter = p4gf_const.P4GF_COUNTER_INIT_COMPLETE
     _maybe_perform_init(p4, started_counter, complete_counter, _global_init)
@@ -217,6 +230,7 @@ def init(p4):
                 client=client_name)]
         p4gf_util.ensure_spec_values(p4, "client", client_name,
                 {'Root': p4gf_dir, 'View': view})
+    p4gf_fact_cache.forget(p4, p4gf_util.client_fact_name(client_name))
 
 
 def main():
@@ -238,6 +252,8 @@ def main():
     LOG.debug("connected to P4 at %s", p4.port)
     p4gf_util.reset_git_enviro()
 
+    # Check everything for real, and make every later request do so too.
+    p4gf_fact_cache.forget(p4)
     init(p4)
 
     return 0
@@ -31,6 +31,7 @@ import p4gf_const
 import p4gf_copy_p2g
 import p4gf_context   # Intentional mis-sequence avoids pylint Similar lines in 2 files
 from   p4gf_create_p4 import connect_p4
+import p4gf_fact_cache
 import p4gf_group
 import p4gf_init
 import p4gf_lock
@@ -221,9 +222,19 @@ def init_repo(p4, view_name):
 
     p4gf_dir    = p4gf_util.p4_to_p4gf_dir(p4)
     view_dirs = p4gf_view_dirs.from_p4gf_dir(p4gf_dir, view_name)
+
+    # Recently found complete? Then it still is: only p4gf_delete_repo.py
+    # takes a repo apart, and it deletes GIT_DIR too.
+    fact = "repo:" + view_name
+    if p4gf_fact_cache.get(p4, fact) and os.path.isdir(view_dirs.GIT_DIR):
+        return INIT_REPO_EXISTS
+
     result = create_p4_client(p4, view_name, client_name, view_dirs.p4root)
     if result > INIT_REPO_OK:
         return result
+    p4gf_fact_cache.forget(p4, p4gf_util.client_fact_name(client_name))
+    if result == INIT_REPO_OK:
+        p4gf_fact_cache.forget(p4, p4gf_util.VIEW_LIST_FACT)
     create_perm_groups(p4, view_name)
     p4gf_copy_p2g.create_git_repo(view_dirs.GIT_DIR)
     ensure_deny_rewind(view_dirs.GIT_WORK_TREE)
@@ -231,6 +242,7 @@ def init_repo(p4, view_name):
     create_p4_client_root(view_dirs.p4root)
     p4gf_rc.update_file(view_dirs.rcfile, client_name, view_name)
     LOG.debug("repository creation for %s complete", view_name)
+    p4gf_fact_cache.put(p4, fact)
     # return the result of creating the client, to indicate if the client
     # had already been set up or not
     return result
@@ -3,9 +3,9 @@
 """Acquire and release a lock using p4 counters."""
 
 import calendar
+import fcntl
 import logging
 import math
-import multiprocessing
 import os
 import sys
 import time
@@ -18,12 +18,24 @@ import p4gf_const
 import p4gf_util
 
 LOG = logging.getLogger(__name__)
+METRICS_LOG = LOG.getChild("metrics")
 
 # time.sleep() accepts a float, which is how you get sub-second sleep durations.
 MS = 1.0 / 1000.0
 
-# How often we retry to acquire the lock.
-_RETRY_PERIOD = 100 * MS
+# How long we wait between polls of the lock: starts short, doubles after
+# every poll that finds the queue has not moved, up to a ceiling. Keeps p4d
+# from drowning in counter traffic when many processes wait on one lock.
+_BACKOFF_MIN_SECS = 25 * MS
+_BACKOFF_MAX_SECS = 2.0
+
+# If "now serving" has not moved for this long, check whether the lock is
+# sitting free (the waiter whose turn it is gave up or died) or held by a
+# dead process, and if so move the queue along. The waiter whose turn it is
+# may be asleep for up to _BACKOFF_MAX_SECS before it notices the lock is
+# free, so give it twice that. Waiters further back wait proportionally
+# longer, so that only one of them checks at a time.
+_TURN_TIMEOUT_SECS = 2 * _BACKOFF_MAX_SECS
 
 # If we cannot acquire the lock within 10 seconds, give up. Someone else
 # is hogging the lock, and it's better to give up than to sit here
@@ -43,6 +55,10 @@ HEARTBEAT_TIMEOUT_SECS = 60
 # Rate for updating heartbeat counter, in seconds
 HEART_RATE = 1
 
+# How often we check whether someone has canceled our lock, in seconds.
+# Each check is a counter read, too many for every changelist or object.
+CANCEL_CHECK_SECS = 2
+
 
 class CounterLock:
     """An object that acquires a lock when created, releases when
@@ -50,6 +66,12 @@ class CounterLock:
     the heartbeat counter will be updated on a regular basis via a
     subprocess.
 
+    Waiters are served in order: each takes a ticket from one counter and
+    waits until a second, "now serving" counter reaches its turn, which
+    every release advances. Only the waiter whose turn it is tries for the
+    lock itself. Each acquisition reports its wait time, hold time and
+    queue depth to the "metrics" child of this module's log.
+
     with p4gf_lock.CounterLock(p4, "mylock") as lock:
         ... do stuff ...
         # Call periodically to ward off any future watchdog timer,
@@ -72,7 +94,13 @@ class CounterLock:
         self.__heartbeat_content = None
         self.__heartbeat_only    = heartbeat_only
         self.__auto_beat         = False
-        self.__event             = None
+        self.__beating           = False
+        self.__canceled          = False
+        self.__cancel_check_time = None
+        self.__wait_secs         = None
+        self.__queue_depth       = None
+        self.__attempts          = 0
+        self.__ticket            = None
 
     def __enter__(self):
         self.acquire(self.__timeout_secs__)
@@ -91,6 +119,113 @@ class CounterLock:
         """Who owns the lock."""
         return "{counter}_heartbeat".format(counter=self.counter_name())
 
+    def ticket_counter_name(self):
+        """Last ticket handed out to a waiter."""
+        return "{counter}_ticket".format(counter=self.counter_name())
+
+    def serving_counter_name(self):
+        """Number of tickets done with the lock."""
+        return "{counter}_serving".format(counter=self.counter_name())
+
+    def abandoned_counter_name(self, ticket):
+        """Set while ticket's waiter has given up, until its turn is skipped."""
+        return "{counter}_abandoned_{ticket}".format(counter=self.counter_name(),
+                                                     ticket=ticket)
+
+    def _counter_value(self, name):
+        """Return counter name's value as an int, 0 if unset."""
+        value = p4gf_util.first_value_for_key(
+                self.__p4__.run('counter', '-u', name),
+                'value')
+        return int(value) if value else 0
+
+    def _counter_increment(self, name):
+        """Atomically increment counter name, return its new value as an int."""
+        return int(p4gf_util.first_value_for_key(
+                self.__p4__.run('counter', '-u', '-i', name),
+                'value'))
+
+    def _advance_serving(self, done_ticket=None):
+        """Record that ticket done_ticket is done with the lock: by default
+        the ticket whose turn it is now.
+
+        Sets "now serving" rather than incrementing it, so that a ticket
+        finished twice (skipped by one waiter and released by its owner, or
+        skipped by two waiters at once) moves the queue along only once, and
+        "now serving" never runs ahead of the tickets handed out.
+        """
+        serving = self._counter_value(self.serving_counter_name())
+        if done_ticket is None:
+            done_ticket = serving + 1
+        if serving < done_ticket:
+            self.__p4__.run('counter', '-u', self.serving_counter_name(),
+                            str(done_ticket))
+
+    def _release_abandoned(self, holder):
+        """The lock is held by a dead process: release it for them."""
+        LOG.debug("releasing the abandoned lock {}".format(holder))
+        # Pretend we have the lock so we can release it. It was not
+        # our ticket that held it, but the one whose turn it is.
+        ticket = self.__ticket
+        self.__ticket = None
+        self.__has__ = True
+        self.release()
+        self.__ticket = ticket
+
+    def _abandon(self, ticket):
+        """We stop waiting for ticket's turn. Say so, so that the waiters
+        behind us skip it at once instead of waiting out turn timeouts. If
+        its turn has already come, it is done with the lock: next, please.
+        """
+        with self.__p4__.at_exception_level(P4.RAISE_NONE):
+            self.__p4__.run('counter', '-u',
+                            self.abandoned_counter_name(ticket), '1')
+            if ticket <= self._counter_value(self.serving_counter_name()) + 1:
+                self._advance_serving(ticket)
+                self.__p4__.run('counter', '-u', '-d',
+                                self.abandoned_counter_name(ticket))
+
+    def _skip_abandoned(self, serving):
+        """If the waiter for ticket serving + 1 gave up, skip its turn.
+        Return True if the queue moved.
+        """
+        ticket = serving + 1
+        if not self._counter_value(self.abandoned_counter_name(ticket)):
+            return False
+        LOG.debug("skipping abandoned ticket {} for {}"
+                  .format(ticket, self.counter_name()))
+        self._advance_serving(ticket)
+        with self.__p4__.at_exception_level(P4.RAISE_NONE):
+            self.__p4__.run('counter', '-u', '-d',
+                            self.abandoned_counter_name(ticket))
+        return True
+
+    def _move_queue_along(self, serving, distance, still_secs):
+        """"Now serving" has stayed at serving for still_secs, with distance
+        tickets between it and ours. If the waiter whose turn it is gave
+        up, skip its ticket now. Otherwise, once still_secs is long enough
+        for our distance: if the lock is free, nobody is coming for it:
+        skip the ticket whose turn it is. If the lock is held by a dead
+        process, release it for them.
+
+        Return True if the queue moved.
+        """
+        if self._skip_abandoned(serving):
+            return True
+        if still_secs < _TURN_TIMEOUT_SECS * distance:
+            return False
+        if self._counter_value(self.counter_name()) == 0:
+            # Skip ticket serving + 1, and only that one: if another
+            # waiter already skipped it, there is nothing left to do.
+            LOG.debug("skipping abandoned ticket for {}".format(self.counter_name()))
+            self._advance_serving(serving + 1)
+            return True
+        holder = self.get_heartbeat()
+        if holder and not check_holder_alive(holder):
+            self._release_abandoned(holder)
+            return True
+        return False
+
     def _acquire_attempt(self):
         """Attempt an atomic increment. If the result is 1, then we now
         own the lock. Any other value means somebody else owns the
@@ -118,30 +253,56 @@ class CounterLock:
             return
 
         start = time.time()
+        ticket  = self._counter_increment(self.ticket_counter_name())
+        serving = self._counter_value(self.serving_counter_name())
+        self.__ticket = ticket
+        # Tickets still ahead of ours, including the lock holder's.
+        self.__queue_depth = max(0, ticket - serving - 1)
+        self.__attempts = 0
+        try:
+            self._wait_for_turn(ticket, serving, start, timeout_secs)
+        finally:
+            if not self.__has__:
+                self._abandon(ticket)
+                self.__ticket = None
+
+    def _wait_for_turn(self, ticket, serving, start, timeout_secs):
+        """acquire()'s polling loop: return holding the lock, or raise."""
+        moved_time = start
+        backoff = _BACKOFF_MIN_SECS
         while True:
-            self.__has__ = self._acquire_attempt()
-            if self.__has__:
-                self.__acquisition_time = time.time()
-                self.update_heartbeat()
-                self._start_pacemaker()
-                self._create_log_timer()
-                self._test_view_sleep_after_acquire()
-                return
-
-            # Check on the lock holder's status, maybe clear the lock.
-            holder = self.get_heartbeat()
-            if holder and not check_holder_alive(holder):
-                LOG.debug("releasing the abandoned lock {}".format(holder))
-                # Pretend we have the lock so we can release it.
-                self.__has__ = True
-                self.release()
-                # Skip the timeout logic and loop around immediately.
+            # Our turn, or some ticket ahead of ours was skipped.
+            if ticket <= serving + 1:
+                self.__attempts += 1
+                self.__has__ = self._acquire_attempt()
+                if self.__has__:
+                    self.__acquisition_time = time.time()
+                    self.__wait_secs = self.__acquisition_time - start
+                    self.update_heartbeat()
+                    self._start_pacemaker()
+                    self._create_log_timer()
+                    self._test_view_sleep_after_acquire()
+                    return
+
+                # Check on the lock holder's status, maybe clear the lock.
+                holder = self.get_heartbeat()
+                if holder and not check_holder_alive(holder):
+                    self._release_abandoned(holder)
+                    # Skip the timeout logic and loop around immediately.
+                    continue
+
+            elif self._move_queue_along(serving, ticket - serving - 1,
+                                        time.time() - moved_time):
+                serving = self._counter_value(self.serving_counter_name())
+                moved_time = time.time()
+                backoff = _BACKOFF_MIN_SECS
                 continue
 
             # Stop waiting if run out of time. Tell the git user
             # who's hogging the lock.
             elapsed = time.time() - start
             if timeout_secs and timeout_secs <= elapsed:
+                self._report_metrics(timed_out=True)
                 holder = self.get_heartbeat()
                 msg = ('Unable to acquire lock: {}'
                        .format(self.counter_name()))
@@ -151,29 +312,32 @@ class CounterLock:
                 msg += '\nPlease try again after {0} minute(s).'.format(timeout)
                 raise RuntimeError(msg)
 
-            time.sleep(_RETRY_PERIOD)
+            time.sleep(backoff)
+            backoff = min(2 * backoff, _BACKOFF_MAX_SECS)
+            prev_serving = serving
+            serving = self._counter_value(self.serving_counter_name())
+            if serving != prev_serving:
+                # The queue moved: our turn may be close. Poll fast again.
+                moved_time = time.time()
+                backoff = _BACKOFF_MIN_SECS
 
     def _start_pacemaker(self):
         """If the lock has been acquired and it is configured to have
-        automatic updates of the heartbeat counter, then set up a child
-        process to regularly update the heartbeat.
+        automatic updates of the heartbeat counter, then hand it to this
+        process's pacemaker thread to regularly update the heartbeat.
         """
-        if self.__auto_beat and self.__event is None:
-            # Set up event flag for signaling subprocess to exit.
-            self.__event = multiprocessing.Event()
-            # Start the pacemaker to beat the heart automatically.
-            p = multiprocessing.Process(target=pacemaker,
-                    args=[self.__counter_name__, self.__event])
-            p.daemon = True
-            p.start()
+        if self.__auto_beat and not self.__beating:
+            self.__canceled = False
+            _pacemaker().add(self)
+            self.__beating = True
 
     def _stop_pacemaker(self):
-        """If the pacemaker has been set up, signal it to stop.
+        """If the pacemaker has been set up, take this lock back from it.
+        Returns once the pacemaker is no longer touching this lock.
         """
-        if self.__event is not None:
-            # Signal the pacemaker to exit normally.
-            self.__event.set()
-            self.__event = None
+        if self.__beating:
+            _pacemaker().remove(self)
+            self.__beating = False
 
     def _held_duration_seconds(self):
         '''
@@ -227,9 +391,14 @@ class CounterLock:
         if _log_timer_duration_seconds() <= self._held_duration_seconds():
             self._report_long_lock()
             LOG.warning("Released lock {}".format(self.counter_name()))
+        self._report_metrics()
         self.clear_heartbeat()
         self.__p4__.run('counter', '-u', '-d', self.counter_name())
+        # Next, please.
+        self._advance_serving(self.__ticket)
+        self.__ticket = None
         self.__has__ = False
+        self.__acquisition_time = None
 
         return True
 
@@ -239,7 +408,8 @@ class CounterLock:
 
     def autobeat(self):
         """Enable keeping the heartbeat counter updated automatically via
-        a subprocess. This applies to the next acquisition of the lock.
+        a background thread. This applies to the next acquisition of the
+        lock.
         """
         self.__auto_beat = True
 
@@ -278,11 +448,19 @@ class CounterLock:
         '''
         if not (self.has() or self.__heartbeat_only):
             return
+        # The pacemaker thread keeps it current.
+        if self.__beating:
+            return
+        self._write_heartbeat(self.__p4__)
 
+    def _write_heartbeat(self, p4):
+        '''
+        Write our heartbeat counter over connection p4, if due.
+        '''
         # don't update counter or log if nothing has changed
         current, last = self.heartbeat_content()
         if current != last:
-            self.__p4__.run('counter', '-u', self.heartbeat_counter_name(), current)
+            p4.run('counter', '-u', self.heartbeat_counter_name(), current)
             LOG.getChild("heartbeat").debug("update_heartbeat {name} {val}"
                  .format(name=self.heartbeat_counter_name(),
                          val=current))
@@ -321,6 +499,24 @@ class CounterLock:
         self._destroy_log_timer()
         self._create_log_timer()
 
+    def _report_metrics(self, timed_out=False):
+        '''
+        One line per acquisition for whoever watches lock pressure: how long
+        we waited, how long we held the lock, how many were ahead of us.
+        '''
+        if self.__wait_secs is None and not timed_out:
+            # Releasing a lock somebody else acquired.
+            return
+        METRICS_LOG.info("lock={name} wait_ms={wait} hold_ms={hold}"
+                         " queue_depth={depth} attempts={attempts}{timed_out}"
+                .format( name      = self.counter_name()
+                       , wait      = int((self.__wait_secs or 0) / MS)
+                       , hold      = int(self._held_duration_seconds() / MS)
+                       , depth     = self.__queue_depth
+                       , attempts  = self.__attempts
+                       , timed_out = " timed_out=1" if timed_out else ""))
+        self.__wait_secs = None
+
     def _report_long_lock(self):
         '''
         Unconditionally record our lock duration to log at level WARNING.
@@ -357,14 +553,16 @@ class CounterLock:
             self.__log_timer.cancel()
             self.__log_timer = None
 
-    def canceled(self):
+    def canceled(self, p4=None):
         '''
         Has our lock counter been cleared?
 
         This is one way to remote-kill a long-running Git Fusion task.
         '''
+        if p4 is None:
+            p4 = self.__p4__
         value = p4gf_util.first_value_for_key(
-                        self.__p4__.run('counter', '-u', self.counter_name()),
+                        p4.run('counter', '-u', self.counter_name()),
                         'value')
 
         if value != "0":  # Compare as strings, "0" != int(0)
@@ -374,22 +572,109 @@ class CounterLock:
                   .format(name=self.counter_name(), value=value))
         return True
 
+    def canceled_recently(self):
+        '''
+        Cheap canceled(): cheap enough to call for every changelist.
+
+        If the pacemaker beats this lock, it also checks for us: return
+        what it last saw. If not, ask the server no more often than every
+        CANCEL_CHECK_SECS, and return False in between.
+        '''
+        if self.__beating:
+            return self.__canceled
+        now = time.time()
+        if (    self.__cancel_check_time
+            and now - self.__cancel_check_time < CANCEL_CHECK_SECS):
+            return self.__canceled
+        self.__cancel_check_time = now
+        self.__canceled = self.canceled()
+        return self.__canceled
+
+    def _pacemaker_beat(self, p4, check_canceled):
+        '''
+        Called by the pacemaker thread, over its own connection p4.
+        '''
+        self._write_heartbeat(p4)
+        if check_canceled and not self.__canceled:
+            self.__canceled = self.canceled(p4)
+
 
-def pacemaker(view_name, event):
-    """As long as event flag is clear, update heartbeat of named lock.
+class Pacemaker(threading.Thread):
+    """One thread per process that keeps the heartbeat counter of every
+    auto-beating lock current, and watches those locks for cancellation.
+
+    Talks to Perforce over a connection of its own, opened the first time
+    there is a lock to beat and kept for the life of the process: P4
+    connections are not safe to share between threads.
     """
-    # Running in a separate process, need to establish our own P4 connection
-    # and set up a heartbeat-only lock to update the heartbeat of the lock
-    # associated with the view.
-    p4 = p4gf_create_p4.connect_p4(client=p4gf_util.get_object_client_name())
-    with p4:
-        lock = CounterLock(p4, view_name, heartbeat_only=True)
-        LOG.debug("starting pacemaker for lock {}".format(view_name))
-        while not event.is_set():
-            lock.update_heartbeat()
-            event.wait(HEART_RATE)
-        lock.clear_heartbeat()
-        LOG.debug("stopping pacemaker for lock {}".format(view_name))
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="p4gf-pacemaker")
+        self.daemon = True
+        self.locks = set()
+        # Held while beating, so that remove() waits out any beat in flight.
+        self.mutex = threading.Lock()
+        self.wake = threading.Event()
+        self.p4 = None
+
+    def add(self, lock):
+        """Start beating lock."""
+        with self.mutex:
+            self.locks.add(lock)
+        self.wake.set()
+
+    def remove(self, lock):
+        """Stop beating lock."""
+        with self.mutex:
+            self.locks.discard(lock)
+
+    def run(self):
+        cancel_check_time = 0
+        while True:
+            self.wake.wait(HEART_RATE)
+            self.wake.clear()
+            now = time.time()
+            check_canceled = CANCEL_CHECK_SECS <= now - cancel_check_time
+            with self.mutex:
+                if not self.locks:
+                    continue
+                if check_canceled:
+                    cancel_check_time = now
+                try:
+                    self._beat(check_canceled)
+                # pylint: disable=W0703
+                # Catching too general exception
+                # A missed beat is not worth dying for: try again next time.
+                except Exception:
+                    LOG.warning("pacemaker beat failed", exc_info=True)
+                    self.p4 = None
+
+    def _beat(self, check_canceled):
+        """Beat every lock once."""
+        if not self.p4 or not self.p4.connected():
+            self.p4 = p4gf_create_p4.connect_p4(
+                                client=p4gf_util.get_object_client_name())
+            if not self.p4:
+                return
+        for lock in self.locks:
+            # pylint: disable=W0212
+            # Access to a protected member of a client class
+            # Only the pacemaker calls this.
+            lock._pacemaker_beat(self.p4, check_canceled)
+
+
+_pacemaker_thread = None
+_pacemaker_mutex = threading.Lock()
+
+
+def _pacemaker():
+    """Return this process's Pacemaker, starting it if necessary."""
+    global _pacemaker_thread
+    with _pacemaker_mutex:
+        if _pacemaker_thread is None:
+            _pacemaker_thread = Pacemaker()
+            _pacemaker_thread.start()
+        return _pacemaker_thread
 
 
 def check_holder_alive(holder):
@@ -438,6 +723,17 @@ def view_lock_name(view_name):
     return "git_fusion_view_{}_lock".format(view_name)
 
 
+def view_lock_counter_names(view_name):
+    '''
+    Return the names of all the counters behind a view's lock.
+    '''
+    lock = CounterLock(None, view_lock_name(view_name))
+    return [ lock.counter_name()
+           , lock.heartbeat_counter_name()
+           , lock.ticket_counter_name()
+           , lock.serving_counter_name() ]
+
+
 def view_lock(p4, view_name):
     '''
     Return a lock for a single view.
@@ -447,6 +743,70 @@ def view_lock(p4, view_name):
     return lock
 
 
+# Files in a view's container directory behind RefsLock.
+REFS_LOCK_FILE = "refs.lock"
+REFS_LOCK_WRITER_FILE = "refs.lock.writer"
+
+
+class RefsLock:
+    """A host-local reader/writer lock on one view's mirror Git repo refs.
+
+    git-upload-pack serves whatever refs are already published, and holds
+    this lock shared for as long as it runs, so any number of fetches run
+    at once. P2G holds it exclusive only while it moves refs, so that no
+    reader sees a half-moved set.
+
+    A writer passes through a turnstile before it waits for the readers to
+    drain, and holds it until it gets the lock, so that a steady stream of
+    fetches cannot starve it. Readers pass through the same turnstile on
+    the way in.
+
+    flock() locks go away with the process that holds them: no heartbeat,
+    no abandoned lock to clean up.
+
+    with p4gf_lock.RefsLock(ctx.view_dirs, exclusive=True):
+        ... move refs ...
+    """
+
+    def __init__(self, view_dirs, exclusive=False):
+        self.path = os.path.join(view_dirs.view_container, REFS_LOCK_FILE)
+        self.writer_path = os.path.join(view_dirs.view_container,
+                                        REFS_LOCK_WRITER_FILE)
+        self.exclusive = exclusive
+        self.__file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, _traceback):
+        self.release()
+        return False    # False = do not squelch exception
+
+    def acquire(self):
+        """Block until we hold the lock."""
+        start = time.time()
+        turnstile = open(self.writer_path, 'a')
+        try:
+            fcntl.flock(turnstile, fcntl.LOCK_EX)
+            self.__file = open(self.path, 'a')
+            fcntl.flock(self.__file,
+                        fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        finally:
+            turnstile.close()
+        LOG.debug("acquired {kind} {path} pid={pid} after {ms} ms"
+                  .format( kind = "exclusive" if self.exclusive else "shared"
+                         , path = self.path
+                         , pid  = os.getpid()
+                         , ms   = int((time.time() - start) / MS)))
+
+    def release(self):
+        """If we hold the lock, release it. If not, NOP."""
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+
+
 def view_lock_heartbeat_only(p4, view_name):
     '''
     Return a lock that only updates an existing heartbeat.
@@ -0,0 +1,280 @@
+#! /usr/bin/env python3.2
+"""Keep each view's mirror Git repo packed, outside any request.
+
+P2G used to run 'git gc' at the end of every import, in the path of the
+fetch that triggered it. That is a full repack of the whole repo, minutes
+for a big view, while the user waits. And it wrote neither reachability
+bitmaps nor a commit-graph, which are what make git-upload-pack fast.
+
+Now P2G just calls request(), which marks the view as needing
+maintenance and, unless P4GF_MAINTENANCE_SPAWN is off, starts this
+script in the background for that view. Or run it from cron:
+
+    p4gf_maintenance.py --all
+
+Per view, maintain() does as little as it can:
+
+    - nothing at all if the view was maintained less than
+      P4GF_MAINTENANCE_MIN_SECS ago (unless --force),
+    - a full repack, with bitmaps, packed refs and expired unreachable
+      objects pruned, once there are P4GF_MAINTENANCE_MAX_PACKS packs,
+      the repo has no bitmap (a geometric repack that rolls up the
+      largest pack drops it), or the last full repack is older than
+      P4GF_MAINTENANCE_FULL_SECS (or --full),
+    - otherwise, if anything was imported or loose objects reach
+      P4GF_MAINTENANCE_LOOSE_OBJECTS: a geometric repack, which rolls up
+      only the small packs each import leaves, or where Git is too old
+      for that, packs just the loose objects,
+    - then a fresh commit-graph.
+
+All of this is safe alongside fetches, pushes and imports: Git writes
+each new pack, index, bitmap and commit-graph beside the old and renames
+it into place, and unreachable objects younger than two weeks stay put
+in case a concurrent import is about to reference them. So maintenance
+never takes the view lock, and holds the refs lock exclusive only for as
+long as 'git pack-refs' takes, so that no fetch sees refs half moved from
+loose files to packed-refs. It only keeps to
+one maintainer per view at a time, with a host-local flock() that a
+second maintainer does not wait for: it leaves the view to the first.
+"""
+
+import fcntl
+import os
+from   subprocess import Popen
+import sys
+import time
+
+import p4gf_const
+import p4gf_lock
+import p4gf_log
+import p4gf_util
+import p4gf_version
+import p4gf_view_dirs
+
+LOG = p4gf_log.for_module()
+
+# Files in a view's container directory.
+LOCK_FILE = "maintenance.lock"
+LAST_FILE = "maintenance.last"      # mtime: when maintenance last ran
+PENDING_FILE = "maintenance.pending"  # exists: imported since then
+FULL_FILE = "maintenance.full"      # mtime: when the last full repack ran
+
+# Unreachable objects younger than this survive a full repack.
+PRUNE_EXPIRE = "2.weeks.ago"
+
+
+def _path(view_dirs, name):
+    """One of the view's maintenance files."""
+    return os.path.join(view_dirs.view_container, name)
+
+
+def _touch(path):
+    """Create path, or update its mtime."""
+    with open(path, 'a'):
+        pass
+    os.utime(path, None)
+
+
+def _throttled(view_dirs):
+    """Was the view maintained less than P4GF_MAINTENANCE_MIN_SECS ago?"""
+    try:
+        last = os.path.getmtime(_path(view_dirs, LAST_FILE))
+    except OSError:
+        return False
+    min_secs = p4gf_util.const_to_int(p4gf_const.P4GF_MAINTENANCE_MIN_SECS)
+    return 0 <= time.time() - last < min_secs
+
+
+def request(view_dirs):
+    """P2G imported something: the view needs maintenance.
+
+    Mark it, and unless turned off or throttled, start maintenance for it
+    in the background. Return at once.
+    """
+    try:
+        _touch(_path(view_dirs, PENDING_FILE))
+    except OSError:
+        LOG.debug("cannot mark {} for maintenance"
+                  .format(view_dirs.view_container), exc_info=True)
+        return
+    if not p4gf_util.const_to_bool(p4gf_const.P4GF_MAINTENANCE_SPAWN):
+        return
+    if _throttled(view_dirs):
+        return
+
+    # No GIT_DIR or quarantine GIT_OBJECT_DIRECTORY from whatever git
+    # called us: maintenance says which repo it means.
+    env = {k: v for k, v in os.environ.items() if not k.startswith("GIT_")}
+    cmd = [ sys.executable, os.path.abspath(__file__)
+          , '--p4gf-dir', view_dirs.p4gf_dir
+          , os.path.basename(view_dirs.view_container) ]
+    LOG.debug("starting maintenance: {}".format(' '.join(cmd)))
+    with open(os.devnull, 'r+') as devnull:
+        Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull, env=env,
+              close_fds=True, start_new_session=True)
+
+
+def _git(git_dir, args):
+    """Run one git command against git_dir. Return True if it succeeded."""
+    result = p4gf_util.popen_no_throw(['git', '--git-dir=' + git_dir] + args)
+    return result['Popen'].returncode == 0
+
+
+def _count_objects(git_dir):
+    """Return (loose object count, pack count)."""
+    result = p4gf_util.popen_no_throw(['git', '--git-dir=' + git_dir,
+                                       'count-objects', '-v'])
+    counts = {}
+    for line in result['out'].splitlines():
+        (key, _sep, value) = line.partition(':')
+        if value.strip().isdigit():
+            counts[key.strip()] = int(value)
+    return (counts.get('count', 0), counts.get('packs', 0))
+
+
+def _has_bitmap(git_dir):
+    """Does any pack have a reachability bitmap?"""
+    pack_dir = os.path.join(git_dir, 'objects', 'pack')
+    try:
+        return any(name.endswith('.bitmap') for name in os.listdir(pack_dir))
+    except OSError:
+        return False
+
+
+def _full_due(view_dirs, packs):
+    """Is it time to repack everything, whatever the pack count?
+
+    When bitmaps are possible, a repo with packs but no bitmap needs
+    one. And a full repack every P4GF_MAINTENANCE_FULL_SECS drops the
+    unreachable objects incremental repacks leave behind.
+    """
+    if (packs and p4gf_version.git_version_supports_repack_bitmaps()
+            and not _has_bitmap(view_dirs.GIT_DIR)):
+        return True
+    try:
+        last = os.path.getmtime(_path(view_dirs, FULL_FILE))
+    except OSError:
+        return True
+    full_secs = p4gf_util.const_to_int(p4gf_const.P4GF_MAINTENANCE_FULL_SECS)
+    return not 0 <= time.time() - last < full_secs
+
+
+def _repack_full(view_dirs):
+    """Everything reachable into one pack, with bitmaps if we can."""
+    git_dir = view_dirs.GIT_DIR
+    cmd = ['repack', '-d', '-l', '-A', '--unpack-unreachable=' + PRUNE_EXPIRE]
+    if p4gf_version.git_version_supports_repack_bitmaps():
+        cmd.append('--write-bitmap-index')
+    ok = _git(git_dir, cmd)
+    with p4gf_lock.RefsLock(view_dirs, exclusive=True):
+        _git(git_dir, ['pack-refs', '--all', '--prune'])
+    _git(git_dir, ['prune', '--expire=' + PRUNE_EXPIRE])
+    if ok:
+        _touch(_path(view_dirs, FULL_FILE))
+    return ok
+
+
+def _repack_incremental(git_dir):
+    """Roll up the small packs and loose objects. Leave the big packs be."""
+    if p4gf_version.git_version_supports_geometric_repack():
+        return _git(git_dir, ['repack', '-d', '-l', '--geometric=2'])
+    return _git(git_dir, ['repack', '-d', '-l'])
+
+
+def _run(view_dirs, force, full):
+    """Maintain one view. Caller holds its maintenance lock."""
+    if not force and _throttled(view_dirs):
+        LOG.debug("{}: maintained recently, skipping"
+                  .format(view_dirs.view_container))
+        return
+    git_dir = view_dirs.GIT_DIR
+
+    # Clear it now, not after: an import during this run marks it again.
+    pending_path = _path(view_dirs, PENDING_FILE)
+    pending = os.path.exists(pending_path)
+    if pending:
+        os.unlink(pending_path)
+
+    (loose, packs) = _count_objects(git_dir)
+    max_packs = p4gf_util.const_to_int(p4gf_const.P4GF_MAINTENANCE_MAX_PACKS)
+    max_loose = p4gf_util.const_to_int(p4gf_const.P4GF_MAINTENANCE_LOOSE_OBJECTS)
+
+    start = time.time()
+    if full or packs >= max_packs or _full_due(view_dirs, packs):
+        kind = "full"
+        ok = _repack_full(view_dirs)
+    elif pending or loose >= max_loose:
+        kind = "incremental"
+        ok = _repack_incremental(git_dir)
+    else:
+        kind = None
+        ok = True
+    if kind and ok and p4gf_version.git_version_supports_commit_graph():
+        _git(git_dir, ['commit-graph', 'write', '--reachable'])
+
+    _touch(_path(view_dirs, LAST_FILE))
+    LOG.info("{view}: loose={loose} packs={packs} repack={kind} ok={ok}"
+             " seconds={secs:.1f}"
+             .format( view  = os.path.basename(view_dirs.view_container)
+                    , loose = loose
+                    , packs = packs
+                    , kind  = kind
+                    , ok    = ok
+                    , secs  = time.time() - start))
+
+
+def maintain(view_dirs, force=False, full=False):
+    """Maintain one view's mirror Git repo, unless another process already
+    is. force ignores P4GF_MAINTENANCE_MIN_SECS, full repacks everything.
+    """
+    if not os.path.isdir(view_dirs.GIT_DIR):
+        return
+    with open(_path(view_dirs, LOCK_FILE), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            LOG.debug("{}: already being maintained"
+                      .format(view_dirs.view_container))
+            return
+        _run(view_dirs, force, full)
+
+
+def _all_view_names(p4gf_dir):
+    """Every view with a directory on this host."""
+    views_dir = os.path.join(p4gf_dir, "views")
+    if not os.path.isdir(views_dir):
+        return []
+    return sorted(name for name in os.listdir(views_dir)
+                  if os.path.isdir(os.path.join(views_dir, name)))
+
+
+def main():
+    """Parse the command line and maintain the views it names."""
+    default_dir = os.path.join(os.path.expanduser('~'), p4gf_const.P4GF_DIR)
+    parser = p4gf_util.create_arg_parser(
+        "Packs Git Fusion's mirror Git repos, writes bitmaps and commit-graphs.")
+    parser.add_argument('--p4gf-dir', metavar="", default=default_dir,
+            help='Git Fusion directory, default={}'.format(default_dir))
+    parser.add_argument('--all', action='store_true',
+            help='maintain every view on this host')
+    parser.add_argument('--force', action='store_true',
+            help='ignore P4GF_MAINTENANCE_MIN_SECS')
+    parser.add_argument('--full', action='store_true',
+            help='repack everything, whatever the pack count')
+    parser.add_argument('views', metavar='view', nargs='*',
+            help='name of view to maintain')
+    args = parser.parse_args()
+
+    view_names = args.views
+    if args.all:
+        view_names = _all_view_names(args.p4gf_dir)
+    if not view_names:
+        parser.error("name a view, or --all")
+    for view_name in view_names:
+        maintain(p4gf_view_dirs.from_p4gf_dir(args.p4gf_dir, view_name),
+                 force=args.force, full=args.full)
+    return 0
+
+
+if __name__ == "__main__":
+    p4gf_log.run_with_exception_logger(main, write_to_stderr=True)
@@ -160,3 +160,8 @@ MsgDm_ExVIEW2               = MsgId( ES_DM, 477 ) # E_WARN  "%!%[%argc% - file(s
 MsgDm_ExFILE                = MsgId( ES_DM, 375 ) # E_WARN  "[%argc% - no|No] such file(s)." } ;
 MsgDm_ExPROTECT             = MsgId( ES_DM, 369 ) # 6513 "[%argc% - no|No] permission for operation on file(s)." } ;
 MsgDm_ExPROTECT2            = MsgId( ES_DM, 480 ) # 6624 "%!%[%argc% - no|No] permission for operation on file(s)." } ;
+
+MsgDb_MaxResults            = MsgId( ES_DB,   32 ) # E_FAILED "Request too large (over %maxResults%); see 'p4 help maxresults'." } ;
+MsgDb_MaxScanRows           = MsgId( ES_DB,   61 ) # E_FAILED "Too many rows scanned (over %maxScanRows%); see 'p4 help maxscanrows'." } ;
+
+MsgDm_ParallelNotEnabled    = MsgId( ES_DM, 796 ) # E_FAILED "Parallel file transfer must be enabled using %'net.parallel.max'%" } ;
@@ -0,0 +1,273 @@
+#! /usr/bin/env python3.2
+"""Serve repeated full clones of a view from a saved git-upload-pack response.
+
+A build farm clones the same view at the same tip over and over, and each
+time git-upload-pack walks and compresses the whole object graph again,
+to produce the very same bytes. With P4GF_UPLOAD_PACK_CACHE on, the auth
+server runs git-upload-pack through upload_pack() here instead, which
+sits between it and the client and speaks just enough of the pack
+protocol (version 0, the only one ssh clients use by default) to tell a
+full clone from anything else:
+
+    upload-pack: ref advertisement, flush
+    client:      want lines, flush, done
+
+No 'have' lines, no shallow or deepen lines, nothing else. For such a
+request, the response depends only on the advertisement (every ref and
+its sha1) and the want lines (including the client's capabilities, less
+its agent string). The first time, upload_pack() passes the request on
+and saves a copy of the response under a key made from those. The next
+identical request gets the saved copy, and git-upload-pack is told the
+client wants nothing.
+
+Anything else goes through to git-upload-pack untouched.
+
+A response saved for refs that have since moved can never match again:
+its key includes the old sha1s. invalidate() deletes them once P2G or a
+push has moved refs, and saving a new response deletes any saved for
+different refs.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+from   subprocess import call, Popen, PIPE
+import sys
+import tempfile
+import threading
+
+import p4gf_const
+import p4gf_util
+
+LOG = logging.getLogger(__name__)
+
+# Saved responses, one file each, in the view's container directory.
+CACHE_DIR = "pack-cache"
+
+_FLUSH = b'0000'
+_CHUNK = 64 * 1024
+
+
+def enabled():
+    """Is P4GF_UPLOAD_PACK_CACHE on?"""
+    return p4gf_util.const_to_bool(p4gf_const.P4GF_UPLOAD_PACK_CACHE)
+
+
+def cache_dir(view_dirs):
+    """Where a view's saved responses go."""
+    return os.path.join(view_dirs.view_container, CACHE_DIR)
+
+
+def invalidate(view_dirs):
+    """Refs moved: no saved response will ever match again. Delete them."""
+    shutil.rmtree(cache_dir(view_dirs), ignore_errors=True)
+
+
+def _read_exactly(f, size):
+    """Read exactly size bytes from f, or raise EOFError."""
+    chunks = []
+    while size:
+        chunk = f.read(size)
+        if not chunk:
+            raise EOFError("pack protocol: unexpected end of input")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _read_pkt(f):
+    """Read one pkt-line from f. Return (raw bytes, payload), where
+    payload is None for a flush-pkt.
+    """
+    head = _read_exactly(f, 4)
+    size = int(head, 16)
+    if size == 0:
+        return (head, None)
+    if size < 4:
+        raise ValueError("pack protocol: bad pkt-line length {}".format(head))
+    payload = _read_exactly(f, size - 4)
+    return (head + payload, payload)
+
+
+def _read_some(f):
+    """Return whatever f has ready, up to _CHUNK bytes, b'' at the end."""
+    if hasattr(f, 'read1'):
+        return f.read1(_CHUNK)
+    return f.read(_CHUNK)
+
+
+def _write(f, data):
+    """Write data to f now."""
+    f.write(data)
+    f.flush()
+
+
+def _want_key(payload):
+    """A want line, minus the client's agent string: the response does
+    not depend on which git version asked.
+    """
+    words = payload.rstrip(b'\n').split(b' ')
+    return b' '.join(w for w in words if not w.startswith(b'agent='))
+
+
+def _read_request(client_in):
+    """Read the client's request as far as we need to tell whether it is
+    a full clone.
+
+    Return (raw bytes read, list of want-key lines or None if the
+    request is not a plain full clone).
+    """
+    raw = []
+    wants = []
+    cacheable = True
+    while True:
+        (pkt, payload) = _read_pkt(client_in)
+        raw.append(pkt)
+        if payload is None:
+            break
+        if payload.startswith(b'want '):
+            wants.append(_want_key(payload))
+        else:
+            cacheable = False    # shallow, deepen, filter...
+    if not wants:
+        # Client wants nothing: nothing follows the flush.
+        return (b''.join(raw), None)
+    (pkt, payload) = _read_pkt(client_in)
+    raw.append(pkt)
+    if payload is None or payload.rstrip(b'\n') != b'done':
+        cacheable = False        # have lines: an incremental fetch
+    return (b''.join(raw), wants if cacheable else None)
+
+
+def _pump(src, dst, close_dst=False):
+    """Copy src to dst until src ends."""
+    try:
+        while True:
+            chunk = _read_some(src)
+            if not chunk:
+                break
+            _write(dst, chunk)
+    except (IOError, OSError):
+        pass
+    finally:
+        if close_dst:
+            try:
+                dst.close()
+            except (IOError, OSError):
+                pass
+
+
+def _pass_through(p, request, client_in, client_out):
+    """Give git-upload-pack the request read so far, then connect it to
+    the client for the rest of the conversation.
+    """
+    _write(p.stdin, request)
+    t = threading.Thread(target=_pump, args=(client_in, p.stdin, True),
+                         name="upload-pack-stdin")
+    # Still blocked reading the client when upload-pack is done: let it go.
+    t.daemon = True
+    t.start()
+    _pump(p.stdout, client_out)
+    return p.wait()
+
+
+def _serve_saved(p, path, client_out):
+    """Tell git-upload-pack the client wants nothing, and send the client
+    the saved response instead.
+    """
+    _write(p.stdin, _FLUSH)
+    p.stdin.close()
+    p.stdout.read()
+    p.wait()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(_CHUNK)
+            if not chunk:
+                break
+            client_out.write(chunk)
+    client_out.flush()
+    return 0
+
+
+def _serve_and_save(p, request, path, prefix, client_out):
+    """Pass the request to git-upload-pack, and save a copy of its
+    response at path if it succeeds. Delete responses saved for other
+    refs (names not starting with prefix).
+    """
+    dir_path = os.path.dirname(path)
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    _write(p.stdin, request)
+    p.stdin.close()
+    with tempfile.NamedTemporaryFile(dir=dir_path, prefix='tmp-',
+                                     delete=False) as f:
+        try:
+            while True:
+                chunk = _read_some(p.stdout)
+                if not chunk:
+                    break
+                f.write(chunk)
+                client_out.write(chunk)
+                client_out.flush()
+            code = p.wait()
+        except:
+            p.kill()
+            p.wait()
+            os.unlink(f.name)
+            raise
+    if code:
+        os.unlink(f.name)
+        return code
+    os.rename(f.name, path)
+    for name in os.listdir(dir_path):
+        if not name.startswith(prefix) and not name.startswith('tmp-'):
+            try:
+                os.unlink(os.path.join(dir_path, name))
+            except OSError:
+                pass
+    return code
+
+
+def upload_pack(view_dirs, cmd_list):
+    """Run git-upload-pack (cmd_list) for the client on our stdin and
+    stdout, answering plain full clones from the cache. Return its exit
+    code.
+    """
+    if 'version=2' in os.environ.get('GIT_PROTOCOL', ''):
+        # Not a conversation we know how to follow.
+        return call(cmd_list)
+    # Unbuffered: _pass_through() may leave a thread blocked reading it
+    # at exit, and a buffered reader's lock would stop Python exiting.
+    client_in = sys.stdin.buffer.raw
+    client_out = sys.stdout.buffer
+    p = Popen(cmd_list, stdin=PIPE, stdout=PIPE)
+    try:
+        # Ref advertisement: pass it on, remember it.
+        advert = []
+        while True:
+            (pkt, payload) = _read_pkt(p.stdout)
+            advert.append(pkt)
+            if payload is None:
+                break
+        _write(client_out, b''.join(advert))
+
+        (request, wants) = _read_request(client_in)
+        if wants is None:
+            return _pass_through(p, request, client_in, client_out)
+
+        prefix = hashlib.sha1(b''.join(advert)).hexdigest() + '-'
+        name = prefix + hashlib.sha1(b'\n'.join(wants)).hexdigest()
+        path = os.path.join(cache_dir(view_dirs), name)
+        if os.path.exists(path):
+            LOG.debug("full clone served from {}".format(path))
+            return _serve_saved(p, path, client_out)
+        LOG.debug("full clone, saving response as {}".format(path))
+        return _serve_and_save(p, request, path, prefix, client_out)
+    except (EOFError, ValueError) as e:
+        # Client or upload-pack gave up, or spoke a protocol we do not
+        # know. Whoever is still there has the stderr to say why.
+        LOG.debug("pack cache: {}".format(e))
+        if p.poll() is None:
+            p.kill()
+        return p.wait() or 1
@@ -18,6 +18,7 @@ import sys
 
 
 import p4gf_context
+import p4gf_create_p4
 from   p4gf_create_p4 import connect_p4
 import p4gf_lock
 import p4gf_log
@@ -59,9 +60,15 @@ def main():
     if not p4:
         return 2
 
-    view_name = p4gf_util.cwd_to_view_name()
+    # p4gf_auth_server.py already knows which view this is, and what its
+    # Context learned from Perforce.
+    handoff = p4gf_context.read_handoff()
+    if handoff and handoff.get('view_name'):
+        view_name = handoff['view_name']
+    else:
+        view_name = p4gf_util.cwd_to_view_name()
     view_lock = p4gf_lock.view_lock_heartbeat_only(p4, view_name)
-    ctx       = p4gf_context.create_context(view_name, view_lock)
+    ctx       = p4gf_context.create_context(view_name, view_lock, p4, handoff)
 
     # Read each input line (usually only one unless pushing multiple branches)
     # and pass to git-to-p4 copier.
@@ -85,4 +92,7 @@ def main():
     return 0
 
 if __name__ == "__main__":
-    p4gf_log.run_with_exception_logger(main, write_to_stderr=True)
+    try:
+        p4gf_log.run_with_exception_logger(main, write_to_stderr=True)
+    finally:
+        p4gf_create_p4.report_round_trips()
@@ -2,10 +2,19 @@
 
 """Wrapper for 'p4 protect' table."""
 
+import hashlib
+import logging
+import os
+import time
+
 import P4
 
+import p4gf_const
+import p4gf_fact_cache
 from   p4gf_path import enquote, dequote
 
+LOG = logging.getLogger(__name__)
+
 # privilege kevel constants
 LIST = 'list'
 READ = 'read'
@@ -83,10 +92,10 @@ def permission_includes(granted, requested):
 # Sam says "unmap" revokes ALL permissions for that path.
 #
 
-def _create_map_for_perm(protects_dict_list, requested_perm):
-    """Return a new MapApi instance that maps in all of
-    protects_dict_list depotFile lines that grant the requested_perm
-    and excludes all lines that exclude it.
+def _map_lines_for_perm(protects_dict_list, requested_perm):
+    """Return the P4.Map() lines that map in all of protects_dict_list
+    depotFile lines that grant the requested_perm and exclude all lines
+    that exclude it.
     """
 
     # Build a list of matching lines.
@@ -100,9 +109,15 @@ def _create_map_for_perm(protects_dict_list, requested_perm):
 
     # P4.Map() requires space-riddled paths to be quoted paths
     # to avoid accidentally splitting a # single path into lhs/rhs.
-    quoted = [enquote(x) for x in lines]
-    mapapi = P4.Map(quoted)
-    return mapapi
+    return [enquote(x) for x in lines]
+
+
+def _create_map_for_perm(protects_dict_list, requested_perm):
+    """Return a new MapApi instance that maps in all of
+    protects_dict_list depotFile lines that grant the requested_perm
+    and excludes all lines that exclude it.
+    """
+    return P4.Map(_map_lines_for_perm(protects_dict_list, requested_perm))
 
 
 class Protect:
@@ -110,7 +125,7 @@ class Protect:
     'p4 protects' lines grants a requested permission on a depotFile.
     """
 
-    def __init__(self, protects=None):
+    def __init__(self, protects=None, perm_to_lines=None, on_new_lines=None):
         # Ordered list of dicts, the result of 'p4 protects ...'.
         if protects is None:
             protects = []
@@ -120,6 +135,12 @@ class Protect:
         # Key = requested permission, Val = Map instance.
         self._perm_to_mapapi = {}
 
+        # Map lines already worked out, by ProtectsCache, and who to tell
+        # about any we have to work out ourselves.
+        # Key = requested permission, Val = list of P4.Map() lines.
+        self._perm_to_lines = perm_to_lines if perm_to_lines else {}
+        self._on_new_lines = on_new_lines
+
     @classmethod
     def from_protects(cls, protects_dict_list):
         """Create and return a new Protect instance seeded with the
@@ -136,7 +157,13 @@ class Protect:
         """
         mapapi = self._perm_to_mapapi.get(requested_perm)
         if not mapapi:
-            mapapi = _create_map_for_perm(self._protects_dict_list, requested_perm)
+            lines = self._perm_to_lines.get(requested_perm)
+            if lines is None:
+                lines = _map_lines_for_perm(self._protects_dict_list, requested_perm)
+                self._perm_to_lines[requested_perm] = lines
+                if self._on_new_lines:
+                    self._on_new_lines(requested_perm, lines)
+            mapapi = P4.Map(lines)
             self._perm_to_mapapi[requested_perm] = mapapi
         return mapapi
 
@@ -150,15 +177,139 @@ def _create_protect_for_user(p4, user):
     return Protect.from_protects(r)
 
 
+# Host-wide cache of 'p4 protects -u' results, in ~/.git-fusion.
+PROTECTS_CACHE_FILE = "protects-cache.json"
+
+
+def _int_const(value):
+    """A p4gf_const tunable as an int, 0 if unreadable."""
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+class ProtectsCache:
+    """This host's copy of each user's 'p4 protects -u' result, and the map
+    lines built from it, shared by every Git Fusion process on the host.
+
+    Good for as long as the protections table is unchanged. At most once
+    every P4GF_PROTECTS_CHECK_SECS, some process checksums 'p4 protect -o'
+    and throws everything away if it differs. Group membership changes do
+    not change the table, so each user's entry is also good for no more
+    than P4GF_PROTECTS_CACHE_SECS.
+
+    Concurrent processes each read the file, and replace it whole and
+    atomically (p4gf_fact_cache.write_json()). A process that loses a
+    race loses only what it would have added.
+
+    If git-fusion-user cannot read the protections table, there is no
+    checksum to trust, and nothing is cached.
+    """
+
+    def __init__(self, p4):
+        self._p4 = p4
+        self._path = os.path.join(os.path.expanduser('~'),
+                                  p4gf_const.P4GF_DIR, PROTECTS_CACHE_FILE)
+        self._data = None
+
+    def _table_checksum(self):
+        """Return a checksum of the protections table, or None if we
+        cannot read it.
+        """
+        try:
+            r = self._p4.run('protect', '-o')
+        except P4.P4Exception:
+            LOG.debug("cannot read protections table, not caching protects",
+                      exc_info=True)
+            return None
+        for e in r:
+            if isinstance(e, dict) and 'Protections' in e:
+                text = '\n'.join(e['Protections'])
+                return hashlib.sha1(text.encode('utf-8')).hexdigest()
+        return None
+
+    def _load(self):
+        """Return the cache's contents if we can trust them now, checking
+        the protections table if it is time to, or None.
+        """
+        if self._data is not None:
+            return self._data or None
+        check_secs = _int_const(p4gf_const.P4GF_PROTECTS_CHECK_SECS)
+        if check_secs <= 0:
+            self._data = {}
+            return None
+        data = p4gf_fact_cache.read_json(self._path)
+        if data.get('port') != self._p4.port:
+            data = {}
+        now = time.time()
+        if not (data and 0 <= now - data.get('checked', 0) < check_secs):
+            checksum = self._table_checksum()
+            if not checksum:
+                self._data = {}
+                return None
+            if checksum != data.get('checksum'):
+                LOG.debug("protections table changed, dropping cached protects")
+                data = {'port': self._p4.port, 'checksum': checksum, 'users': {}}
+            data['checked'] = now
+            p4gf_fact_cache.write_json(self._path, data)
+        self._data = data
+        return data
+
+    def _update(self, user, func):
+        """Re-read the file, let func() change user's entry, write it back,
+        unless the table changed under us.
+        """
+        data = p4gf_fact_cache.read_json(self._path)
+        if data.get('checksum') != self._data.get('checksum'):
+            return
+        entry = data.setdefault('users', {}).get(user)
+        if entry is None:
+            entry = self._data['users'].get(user)
+            if entry is None:
+                return
+            data['users'][user] = entry
+        func(entry)
+        p4gf_fact_cache.write_json(self._path, data)
+
+    def protect_for_user(self, user):
+        """Return a Protect object for user, from the cache if it has a
+        recent one, from 'p4 protects -u <user>' if not.
+        """
+        data = self._load()
+        if not data:
+            return _create_protect_for_user(self._p4, user)
+
+        entry = data['users'].get(user)
+        max_age = _int_const(p4gf_const.P4GF_PROTECTS_CACHE_SECS)
+        if not (entry and 0 <= time.time() - entry['time'] < max_age):
+            r = self._p4.run('protects', '-u', user)
+            entry = { 'time'     : time.time()
+                    , 'protects' : [dict(e) for e in r if isinstance(e, dict)]
+                    , 'lines'    : {}
+                    }
+            data['users'][user] = entry
+            self._update(user, lambda e: e.update(entry))
+
+        def remember_lines(perm, lines):
+            """Save map lines Protect just worked out for next time."""
+            self._update(user, lambda e: e['lines'].__setitem__(perm, lines))
+
+        return Protect(entry['protects'], dict(entry['lines']), remember_lines)
+
+
 class UserToProtect:
     """Caching/Factory object that maintains a cache of Protect objects,
     one per requested user, and knows how to create those Protect objects
     on the fly if you ask for one it does not (yet) have cached.
+
+    Behind this per-process cache is the host-wide ProtectsCache.
     """
 
     def __init__(self, p4):
         self._p4 = p4
         self._user_to_protect = {}
+        self._protects_cache = ProtectsCache(p4)
 
     def user_to_protect(self, user):
         """Return a Protect object for user, from cache if one already
@@ -166,7 +317,10 @@ class UserToProtect:
         """
         p = self._user_to_protect.get(user)
         if not p:
-            p = _create_protect_for_user(self._p4, user)
+            if user:
+                p = self._protects_cache.protect_for_user(user)
+            else:
+                p = Protect()
             self._user_to_protect[user] = p
         return p
 
@@ -17,12 +17,11 @@ class RepoList:
         '''build list of repos visible to user'''
         result = RepoList()
 
-        for view in p4gf_util.view_list(p4):
-            #check user permissions for view
-            view_perm = p4gf_group.ViewPerm.for_user_and_view(p4,
-                                                            user,
-                                                            view)
-            #sys.stderr.write("view: {}, user: {}, perm: {}".format(view, user, view_perm))
+        views = p4gf_util.view_list(p4)
+        for view_perm in p4gf_group.ViewPerm.for_user_and_views(p4,
+                                                                user,
+                                                                views):
+            view = view_perm.view_name
             if view_perm.can_push():
                 result.repos.append((view, 'push'))
             elif view_perm.can_pull():
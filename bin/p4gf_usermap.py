@@ -11,9 +11,11 @@ Perforce administrator may add a mapping to the p4gf_usermap file."""
 import os
 import re
 import sys
+import time
 
 import p4gf_const
 from p4gf_create_p4 import connect_p4
+import p4gf_fact_cache
 import p4gf_init
 import p4gf_log
 import p4gf_p4user
@@ -24,19 +26,11 @@ try:
 except ImportError:
     local_users = {}
 
-def read_user_map(p4):
-    """Reads the user map file from Perforce into a list of tuples,
-    consisting of username, email address, and full name. If no
-    such file exists, an empty list is returned.
-
-    Returns a list of 3-tuples: (p4user, email, fullname)
+def _parse_user_map(mappath):
+    """Parse the p4gf_usermap file at mappath, if any, into a list of
+    3-tuples: (p4user, email, fullname)
     """
-    usermap = [(key, value['Email'], value['FullName'])
-               for key, value in local_users.items() if 'Email' in value]
-    client = p4.fetch_client(p4gf_util.get_object_client_name())
-    mappath = client['Root'] + '/users/p4gf_usermap'
-    # don't let a writable usermap file get in our way
-    p4.run('sync', '-fq', mappath)
+    usermap = []
     if os.path.exists(mappath):
         regex = re.compile('([^ \t]+)[ \t]+([^ \t]+)[ \t]+"([^"]+)"')
         with open(mappath) as mf:
@@ -50,6 +44,25 @@ def read_user_map(p4):
     return usermap
 
 
+def _local_users():
+    """Users from ravenbrook_data, if installed, as 3-tuples."""
+    return [(key, value['Email'], value['FullName'])
+            for key, value in local_users.items() if 'Email' in value]
+
+
+def read_user_map(p4):
+    """Reads the user map file from Perforce into a list of tuples,
+    consisting of username, email address, and full name. If no
+    such file exists, an empty list is returned.
+
+    Returns a list of 3-tuples: (p4user, email, fullname)
+    """
+    mappath = p4gf_util.p4_to_p4gf_dir(p4) + '/users/p4gf_usermap'
+    # don't let a writable usermap file get in our way
+    p4.run('sync', '-fq', mappath)
+    return _local_users() + _parse_user_map(mappath)
+
+
 def get_p4_users(p4):
     """Retrieve the set of users registered in the Perforce server, in a
     list of tuples consisting of username, email address, and full name. If
@@ -110,23 +123,179 @@ def tuple_to_P4User(um_3tuple):
     p4user.full_name = um_3tuple[TUPLE_INDEX_FULLNAME]
     return p4user
 
+def _normalize_email(addr):
+    """Email addresses match regardless of case."""
+    return addr.lower() if addr else addr
+
+
+def _index(users, tuple_index, normalize=None):
+    """Return a dict of (normalized) tuple element ==> first 3-tuple with
+    that value.
+    """
+    d = {}
+    for usr in users:
+        key = usr[tuple_index]
+        if normalize:
+            key = normalize(key)
+        if not key in d:
+            d[key] = usr
+    return d
+
+
+class UserIndex:
+    """A list of user 3-tuples, indexed by email and by p4user.
+
+    First tuple wins, as with find_by_tuple_index(). Emails match
+    regardless of case.
+    """
+
+    def __init__(self, users):
+        self.users = list(users)
+        self.by_email  = _index(self.users, TUPLE_INDEX_EMAIL, _normalize_email)
+        self.by_p4user = _index(self.users, TUPLE_INDEX_P4USER)
+
+    def find(self, index, value):
+        """Return the first 3-tuple whose element index matches value, or None."""
+        if index == TUPLE_INDEX_EMAIL:
+            return self.by_email.get(_normalize_email(value))
+        if index == TUPLE_INDEX_P4USER:
+            return self.by_p4user.get(value)
+        return find_by_tuple_index(index, value, self.users)
+
+    def append(self, usr):
+        """Add one more 3-tuple, behind any already here."""
+        self.users.append(usr)
+        self.by_email.setdefault(_normalize_email(usr[TUPLE_INDEX_EMAIL]), usr)
+        self.by_p4user.setdefault(usr[TUPLE_INDEX_P4USER], usr)
+
+
+# Every process that maps users used to sync the p4gf_usermap file and,
+# on the first miss, fetch all of 'p4 users'. Both are kept here, in the
+# Git Fusion directory, shared by every process on this host.
+#
+# The p4gf_usermap part is good for as long as the file's head revision
+# is unchanged. The 'p4 users' part is good for P4GF_USERS_CACHE_SECS, or
+# until a lookup misses: a user nobody has heard of might be a new one.
+USERMAP_CACHE_FILE = "usermap-cache.json"
+USERMAP_DEPOT_PATH = "//{}/users/p4gf_usermap".format(p4gf_const.P4GF_DEPOT)
+
+
+def _usermap_head(p4):
+    """Return a string that changes whenever the p4gf_usermap file's head
+    revision does, or None if there is no such file.
+    """
+    with p4.at_exception_level(p4.RAISE_NONE):
+        r = p4.run('fstat', '-T', 'headRev,headChange,headAction',
+                   USERMAP_DEPOT_PATH)
+    d = p4gf_util.first_dict_with_key(r, 'headRev')
+    if not d or 'delete' in d.get('headAction', ''):
+        return None
+    return "{}#{}@{}".format(USERMAP_DEPOT_PATH, d['headRev'], d.get('headChange'))
+
+
+class _UserCache:
+    """This host's on-disk copy of the parsed p4gf_usermap and 'p4 users'."""
+
+    def __init__(self, p4):
+        self.p4 = p4
+        self.p4gf_dir = p4gf_util.p4_to_p4gf_dir(p4)
+        self.path = os.path.join(self.p4gf_dir, USERMAP_CACHE_FILE)
+        self.data = self._load()
+
+    def _load(self):
+        """Read the cache file, if it is there and for our server."""
+        data = p4gf_fact_cache.read_json(self.path)
+        if data.get('port') != self.p4.port:
+            return {}
+        return data
+
+    def _save(self):
+        """Write the cache file, atomically. Last writer wins."""
+        self.data['port'] = self.p4.port
+        p4gf_fact_cache.write_json(self.path, self.data)
+
+    def user_map(self):
+        """Return p4gf_usermap's 3-tuples, syncing and parsing the file only
+        if its head revision changed since we last did.
+        """
+        head = _usermap_head(self.p4)
+        if head and head == self.data.get('usermap_head'):
+            return [tuple(u) for u in self.data.get('usermap', [])]
+        mappath = self.p4gf_dir + '/users/p4gf_usermap'
+        if head:
+            # don't let a writable usermap file get in our way
+            self.p4.run('sync', '-fq', mappath)
+        usermap = _parse_user_map(mappath)
+        self.data['usermap_head'] = head
+        self.data['usermap'] = usermap
+        self._save()
+        return usermap
+
+    def p4_users(self, refresh=False):
+        """Return 'p4 users' as 3-tuples, from the cache unless it is too
+        old or refresh is set, and whether they came from Perforce.
+        """
+        try:
+            ttl = int(p4gf_const.P4GF_USERS_CACHE_SECS)
+        except ValueError:
+            ttl = 0
+        age = time.time() - self.data.get('users_time', 0)
+        if not refresh and 'users' in self.data and 0 <= age < ttl:
+            return ([tuple(u) for u in self.data['users']], False)
+        users = get_p4_users(self.p4)
+        self.data['users'] = users
+        self.data['users_time'] = time.time()
+        self._save()
+        return (users, True)
+
+
 class UserMap:
     """Mapping of Git authors to Perforce users. Caches the lists of users
     to improve performance when performing repeated searches (e.g. when
-    processing a Git push consisting of many commits).
+    processing a Git push consisting of many commits), both in memory,
+    indexed by email and p4user, and on disk for the next process.
     """
 
     def __init__(self, p4):
-        # List of 3-tuples: first whatever's loaded from p4gf_usermap,
+        # UserIndex of 3-tuples: first whatever's loaded from p4gf_usermap,
         # then followed by single tuples fetched from 'p4 users' to
         # satisfy later lookup_by_xxx() requests.
         self.users = None
 
-        # List of 3-tuples, filled in only if needed.
+        # UserIndex, filled in only if needed.
         # Complete list of all Perforce user specs, as 3-tuples.
         self.p4users = None
+        # Has self.p4users come from Perforce, not the on-disk cache,
+        # during this process?
+        self.p4users_fresh = False
 
         self.p4 = p4
+        self._cache = None
+
+    def _user_cache(self):
+        """Lazy-load the on-disk cache."""
+        if not self._cache:
+            self._cache = _UserCache(self.p4)
+        return self._cache
+
+    def _load_p4users(self, refresh=False):
+        """Fill self.p4users, from the on-disk cache if possible."""
+        (users, fresh) = self._user_cache().p4_users(refresh)
+        self.p4users = UserIndex(users)
+        self.p4users_fresh = self.p4users_fresh or fresh
+
+    def _find_p4user(self, index, value):
+        """Look for user in Perforce. If a cached 'p4 users' list does not
+        have them, the list might be out of date: fetch it once and look
+        again.
+        """
+        if not self.p4users:
+            self._load_p4users()
+        user = self.p4users.find(index, value)
+        if not user and not self.p4users_fresh:
+            self._load_p4users(refresh=True)
+            user = self.p4users.find(index, value)
+        return user
 
     def _lookup_by_tuple_index(self, index, value):
         """Return 3-tuple for user whose tuple matches requested value.
@@ -138,28 +307,25 @@ class UserMap:
 
         Lazy-fetches p4gf_usermap and 'p4 users' as needed.
 
-        O(n) list scan.
+        O(1) dict lookups.
         """
         if not self.users:
-            self.users = read_user_map(self.p4)
+            self.users = UserIndex(_local_users() + self._user_cache().user_map())
         # Look for user in existing map. If found return. We're done.
-        user = find_by_tuple_index(index, value, self.users)
+        user = self.users.find(index, value)
         if user:
             return user
 
         # Look for user in Perforce.
-        if not self.p4users:
-            self.p4users = get_p4_users(self.p4)
-        user = find_by_tuple_index(index, value, self.p4users)
+        user = self._find_p4user(index, value)
 
         if not user:
             # Look for the "unknown git" user, if any.
-            user = find_by_tuple_index(TUPLE_INDEX_P4USER,
-                                       p4gf_const.P4GF_UNKNOWN_USER,
-                                       self.p4users)
+            user = self.p4users.find(TUPLE_INDEX_P4USER,
+                                     p4gf_const.P4GF_UNKNOWN_USER)
 
         # Remember this search hit for later so that we don't have to
-        # re-scan our p4users list again.
+        # look through our p4users list again.
         if user:
             self.users.append(user)
 
@@ -175,19 +341,19 @@ class UserMap:
         """
         return self._lookup_by_tuple_index(TUPLE_INDEX_EMAIL, addr)
 
+    def lookup_by_emails(self, addrs):
+        """Return a dict of email address ==> lookup_by_email() result for
+        every distinct address in addrs, looking each one up only once.
+        """
+        return {addr: self.lookup_by_email(addr) for addr in set(addrs)}
+
     def lookup_by_p4user(self, p4user):
         """Return 3-tuple for given Perforce user."""
         return self._lookup_by_tuple_index(TUPLE_INDEX_P4USER, p4user)
 
     def p4user_exists(self, p4user):
         '''Return True if we saw this p4user in 'p4 users' list.'''
-        # Look for user in Perforce.
-        if not self.p4users:
-            self.p4users = get_p4_users(self.p4)
-        user = find_by_tuple_index(TUPLE_INDEX_P4USER, p4user, self.p4users)
-        if user:
-            return True
-        return False
+        return self._find_p4user(TUPLE_INDEX_P4USER, p4user) is not None
 
 
 def main():
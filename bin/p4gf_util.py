@@ -8,6 +8,7 @@ import re
 from subprocess import Popen, PIPE
 
 import p4gf_const
+import p4gf_fact_cache
 import p4gf_log
 import p4gf_path
 import p4gf_rc
@@ -515,13 +516,71 @@ def git_checkout(sha1):
 
 
 def checkout_detached_master():
-    """Dereference master and switch to that sha1."""
+    """Dereference master and switch to that sha1.
 
+    NOP for a bare repo: there is no work tree to switch, and HEAD stays
+    on branch master.
+    """
+    if git_bare_repo():
+        return
     sha1 = git_ref_master()
     if (sha1):
         git_checkout(sha1)
 
 
+def git_bare_repo():
+    """Does Git Fusion keep its mirror Git repos bare?"""
+    return (    const_to_bool(p4gf_const.P4GF_GIT_BARE_REPO)
+            and p4gf_version.git_version_supports_update_ref_stdin())
+
+
+_BARE_RE = re.compile(r'^\s*bare\s*=\s*true\s*$', re.MULTILINE | re.IGNORECASE)
+
+
+def git_make_bare(git_dir):
+    """Turn a mirror repo created with a work tree into a bare one.
+
+    Reads git_dir/config directly so that the common case, a repo that is
+    already bare, costs no git process. Converting points HEAD at branch
+    master and drops the empty_repo branch that non-bare repos needed to
+    accept a first push.
+    """
+    try:
+        with open(os.path.join(git_dir, 'config'), 'r') as f:
+            if _BARE_RE.search(f.read()):
+                return
+    except (OSError, IOError):
+        return
+    LOG.info("converting mirror Git repository {} to bare".format(git_dir))
+    popen(['git', '--git-dir=' + git_dir, 'config', 'core.bare', 'true'])
+    popen(['git', '--git-dir=' + git_dir, 'symbolic-ref', 'HEAD', 'refs/heads/master'])
+    git_update_refs([('refs/heads/' + p4gf_const.P4GF_BRANCH_EMPTY_REPO, None, None)],
+                    git_dir)
+
+
+def git_update_refs(updates, git_dir=None):
+    """Move refs in one atomic 'git update-ref --stdin' transaction.
+
+    updates is a list of (ref, new_sha1, old_sha1) tuples. A new_sha1 of
+    None deletes ref. An old_sha1 of None moves ref no matter where it
+    points now; otherwise ref must point at old_sha1 ('0'*40: must not
+    exist yet). Either every ref moves or none do, and this raises.
+    """
+    lines = []
+    for (ref, new, old) in updates:
+        if new:
+            line = ['update', ref, new]
+        else:
+            line = ['delete', ref]
+        if old:
+            line.append(old)
+        lines.append(' '.join(line) + '\n')
+    cmd = ['git', 'update-ref', '--stdin']
+    if git_dir:
+        cmd.insert(1, '--git-dir=' + git_dir)
+    popen(cmd, stdin=''.join(lines).encode())
+
+
 class HeadRestorer:
     """An RAII class that restores the current working directory's HEAD and
     working tree to the sha1 it had when created.
@@ -534,7 +593,8 @@ class HeadRestorer:
         """
         Remember the current HEAD sha1.
         """
-        self.__sha1__ = git_head_sha1()
+        # A bare repo's HEAD never moves.
+        self.__sha1__ = None if git_bare_repo() else git_head_sha1()
         if not self.__sha1__:
             logging.getLogger("HeadRestorer").debug(
                 "get_head_sha1() returned None, will not restore")
@@ -578,8 +638,31 @@ def test_vars():
     that the test script controls.
 
     Return an empty dict if not testing (the usual case).
+
+    Called for every changelist and object we copy: only re-read the rc
+    file when it has changed since last time.
     """
-    config = p4gf_rc.read_config()
+    rc_path = p4gf_rc.calc_rc_path(None, None)
+    try:
+        mtime = os.stat(rc_path).st_mtime if rc_path else None
+    except OSError:
+        mtime = None
+    cached = _test_vars_cache.get(rc_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    d = _read_test_vars(rc_path)
+    _test_vars_cache[rc_path] = (mtime, d)
+    return d
+
+
+# rc file path ==> (mtime, test_vars() dict) as of the last read.
+_test_vars_cache = {}
+
+
+def _read_test_vars(rc_path):
+    """Parse the [test] section out of rc_path."""
+    config = p4gf_rc.read_config(rc_path=rc_path) if rc_path else None
     if not config:
         LOG.debug("test_vars no config.")
         return {}
@@ -591,6 +674,22 @@ def test_vars():
     return d
 
 
+def const_to_bool(value):
+    """Interpret a p4gf_const tunable as a boolean.
+
+    Tunables default to Python values but environment overrides arrive as
+    strings: accept "0", "false", "no", "off" and "" as False.
+    """
+    if isinstance(value, str):
+        return value.strip().lower() not in ['', '0', 'false', 'no', 'off']
+    return bool(value)
+
+
+def const_to_int(value):
+    """Interpret a p4gf_const tunable as an integer."""
+    return int(value)
+
+
 def test_var_to_dict(var_val):
     """Cheesy 'key:val' parser that probably could be better replaced
     with ConfigParser.
@@ -638,8 +737,31 @@ def p4_to_p4gf_dir(p4):
     Initialized to ~/.git-fusion in p4gf_init.py, admin is free to
     change this later.
     """
-    spec = p4.fetch_client(get_object_client_name())
-    return spec['Root']
+    return fetch_client_root_view(p4, get_object_client_name())['Root']
+
+
+def client_fact_name(client_name):
+    """Name of the p4gf_fact_cache fact that holds a client's Root and View."""
+    return "client:" + client_name
+
+
+def fetch_client_root_view(p4, client_name):
+    """Return a dict of just the Root and View of an existing client.
+
+    Clients change rarely, and Git Fusion fetches the same few on every
+    request: answer from p4gf_fact_cache when it knows.
+    """
+    fact = client_fact_name(client_name)
+    spec = p4gf_fact_cache.get(p4, fact)
+    if spec:
+        return spec
+    client = p4.fetch_client(client_name)
+    spec = {'Root': client['Root'], 'View': list(client['View'])}
+    # 'p4 client -o' of a missing client returns a default spec, with no
+    # Access time. Do not remember that.
+    if 'Access' in client or 'Update' in client:
+        p4gf_fact_cache.put(p4, fact, spec)
+    return spec
 
 
 def dict_to_attr(input_dict, attr_map, dest_object):
@@ -651,6 +773,9 @@ def dict_to_attr(input_dict, attr_map, dest_object):
         setattr(dest_object, attr_name, v)
 
 
+VIEW_LIST_FACT = "view_list"
+
+
 def view_list(p4):
     '''
     Return a list of all known Git Fusion views.
@@ -659,13 +784,20 @@ def view_list(p4):
     Omits the host-specific 'git-fusion--*' object clients.
 
     Return empty list if none found.
+
+    Remembered in p4gf_fact_cache: whatever creates or deletes a view's
+    client must forget VIEW_LIST_FACT.
     '''
+    l = p4gf_fact_cache.get(p4, VIEW_LIST_FACT)
+    if l is not None:
+        return l
     prefix_len = len(p4gf_const.P4GF_CLIENT_PREFIX)
     r = p4.run('clients', '-e', p4gf_const.P4GF_CLIENT_PREFIX + '*')
     l = []
     for spec in r:
         if not spec['client'].startswith(p4gf_const.P4GF_OBJECT_CLIENT_PREFIX):
             l.append(spec['client'][prefix_len:])
+    p4gf_fact_cache.put(p4, VIEW_LIST_FACT, l)
     return l
 
 
@@ -699,3 +831,25 @@ def first_value_for_key(result_list, key):
         if isinstance(e, dict) and key in e:
             return e[key]
     return None
+
+
+def have_change(p4, view_name):
+    '''
+    Return the changelist number that the view's Git Fusion client's have
+    list is known to match, or 0 if unknown.
+    '''
+    name = p4gf_const.P4GF_COUNTER_HAVE_CHANGE.format(view=view_name)
+    value = first_value_for_key(p4.run('counter', '-u', name), 'value')
+    return int(value) if value else 0
+
+
+def set_have_change(p4, view_name, change):
+    '''
+    Record that the view's client's have list matches change. If change is
+    None, forget: the next push will do a full resync.
+    '''
+    name = p4gf_const.P4GF_COUNTER_HAVE_CHANGE.format(view=view_name)
+    if change:
+        p4.run('counter', '-u', name, str(change))
+    else:
+        p4.run('counter', '-u', '-d', name)
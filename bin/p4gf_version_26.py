@@ -42,6 +42,15 @@ _PRODUCT_DICT = {
 # Required Git version (e.g. (1, 2, 3) => '1.2.3')
 _GIT_VERSION = (1, 7, 11, 3)
 
+# Git version required to keep mirror repos bare: 'git update-ref --stdin'.
+_GIT_VERSION_UPDATE_REF_STDIN = (1, 8, 5)
+
+# Git versions required by p4gf_maintenance for reachability bitmaps,
+# 'git commit-graph write --reachable', and 'git repack --geometric'.
+_GIT_VERSION_REPACK_BITMAPS  = (2, 0)
+_GIT_VERSION_COMMIT_GRAPH    = (2, 19)
+_GIT_VERSION_GEOMETRIC       = (2, 32)
+
 LOG = logging.getLogger('p4gf_version')
 
 def as_string():
@@ -223,12 +232,11 @@ def parse_git_version(version_string):
     version_ints = [int(x) for x in version_elements if len(x)]
     return version_ints
 
-def git_version_acceptable(version_string):
+def git_version_acceptable(version_string, required_list=_GIT_VERSION):
     '''Return True if the version string meets the requirement for the Git
-    version, as defined in _GIT_VERSION.
+    version, as defined in _GIT_VERSION unless required_list says otherwise.
     '''
     got_list      = parse_git_version(version_string)
-    required_list = _GIT_VERSION
     if len(got_list) < len(required_list):
         got_list += [0, 0, 0, 0] # Pad with 0: 1.7 == 1.7.0.0
 
@@ -250,6 +258,47 @@ def git_version_check():
         vers = ".".join([str(v) for v in _GIT_VERSION])
         raise RuntimeError("Git version {0} or greater required.".format(vers))
 
+_git_version_string = None
+def _git_version_supports(required_list):
+    '''
+    Is 'git --version' at least required_list?
+
+    Cache the version: only ask 'git --version' once per process.
+    '''
+    global _git_version_string
+    if _git_version_string is None:
+        _git_version_string = git_version() or ''
+    return (    bool(_git_version_string)
+            and git_version_acceptable(_git_version_string, required_list))
+
+
+def git_version_supports_update_ref_stdin():
+    '''
+    'git update-ref --stdin' added for 1.8.5
+    '''
+    return _git_version_supports(_GIT_VERSION_UPDATE_REF_STDIN)
+
+
+def git_version_supports_repack_bitmaps():
+    '''
+    'git repack --write-bitmap-index' added for 2.0
+    '''
+    return _git_version_supports(_GIT_VERSION_REPACK_BITMAPS)
+
+
+def git_version_supports_commit_graph():
+    '''
+    'git commit-graph write --reachable' added for 2.19
+    '''
+    return _git_version_supports(_GIT_VERSION_COMMIT_GRAPH)
+
+
+def git_version_supports_geometric_repack():
+    '''
+    'git repack --geometric' added for 2.32
+    '''
+    return _git_version_supports(_GIT_VERSION_GEOMETRIC)
+
 
 def python_version():
     """Return python version number '2.7.3'."""
@@ -368,6 +417,8 @@ def p4d_version_check(p4):
 
     if p4 is not connected, it will be connected/disconnected
     if already connected, it will be left connected
+
+    Return the version string.
     """
 
     if p4.connected():
@@ -390,6 +441,7 @@ def p4d_version_check(p4):
             req_v=vr[0],
             req_ch=vr[1])
         raise RuntimeError(msg)
+    return version_string
 
 
 def p4d_version_supports_admin_user(p4):
@@ -437,6 +489,16 @@ def p4d_version_supports_populate(p4):
     return 2012.1 <= p4d_version(p4)
 
 
+def p4d_version_supports_submit_parallel(p4):
+    '''
+    'p4 submit --parallel' added for 2014.1
+
+    Transfers file content over several connections at once. The server
+    must also have net.parallel.max set, which only it knows.
+    '''
+    return 2014.1 <= p4d_version(p4)
+
+
 _KEY_VERSION_YEAR_SUB = '_version_year_sub'
 def p4d_version_cache_set(p4, version_string):
     '''
@@ -0,0 +1,80 @@
+#! /usr/bin/env python3.2
+"""Benchmark G2PConflictChecker.record_commit() + check() over a long push,
+against an in-process stand-in for 'p4 changes'.
+
+Needs P4Python importable (nothing here talks to a server):
+
+    python3 test/bench_g2p_conflict_checker.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+
+from p4gf_g2p_conflict_checker import G2PConflictChecker
+
+
+class _BenchP4:
+    """Just enough of a P4 connection to answer 'p4 changes' for
+    bench(), as if the only changelists in the view were the ones we
+    submitted.
+    """
+
+    def __init__(self):
+        self.submitted = []
+
+    def run(self, cmd):
+        """Answer 'p4 changes -mN -ssubmitted path@from,to'."""
+        maxct = int(cmd[1][2:])
+        (lo, hi) = cmd[-1].split('@', 1)[1].split(',')
+        lo = int(lo)
+        hi = int(hi[1:]) if hi.startswith('@') else None
+        r = [{'change': str(c)} for c in reversed(self.submitted)
+             if lo <= c and (hi is None or c <= hi)]
+        return r[:maxct]
+
+
+class _BenchConfig:
+    """Config with just a client name."""
+    p4client = 'bench'
+
+
+class _BenchCtx:
+    """Context for bench()."""
+    def __init__(self):
+        self.p4 = _BenchP4()
+        self.config = _BenchConfig()
+
+
+def bench(commit_count=10000, gap_every=0):
+    """Time record_commit() + check() over a push of commit_count commits.
+
+    gap_every=N leaves a gap in changelist numbers after every Nth commit,
+    as if someone had created, but not submitted, a changelist: that costs
+    a 'p4 changes -m1' probe.
+    """
+    ctx = _BenchCtx()
+    checker = G2PConflictChecker(ctx, testing_head_sha1=-1)
+    start = time.time()
+    change = 1
+    for i in range(commit_count):
+        change += 1
+        if gap_every and i % gap_every == 0:
+            change += 1
+        ctx.p4.submitted.append(change)
+        checker.record_commit("{:040x}".format(i), str(change))
+        if checker.check():
+            raise RuntimeError("unexpected conflict at {}".format(change))
+    if checker.reconcile():
+        raise RuntimeError("unexpected conflict at reconcile")
+    elapsed = time.time() - start
+    print("{ct} commits: {sec:.3f}s, {q} 'p4 changes' queries"
+          .format(ct=commit_count, sec=elapsed, q=checker.query_count))
+
+
+if __name__ == "__main__":
+    bench()
+    bench(gap_every=10)
@@ -0,0 +1,129 @@
+#! /usr/bin/env python3.2
+"""Resuming a push that failed part way: G2P.attempt_resync() must bring
+the client's have list up to the commits the failed push already
+submitted, not back down to master.
+
+Needs P4Python importable (nothing here talks to a server):
+
+    python3 -m unittest discover -s test
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+
+try:
+    import P4
+except ImportError:
+    P4 = None
+
+if P4:
+    import p4gf_copy_to_p4
+    import p4gf_util
+
+
+class _DepotP4:
+    """Just enough of a P4 connection for attempt_resync(): counters, and
+    a have list that 'sync -k' moves.
+
+    revs: depot path ==> [changelist number of rev #1, of #2, ...]
+    """
+
+    def __init__(self, revs):
+        self.revs = revs
+        self.have = {}
+        self.counters = {}
+        self.errors = []
+        self.warnings = []
+        self.messages = []
+
+    def _head_rev_at(self, path, change):
+        """Newest rev of path submitted at or before change, 0 if none."""
+        return len([c for c in self.revs[path] if c <= change])
+
+    def run(self, *cmd):
+        cmd = list(cmd[0]) if len(cmd) == 1 else list(cmd)
+        if cmd[0] == 'counter':
+            args = [a for a in cmd[1:] if a != '-u']
+            if args[0] == '-d':
+                self.counters.pop(args[1], None)
+                return []
+            if len(args) == 2:
+                self.counters[args[0]] = args[1]
+                return []
+            return [{'value': self.counters.get(args[0], '0')}]
+        if cmd[:2] == ['sync', '-k']:
+            revs = cmd[2].split('@', 1)[1].split(',')
+            lo = int(revs[0]) if len(revs) == 2 else 0
+            hi = int(revs[-1].lstrip('@'))
+            for path, changes in self.revs.items():
+                if any(lo <= c <= hi for c in changes):
+                    self.have[path] = self._head_rev_at(path, hi)
+            return []
+        raise RuntimeError("unexpected p4 {}".format(cmd))
+
+
+class _Mirror:
+    """Git commit ==> changelist, for master."""
+    def __init__(self, commit_change):
+        self.commit_change = commit_change
+
+    def get_change_for_commit(self, commit, _ctx):
+        """Changelist master's commit was copied to."""
+        return self.commit_change.get(commit)
+
+
+class _Config:
+    """View name only."""
+    view_name = 'resume'
+
+
+class _Ctx:
+    """What attempt_resync() reads from a Context."""
+    def __init__(self, p4, mirror):
+        self.p4 = p4
+        self.mirror = mirror
+        self.config = _Config()
+
+
+@unittest.skipUnless(P4, "P4Python not installed")
+class TestResumeResync(unittest.TestCase):
+    """Master is at changelist 10. A push submitted commit B as 12, which
+    edited a.txt, then failed; the failure forgot the have-change counter.
+    The retry's commit C edits a.txt again.
+    """
+
+    def setUp(self):
+        self.p4 = _DepotP4({ '//depot/a.txt' : [10, 12]
+                           , '//depot/b.txt' : [10] })
+        # The failed push submitted 12 from this client: have #2.
+        self.p4.have = {'//depot/a.txt': 2, '//depot/b.txt': 1}
+        self.g2p = p4gf_copy_to_p4.G2P.__new__(p4gf_copy_to_p4.G2P)
+        self.g2p.ctx = _Ctx(self.p4, _Mirror({'master-sha1': '10'}))
+        self.g2p.journaled = {}
+        self.saved_git_ref_master = p4gf_util.git_ref_master
+        p4gf_util.git_ref_master = lambda: 'master-sha1'
+
+    def tearDown(self):
+        p4gf_util.git_ref_master = self.saved_git_ref_master
+
+    def test_resume_keeps_journaled_revs(self):
+        """C must open a.txt#2, the rev B submitted, not #1."""
+        self.g2p.journaled = {'b-sha1': '12'}
+        self.g2p.attempt_resync()
+        self.assertEqual(self.p4.have['//depot/a.txt'], 2)
+        self.assertEqual(p4gf_util.have_change(self.p4, 'resume'), 12)
+
+    def test_no_journal_syncs_to_master(self):
+        """Without a journal, master's changelist is the target."""
+        self.p4.have = {}
+        self.g2p.attempt_resync()
+        self.assertEqual(self.p4.have['//depot/a.txt'], 1)
+        self.assertEqual(p4gf_util.have_change(self.p4, 'resume'), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+#! /usr/bin/env python3.2
+"""p4gf_bulk: long argument lists split into chunks, and chunks the server
+finds too big halved until it takes them.
+
+Needs P4Python importable (nothing here talks to a server):
+
+    python3 -m unittest discover -s test
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+
+try:
+    import P4
+except ImportError:
+    P4 = None
+
+if P4:
+    import p4gf_bulk
+    import p4gf_const
+    import p4gf_p4msgid
+
+
+class _Message:
+    """One entry of p4.messages."""
+    def __init__(self, msgid, generic=0):
+        self.msgid = msgid
+        self.generic = generic
+
+
+class _BulkP4:
+    """A server that refuses any command with more than max_args file
+    arguments, with the given message id.
+    """
+
+    def __init__(self, max_args, msgid=None):
+        self.max_args = max_args
+        self.msgid = msgid if msgid is not None else p4gf_p4msgid.MsgDb_MaxResults
+        self.calls = []
+        self.messages = []
+
+    def run(self, cmd):
+        args = cmd[1:]
+        self.calls.append(args)
+        if len(args) > self.max_args:
+            self.messages = [_Message(self.msgid)]
+            raise P4.P4Exception("too big")
+        self.messages = []
+        return [{'depotFile': a} for a in args]
+
+
+@unittest.skipUnless(P4, "P4Python not installed")
+class TestChunks(unittest.TestCase):
+    """chunks() caps each chunk by count and by bytes."""
+
+    def setUp(self):
+        self.saved_max_bytes = p4gf_const.P4GF_BULK_MAX_ARG_BYTES
+
+    def tearDown(self):
+        p4gf_const.P4GF_BULK_MAX_ARG_BYTES = self.saved_max_bytes
+
+    def test_count(self):
+        """No chunk longer than max_count, nothing lost or reordered."""
+        args = [str(i) for i in range(10)]
+        chunks = list(p4gf_bulk.chunks(args, max_count=4))
+        self.assertEqual([len(c) for c in chunks], [4, 4, 2])
+        self.assertEqual(sum(chunks, []), args)
+
+    def test_bytes(self):
+        """A chunk ends before it passes P4GF_BULK_MAX_ARG_BYTES, but an
+        argument longer than that still gets a chunk of its own.
+        """
+        p4gf_const.P4GF_BULK_MAX_ARG_BYTES = 10
+        args = ['aaaa', 'bbbb', 'cccc', 'x' * 20, 'dd']
+        self.assertEqual(list(p4gf_bulk.chunks(args, max_count=100)),
+                         [['aaaa', 'bbbb'], ['cccc'], ['x' * 20], ['dd']])
+
+
+@unittest.skipUnless(P4, "P4Python not installed")
+class TestRunChunked(unittest.TestCase):
+    """run_chunked() halves a chunk the server refuses as too big."""
+
+    def test_halving_sticks(self):
+        """Refused at 8 and 4, the run goes on 2 at a time, in order."""
+        p4 = _BulkP4(max_args=3)
+        args = ['//depot/{}'.format(i) for i in range(10)]
+        results = list(p4gf_bulk.run(p4, ['add'], args, max_count=8))
+        self.assertEqual([r['depotFile'] for r in results], args)
+        self.assertEqual([len(c) for c in p4.calls], [8, 4, 2, 2, 2, 2, 2])
+
+    def test_other_errors_raise(self):
+        """Any other failure is the caller's."""
+        p4 = _BulkP4(max_args=3, msgid=p4gf_p4msgid.MsgDm_ParallelNotEnabled)
+        with self.assertRaises(P4.P4Exception):
+            list(p4gf_bulk.run(p4, ['add'], ['a', 'b', 'c', 'd'], max_count=4))
+        self.assertEqual(len(p4.calls), 1)
+
+    def test_single_arg_too_big_raises(self):
+        """Nothing left to halve."""
+        p4 = _BulkP4(max_args=0)
+        with self.assertRaises(P4.P4Exception):
+            list(p4gf_bulk.run(p4, ['add'], ['a', 'b'], max_count=2))
+        self.assertEqual([len(c) for c in p4.calls], [2, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
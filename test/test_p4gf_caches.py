@@ -0,0 +1,293 @@
+#! /usr/bin/env python3.2
+"""The host-wide caches behind each request: facts, the user map and
+'p4 users', and 'p4 protects'. What one process learns, the next reuses,
+until it is too old or Perforce says it changed.
+
+Needs P4Python importable (nothing here talks to a server):
+
+    python3 -m unittest discover -s test
+"""
+
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+
+try:
+    import P4
+except ImportError:
+    P4 = None
+
+if P4:
+    import p4gf_const
+    import p4gf_fact_cache
+    import p4gf_protect
+    import p4gf_usermap
+    import p4gf_util
+
+
+class _CacheP4:
+    """A server that counts the commands it runs.
+
+    users:       'p4 users' result
+    usermap_rev: head rev of p4gf_usermap, 0 for none
+    protections: the protections table, None if we may not read it
+    """
+
+    RAISE_NONE = 0
+
+    def __init__(self, port='perforce:1666'):
+        self.port = port
+        self.users = [{'User': 'bob', 'Email': 'bob@x', 'FullName': 'Bob'}]
+        self.usermap_rev = 0
+        self.protections = ['write user * * //...']
+        self.calls = []
+
+    @contextlib.contextmanager
+    def at_exception_level(self, _level):
+        """No exceptions to suppress."""
+        yield
+
+    def count(self, cmd):
+        """How many times has cmd run?"""
+        return len([c for c in self.calls if c == cmd])
+
+    def run(self, *cmd):
+        self.calls.append(cmd[0])
+        if cmd[0] == 'users':
+            return list(self.users)
+        if cmd[0] == 'fstat':
+            if not self.usermap_rev:
+                return []
+            return [{'headRev': str(self.usermap_rev), 'headChange': '7',
+                     'headAction': 'edit'}]
+        if cmd[0] == 'sync':
+            return []
+        if cmd[0] == 'protect':
+            if self.protections is None:
+                raise P4.P4Exception("no permission")
+            return [{'Protections': list(self.protections)}]
+        if cmd[0] == 'protects':
+            return [{'perm': 'write', 'user': '*', 'depotFile': '//...'}]
+        raise RuntimeError("unexpected p4 {}".format(cmd))
+
+
+class _CacheTestCase(unittest.TestCase):
+    """Each test gets an empty home directory for the cache files."""
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix='test-caches-')
+        self.saved_home = os.environ.get('HOME')
+        os.environ['HOME'] = self.home
+        self.saved_consts = { name: getattr(p4gf_const, name) for name in
+                              [ 'P4GF_FACT_CACHE_SECS'
+                              , 'P4GF_USERS_CACHE_SECS'
+                              , 'P4GF_PROTECTS_CACHE_SECS'
+                              , 'P4GF_PROTECTS_CHECK_SECS' ]}
+        p4gf_fact_cache._facts = None
+        self.p4 = _CacheP4()
+
+    def tearDown(self):
+        for (name, value) in self.saved_consts.items():
+            setattr(p4gf_const, name, value)
+        if self.saved_home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = self.saved_home
+        p4gf_fact_cache._facts = None
+        shutil.rmtree(self.home, ignore_errors=True)
+
+
+@unittest.skipUnless(P4, "P4Python not installed")
+class TestFactCache(_CacheTestCase):
+    """p4gf_fact_cache: good news, remembered for P4GF_FACT_CACHE_SECS."""
+
+    def _next_process(self):
+        """Forget this process's copy: read the file afresh."""
+        p4gf_fact_cache._facts = None
+
+    def test_put_get(self):
+        """A fact put by one process is there for the next."""
+        p4gf_fact_cache.put(self.p4, 'init', {'root': '/p4'})
+        self._next_process()
+        self.assertEqual(p4gf_fact_cache.get(self.p4, 'init'), {'root': '/p4'})
+        self.assertIsNone(p4gf_fact_cache.get(self.p4, 'other'))
+
+    def test_other_server(self):
+        """Facts about one server never answer for another."""
+        p4gf_fact_cache.put(self.p4, 'init')
+        self._next_process()
+        self.assertIsNone(p4gf_fact_cache.get(_CacheP4('other:1666'), 'init'))
+
+    def test_forget(self):
+        """forget() one fact, or all of a server's."""
+        other = _CacheP4('other:1666')
+        for p4 in (self.p4, other):
+            p4gf_fact_cache.put(p4, 'a')
+            p4gf_fact_cache.put(p4, 'b')
+        p4gf_fact_cache.forget(self.p4, 'a')
+        self._next_process()
+        self.assertIsNone(p4gf_fact_cache.get(self.p4, 'a'))
+        self.assertTrue(p4gf_fact_cache.get(self.p4, 'b'))
+        p4gf_fact_cache.forget(self.p4)
+        self._next_process()
+        self.assertIsNone(p4gf_fact_cache.get(self.p4, 'b'))
+        self.assertTrue(p4gf_fact_cache.get(other, 'a'))
+
+    def test_expired(self):
+        """A fact older than P4GF_FACT_CACHE_SECS is looked up again."""
+        p4gf_fact_cache.put(self.p4, 'init')
+        path = p4gf_fact_cache._path()
+        facts = p4gf_fact_cache.read_json(path)
+        for entry in facts.values():
+            entry[0] -= int(p4gf_const.P4GF_FACT_CACHE_SECS) + 1
+        p4gf_fact_cache.write_json(path, facts)
+        self._next_process()
+        self.assertIsNone(p4gf_fact_cache.get(self.p4, 'init'))
+
+    def test_disabled(self):
+        """P4GF_FACT_CACHE_SECS=0 remembers nothing."""
+        p4gf_const.P4GF_FACT_CACHE_SECS = 0
+        p4gf_fact_cache.put(self.p4, 'init')
+        self.assertFalse(os.path.exists(p4gf_fact_cache._path()))
+        self.assertIsNone(p4gf_fact_cache.get(self.p4, 'init'))
+
+
+@unittest.skipUnless(P4, "P4Python not installed")
+class TestUserCache(_CacheTestCase):
+    """p4gf_usermap._UserCache: 'p4 users' for P4GF_USERS_CACHE_SECS, the
+    parsed p4gf_usermap until its head revision changes.
+    """
+
+    def setUp(self):
+        _CacheTestCase.setUp(self)
+        self.saved_p4_to_p4gf_dir = p4gf_util.p4_to_p4gf_dir
+        p4gf_util.p4_to_p4gf_dir = lambda _p4: self.home
+        os.makedirs(os.path.join(self.home, 'users'))
+
+    def tearDown(self):
+        p4gf_util.p4_to_p4gf_dir = self.saved_p4_to_p4gf_dir
+        _CacheTestCase.tearDown(self)
+
+    def _write_usermap(self, text):
+        """What 'p4 sync' of p4gf_usermap would leave."""
+        with open(os.path.join(self.home, 'users', 'p4gf_usermap'), 'w') as f:
+            f.write(text)
+
+    def test_p4_users(self):
+        """Fetched once, then from the file, until refresh or other server."""
+        (users, fresh) = p4gf_usermap._UserCache(self.p4).p4_users()
+        self.assertEqual((users, fresh), ([('bob', 'bob@x', 'Bob')], True))
+        (users, fresh) = p4gf_usermap._UserCache(self.p4).p4_users()
+        self.assertEqual((users, fresh), ([('bob', 'bob@x', 'Bob')], False))
+        self.assertEqual(self.p4.count('users'), 1)
+
+        p4gf_usermap._UserCache(self.p4).p4_users(refresh=True)
+        self.assertEqual(self.p4.count('users'), 2)
+
+        other = _CacheP4('other:1666')
+        p4gf_usermap._UserCache(other).p4_users()
+        self.assertEqual(other.count('users'), 1)
+
+    def test_p4_users_expire(self):
+        """P4GF_USERS_CACHE_SECS=0 fetches every time."""
+        p4gf_const.P4GF_USERS_CACHE_SECS = 0
+        p4gf_usermap._UserCache(self.p4).p4_users()
+        p4gf_usermap._UserCache(self.p4).p4_users()
+        self.assertEqual(self.p4.count('users'), 2)
+
+    def test_lookup_miss_refreshes(self):
+        """A user missing from cached 'p4 users' might be new: ask again."""
+        p4gf_usermap._UserCache(self.p4).p4_users()
+        self.p4.users.append({'User': 'ann', 'Email': 'ann@x',
+                              'FullName': 'Ann'})
+        usermap = p4gf_usermap.UserMap(self.p4)
+        self.assertEqual(usermap.lookup_by_email('ann@x'),
+                         ('ann', 'ann@x', 'Ann'))
+        self.assertEqual(self.p4.count('users'), 2)
+
+    def test_user_map(self):
+        """Synced and parsed once per head revision."""
+        self.p4.usermap_rev = 1
+        self._write_usermap('joe joe@x "Joe"\n')
+        self.assertEqual(p4gf_usermap._UserCache(self.p4).user_map(),
+                         [('joe', 'joe@x', 'Joe')])
+        self._write_usermap('# not synced again\n')
+        self.assertEqual(p4gf_usermap._UserCache(self.p4).user_map(),
+                         [('joe', 'joe@x', 'Joe')])
+        self.assertEqual(self.p4.count('sync'), 1)
+
+        self.p4.usermap_rev = 2
+        self._write_usermap('sue sue@x "Sue"\n')
+        self.assertEqual(p4gf_usermap._UserCache(self.p4).user_map(),
+                         [('sue', 'sue@x', 'Sue')])
+        self.assertEqual(self.p4.count('sync'), 2)
+
+
+@unittest.skipUnless(P4, "P4Python not installed")
+class TestProtectsCache(_CacheTestCase):
+    """p4gf_protect.ProtectsCache: 'p4 protects -u' per user, for as long
+    as the protections table is unchanged.
+    """
+
+    def _protects(self):
+        """Another process asks for bob's protections."""
+        return p4gf_protect.ProtectsCache(self.p4).protect_for_user('bob')
+
+    def _make_check_due(self):
+        """Pretend the table was last checked long ago."""
+        path = os.path.join(self.home, p4gf_const.P4GF_DIR,
+                            p4gf_protect.PROTECTS_CACHE_FILE)
+        with open(path) as f:
+            data = json.load(f)
+        data['checked'] = 0
+        p4gf_fact_cache.write_json(path, data)
+
+    def test_reused(self):
+        """The next process reuses the first one's 'p4 protects -u'."""
+        self._protects()
+        self._protects()
+        self.assertEqual(self.p4.count('protects'), 1)
+        self.assertEqual(self.p4.count('protect'), 1)
+
+    def test_table_unchanged(self):
+        """Checking an unchanged table keeps what is cached."""
+        self._protects()
+        self._make_check_due()
+        self._protects()
+        self.assertEqual(self.p4.count('protect'), 2)
+        self.assertEqual(self.p4.count('protects'), 1)
+
+    def test_table_changed(self):
+        """A changed table throws everything away."""
+        self._protects()
+        self.p4.protections.append('write user bob * -//secret/...')
+        self._make_check_due()
+        self._protects()
+        self.assertEqual(self.p4.count('protects'), 2)
+
+    def test_user_expired(self):
+        """Group changes leave the table alone: each user's entry is good
+        for P4GF_PROTECTS_CACHE_SECS at most.
+        """
+        p4gf_const.P4GF_PROTECTS_CACHE_SECS = 0
+        self._protects()
+        self._protects()
+        self.assertEqual(self.p4.count('protects'), 2)
+
+    def test_table_unreadable(self):
+        """No checksum to trust: nothing cached."""
+        self.p4.protections = None
+        self._protects()
+        self._protects()
+        self.assertEqual(self.p4.count('protects'), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+#! /usr/bin/env python3.2
+"""CounterLock's ticket queue: waiters are served in order, and a waiter
+that gives up never leaves the lock unobtainable behind it.
+
+Needs P4Python importable (nothing here talks to a server):
+
+    python3 -m unittest discover -s test
+"""
+
+import contextlib
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+
+try:
+    import P4
+except ImportError:
+    P4 = None
+
+if P4:
+    import p4gf_lock
+
+LOCK = "git_fusion_test_lock"
+
+
+class _CounterP4:
+    """Just enough of a P4 connection for CounterLock: 'p4 counter'."""
+
+    def __init__(self):
+        self.counters = {}
+        self.mutex = threading.Lock()
+
+    @contextlib.contextmanager
+    def at_exception_level(self, _level):
+        """No exceptions to suppress."""
+        yield
+
+    def run(self, *cmd):
+        args = [a for a in cmd[1:] if a != '-u']
+        assert cmd[0] == 'counter'
+        with self.mutex:
+            if args[0] == '-d':
+                self.counters.pop(args[1], None)
+                return []
+            if args[0] == '-i':
+                value = int(self.counters.get(args[1], 0)) + 1
+                self.counters[args[1]] = str(value)
+                return [{'value': str(value)}]
+            if len(args) == 2:
+                self.counters[args[0]] = args[1]
+                return []
+            return [{'value': self.counters.get(args[0], '0')}]
+
+    def value(self, name):
+        """Counter name as an int."""
+        return int(self.counters.get(name, 0))
+
+
+class _Clock:
+    """Virtual time for p4gf_lock: sleep() returns at once, and moves the
+    clock forward.
+    """
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        """Virtual now."""
+        return self.now
+
+    def sleep(self, secs):
+        """Pass secs of virtual time."""
+        self.now += secs
+
+    def gmtime(self):
+        """Virtual now, for heartbeats."""
+        return time.gmtime(self.now)
+
+
+@unittest.skipUnless(P4, "P4Python not installed")
+class TestCounterLockQueue(unittest.TestCase):
+    """Tickets, turns and abandonment."""
+
+    def setUp(self):
+        self.p4 = _CounterP4()
+
+    def _lock(self):
+        """Another waiter for the same lock."""
+        return p4gf_lock.CounterLock(self.p4, LOCK)
+
+    def test_timed_out_waiters_do_not_block_later_ones(self):
+        """Two waiters give up behind a long hold. Once it ends, the next
+        waiter gets the free lock without waiting out their turns.
+        """
+        clock = _Clock()
+        saved_time = p4gf_lock.time
+        p4gf_lock.time = clock
+        try:
+            holder = self._lock()
+            holder.acquire()
+            for _ in range(2):
+                with self.assertRaises(RuntimeError):
+                    self._lock().acquire(timeout_secs=10)
+            holder.release()
+
+            start = clock.time()
+            for _ in range(4):
+                waiter = self._lock()
+                waiter.acquire(timeout_secs=10)
+                self.assertTrue(waiter.has())
+                waiter.release()
+            self.assertLess(clock.time() - start, 1.0)
+        finally:
+            p4gf_lock.time = saved_time
+
+        lock = self._lock()
+        self.assertEqual(self.p4.value(lock.ticket_counter_name()),
+                         self.p4.value(lock.serving_counter_name()))
+        self.assertFalse([name for name in self.p4.counters
+                          if "_abandoned_" in name])
+
+    def test_timed_out_turn_moves_queue_along(self):
+        """A waiter whose turn it was, but never got the lock, marks its
+        own ticket done when it gives up.
+        """
+        holder = self._lock()
+        holder.acquire()
+        # Pretend the holder's ticket is done, but the lock still held.
+        self.p4.counters[holder.serving_counter_name()] = '1'
+        with self.assertRaises(RuntimeError):
+            self._lock().acquire(timeout_secs=-1)
+        self.assertEqual(self.p4.value(holder.serving_counter_name()), 2)
+        holder.release()
+        self.assertEqual(self.p4.value(holder.serving_counter_name()), 2)
+
+    def test_fifo(self):
+        """Waiters get the lock in the order they asked for it."""
+        holder = self._lock()
+        holder.acquire()
+        order = []
+
+        def wait(i):
+            """Take the lock, note our turn, let it go."""
+            lock = self._lock()
+            lock.acquire(timeout_secs=30)
+            order.append(i)
+            lock.release()
+
+        threads = []
+        for i in range(1, 5):
+            t = threading.Thread(target=wait, args=(i,))
+            t.start()
+            threads.append(t)
+            # Next waiter only once this one has its ticket.
+            while self.p4.value(holder.ticket_counter_name()) < i + 1:
+                time.sleep(0.001)
+        holder.release()
+        for t in threads:
+            t.join()
+        self.assertEqual(order, [1, 2, 3, 4])
+        self.assertEqual(self.p4.value(holder.ticket_counter_name()),
+                         self.p4.value(holder.serving_counter_name()))
+
+
+if __name__ == "__main__":
+    unittest.main()
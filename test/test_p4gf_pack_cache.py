@@ -0,0 +1,105 @@
+#! /usr/bin/env python3.2
+"""p4gf_pack_cache's pkt-line parsing: which requests count as a plain
+full clone, and what key they get.
+
+Needs P4Python importable (nothing here talks to a server):
+
+    python3 -m unittest discover -s test
+"""
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+
+try:
+    import P4
+except ImportError:
+    P4 = None
+
+if P4:
+    import p4gf_pack_cache
+
+
+def _pkt(text):
+    """text as one pkt-line."""
+    data = text.encode()
+    return "{:04x}".format(len(data) + 4).encode() + data
+
+
+FLUSH = b'0000'
+WANT_A = "want " + "a" * 40 + " multi_ack_detailed side-band-64k agent=git/2.39.0\n"
+WANT_B = "want " + "b" * 40 + "\n"
+
+
+@unittest.skipUnless(P4, "P4Python not installed")
+class TestReadPkt(unittest.TestCase):
+    """One pkt-line at a time."""
+
+    def test_data_then_flush(self):
+        """Raw bytes come back as read, payload without the length."""
+        f = io.BytesIO(_pkt("hello\n") + FLUSH)
+        self.assertEqual(p4gf_pack_cache._read_pkt(f),
+                         (b'000ahello\n', b'hello\n'))
+        self.assertEqual(p4gf_pack_cache._read_pkt(f), (FLUSH, None))
+
+    def test_bad_length(self):
+        """Lengths 1 to 3 cannot be."""
+        with self.assertRaises(ValueError):
+            p4gf_pack_cache._read_pkt(io.BytesIO(b'0003'))
+
+    def test_truncated(self):
+        """Input that ends part way through a pkt-line."""
+        with self.assertRaises(EOFError):
+            p4gf_pack_cache._read_pkt(io.BytesIO(b'000ahel'))
+
+
+@unittest.skipUnless(P4, "P4Python not installed")
+class TestReadRequest(unittest.TestCase):
+    """Full clone, or anything else."""
+
+    def _read(self, data):
+        """_read_request() over data, checking it consumed exactly the
+        request and gave back its raw bytes.
+        """
+        f = io.BytesIO(data + b'more')
+        (raw, wants) = p4gf_pack_cache._read_request(f)
+        self.assertEqual(raw, data)
+        self.assertEqual(f.read(), b'more')
+        return wants
+
+    def test_full_clone(self):
+        """Want lines, flush, done: keyed without the agent string."""
+        wants = self._read(_pkt(WANT_A) + _pkt(WANT_B) + FLUSH + _pkt("done\n"))
+        self.assertEqual(wants,
+                         [("want " + "a" * 40
+                           + " multi_ack_detailed side-band-64k").encode(),
+                          ("want " + "b" * 40).encode()])
+
+    def test_same_key_any_agent(self):
+        """Two git versions asking for the same thing get the same key."""
+        other = WANT_A.replace("git/2.39.0", "git/2.45.1")
+        self.assertEqual(self._read(_pkt(WANT_A) + FLUSH + _pkt("done\n")),
+                         self._read(_pkt(other) + FLUSH + _pkt("done\n")))
+
+    def test_haves(self):
+        """An incremental fetch is not cached."""
+        data = (_pkt(WANT_A) + FLUSH
+                + _pkt("have " + "c" * 40 + "\n"))
+        self.assertIsNone(self._read(data))
+
+    def test_shallow(self):
+        """Nor is a shallow clone."""
+        data = (_pkt(WANT_A) + _pkt("deepen 1\n") + FLUSH + _pkt("done\n"))
+        self.assertIsNone(self._read(data))
+
+    def test_wants_nothing(self):
+        """A client already up to date sends just a flush."""
+        self.assertIsNone(self._read(FLUSH))
+
+
+if __name__ == "__main__":
+    unittest.main()